@@ -149,6 +149,27 @@ except ImportError:
     print "This is useful for fnv1_ch hashing support."
 
 
+# Test for scandir
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    print "[INFO]"
+    print "Unable to import the 'scandir' module."
+    print "This speeds up metric finds on large whisper trees on python < 3.5."
+
+
+# Test for numpy
+try:
+  import numpy
+except ImportError:
+  print "[INFO]"
+  print "Unable to import the 'numpy' module."
+  print "This is required for WHISPER_READER = 'mmap'."
+
+
 if fatal:
   print "%d necessary dependencies not met. Graphite will not function until these dependencies are fulfilled." % fatal
 
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Benchmarks TimeSeries consolidation against the per-value generator it replaced.
+
+Consolidates synthetic series the way a PNG render squeezes a week of minutely
+points into the width of a graph, with the old generator, with list-based
+series and with array-based series (TIMESERIES_BACKEND = 'array'). Renders
+iterate over every series several times, so the time of the first pass and of
+a repeated pass, served from the consolidation cache, are reported separately.
+
+Run from the root of a configured graphite install, for example:
+
+  misc/bench-consolidate.py --series 200 --points 10080 --per-point 15 --func max
+"""
+
+import os, sys, time, random, optparse
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'webapp'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphite.settings')
+
+import django
+if hasattr(django, 'setup'):
+  django.setup()
+
+from graphite.render import datalib
+
+
+parser = optparse.OptionParser(usage="%prog [options]")
+parser.add_option('--series', type='int', default=200, help="Number of series [default: %default]")
+parser.add_option('--points', type='int', default=10080, help="Values per series [default: %default]")
+parser.add_option('--per-point', type='int', default=15, help="Values consolidated into each point [default: %default]")
+parser.add_option('--nulls', type='float', default=0.05, help="Fraction of None values [default: %default]")
+parser.add_option('--func', default='average', help="Consolidation function [default: %default]")
+(options, args) = parser.parse_args()
+
+
+def generator(gen, valuesPerPoint, consolidationFunc):
+  # TimeSeries.__consolidatingGenerator and __consolidate as they were
+  buf = []
+  for x in gen:
+    buf.append(x)
+    if len(buf) == valuesPerPoint:
+      while None in buf: buf.remove(None)
+      if buf:
+        yield consolidate(buf, consolidationFunc)
+        buf = []
+      else:
+        yield None
+  while None in buf: buf.remove(None)
+  if buf: yield consolidate(buf, consolidationFunc)
+  else: yield None
+
+def consolidate(values, consolidationFunc):
+  usable = [v for v in values if v is not None]
+  if not usable: return None
+  if consolidationFunc == 'sum':
+    return sum(usable)
+  if consolidationFunc == 'average':
+    return float(sum(usable)) / len(usable)
+  if consolidationFunc == 'max':
+    return max(usable)
+  if consolidationFunc == 'min':
+    return min(usable)
+  raise Exception, "Invalid consolidation function!"
+
+
+def make_series(cls):
+  rng = random.Random(42)
+  seriesList = []
+  for i in range(options.series):
+    values = [None if rng.random() < options.nulls else rng.random() * 100 for j in range(options.points)]
+    series = cls('collectd.host%04d.cpu.user' % i, 0, 60 * options.points, 60, values, consolidate=options.func)
+    series.consolidate(options.per_point)
+    seriesList.append(series)
+  return seriesList
+
+def timed(func, seriesList):
+  t = time.time()
+  results = [func(series) for series in seriesList]
+  return (time.time() - t, results)
+
+
+reference = None
+candidates = [('generator', datalib.TimeSeries, lambda s: list(generator(s[:], s.valuesPerPoint, s.consolidationFunc)))]
+candidates.append( ('list', datalib.TimeSeries, list) )
+candidates.append( ('array', datalib.CompactTimeSeries, list) )
+if not datalib.numpy:
+  print "numpy is not installed, array-based series consolidate in pure Python"
+
+print "%d series of %d values, %d per point, %d%% None, %s" % (
+  options.series, options.points, options.per_point, options.nulls * 100, options.func)
+print "%-10s %12s %12s %16s" % ('engine', 'first s', 'repeat s', 'values/s')
+for (name, cls, func) in candidates:
+  seriesList = make_series(cls)
+  (first, results) = timed(func, seriesList)
+  (repeat, repeated) = timed(func, seriesList)
+  if options.func in ('sum', 'average', 'max', 'min'):
+    if reference is None:
+      reference = results
+    assert results == reference and repeated == reference, "%s consolidated differently" % name
+  print "%-10s %12.4f %12.4f %16.0f" % (name, first, repeat, options.series * options.points / first)
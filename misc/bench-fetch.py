@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Benchmarks local data fetches against the size of the local fetch pool.
+
+Builds a synthetic whisper tree and times graphite.render.datalib.fetchData()
+for a wildcard target matching every file, once per LOCAL_FETCH_THREADS value.
+Use --drop-caches (requires root) to measure cold reads from the disk instead
+of reads served from the page cache.
+
+Run from the root of a configured graphite install, for example:
+
+  misc/bench-fetch.py --files 2000 --threads 1,2,4,8,16 --drop-caches
+"""
+
+import os, sys, time, optparse
+from os.path import join, dirname, abspath
+from datetime import datetime
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'webapp'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphite.settings')
+
+import django
+if hasattr(django, 'setup'):
+  django.setup()
+
+import pytz
+import whisper
+from django.conf import settings
+from graphite.render import datalib
+from graphite.storage import Store
+
+
+parser = optparse.OptionParser(usage="%prog [options]")
+parser.add_option('--dir', default='/tmp/graphite-bench-whisper', help="Where to build the synthetic tree")
+parser.add_option('--files', type='int', default=2000, help="Number of whisper files [default: %default]")
+parser.add_option('--points', type='int', default=10080, help="Minutely points per file [default: %default]")
+parser.add_option('--threads', default='1,2,4,8,16', help="Pool sizes to compare [default: %default]")
+parser.add_option('--repeat', type='int', default=3, help="Runs per pool size [default: %default]")
+parser.add_option('--reader', default='whisper', help="WHISPER_READER to use [default: %default]")
+parser.add_option('--drop-caches', action='store_true', help="Drop the page cache before each run")
+(options, args) = parser.parse_args()
+
+
+def build_tree(root, files, points):
+  marker = join(root, '.complete-%d-%d' % (files, points))
+  if os.path.exists(marker):
+    return
+
+  print "Building %d whisper files with %d points beneath %s" % (files, points, root)
+  now = int(time.time())
+  now -= now % 60
+  datapoints = [(now - (i * 60), float(i)) for i in range(points)]
+  for i in range(files):
+    directory = join(root, 'bench', 'host%04d' % (i // 100))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    path = join(directory, 'metric%02d.wsp' % (i % 100))
+    whisper.create(path, [(60, points)])
+    whisper.update_many(path, datapoints)
+
+  open(marker, 'w').close()
+
+
+def drop_caches():
+  os.system('sync')
+  with open('/proc/sys/vm/drop_caches', 'w') as fh:
+    fh.write('3\n')
+
+
+build_tree(options.dir, options.files, options.points)
+
+settings.WHISPER_READER = options.reader
+datalib.LOCAL_STORE = Store([options.dir])
+datalib.CarbonLink = datalib.CarbonLinkPool([], 1)
+
+now = time.time()
+requestContext = {
+  'startTime' : datetime.fromtimestamp(now - (options.points * 60), pytz.utc),
+  'endTime' : datetime.fromtimestamp(now, pytz.utc),
+  'now' : datetime.fromtimestamp(now, pytz.utc),
+  'localOnly' : True,
+}
+
+print "%-8s %10s %10s %8s" % ('threads', 'series', 'seconds', 'speedup')
+baseline = None
+for threads in [int(t) for t in options.threads.split(',')]:
+  settings.LOCAL_FETCH_THREADS = threads
+  timings = []
+  for i in range(options.repeat):
+    if options.drop_caches:
+      drop_caches()
+    t = time.time()
+    seriesList = datalib.fetchData(requestContext, 'bench.*.*')
+    timings.append(time.time() - t)
+
+  best = min(timings)
+  if baseline is None:
+    baseline = best
+  print "%-8d %10d %10.3f %7.2fx" % (threads, len(seriesList), best, baseline / best)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""Benchmarks local metric finds on a synthetic whisper tree.
+
+Compares the original listdir/isdir/isfile walker with the scandir based
+scanner used by graphite.storage.find(), with and without the directory cache.
+Filesystem calls are counted by wrapping os.listdir, os.stat, os.lstat and
+scandir; type checks answered from d_type never reach the kernel and are
+therefore not counted.
+
+Run from the root of a configured graphite install, for example:
+
+  misc/bench-find.py --files 1000000 --dir /tmp/bench-tree
+"""
+
+import os, sys, time, fnmatch, optparse
+from os.path import join, isdir, isfile, dirname, abspath, realpath
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'webapp'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphite.settings')
+
+import django
+if hasattr(django, 'setup'):
+  django.setup()
+
+from graphite import storage
+
+
+parser = optparse.OptionParser(usage="%prog [options]")
+parser.add_option('--dir', default='/tmp/graphite-bench-tree', help="Where to build the synthetic tree")
+parser.add_option('--files', type='int', default=1000000, help="Number of whisper files [default: %default]")
+parser.add_option('--fanout', type='int', default=100, help="Entries per directory level [default: %default]")
+parser.add_option('--repeat', type='int', default=3, help="Runs per query [default: %default]")
+(options, args) = parser.parse_args()
+
+
+def build_tree(root, files, fanout):
+  "Creates root/hostNN/serviceNN/metricNN.wsp until there are enough files"
+  marker = join(root, '.complete-%d-%d' % (files, fanout))
+  if os.path.exists(marker):
+    return
+
+  print "Building %d files beneath %s" % (files, root)
+  created = 0
+  host = 0
+  while created < files:
+    for service in xrange(fanout):
+      directory = join(root, 'host%04d' % host, 'service%02d' % service)
+      os.makedirs(directory)
+      for metric in xrange(min(fanout, files - created)):
+        open(join(directory, 'metric%02d.wsp' % metric), 'w').close()
+        created += 1
+      if created >= files:
+        break
+    host += 1
+
+  open(marker, 'w').close()
+
+
+# The walker graphite.storage used before the scanner was introduced
+def legacy_find(root_dir, pattern):
+  for absolute_path in legacy_walk(root_dir, pattern.split('.')):
+    metric_path = absolute_path[len(root_dir):].lstrip('/').replace('/', '.')
+    if isdir(absolute_path):
+      yield storage.Branch(absolute_path, metric_path)
+    elif isfile(absolute_path):
+      node = storage.WhisperFile(absolute_path, metric_path[:-4])
+      realpath(absolute_path) # eagerly resolved symlinks back then
+      yield node
+
+def legacy_walk(current_dir, patterns):
+  pattern = patterns[0]
+  patterns = patterns[1:]
+  entries = os.listdir(current_dir)
+  subdirs = [e for e in entries if isdir(join(current_dir, e))]
+  matching_subdirs = legacy_match(subdirs, pattern)
+
+  if patterns:
+    for subdir in matching_subdirs:
+      for match in legacy_walk(join(current_dir, subdir), patterns):
+        yield match
+  else:
+    files = [e for e in entries if isfile(join(current_dir, e))]
+    for basename in legacy_match(files, pattern + '.*') + matching_subdirs:
+      yield join(current_dir, basename)
+
+def legacy_match(entries, pattern):
+  matching = []
+  for variant in storage.expand_braces(pattern):
+    matching.extend(fnmatch.filter(entries, variant))
+  return list(set(matching))
+
+
+class CallCounter:
+  "Counts calls to the filesystem functions used by the walkers"
+  names = ('listdir', 'stat', 'lstat')
+
+  def __init__(self):
+    self.counts = dict.fromkeys(self.names + ('scandir',), 0)
+    self.originals = {}
+
+  def wrap(self, name, func):
+    def counted(*args, **kwargs):
+      self.counts[name] += 1
+      return func(*args, **kwargs)
+    return counted
+
+  def __enter__(self):
+    for name in self.names:
+      self.originals[name] = getattr(os, name)
+      setattr(os, name, self.wrap(name, self.originals[name]))
+    self.originals['scandir'] = storage.scandir
+    if storage.scandir:
+      storage.scandir = self.wrap('scandir', storage.scandir)
+    return self
+
+  def __exit__(self, *exc_info):
+    for name in self.names:
+      setattr(os, name, self.originals[name])
+    storage.scandir = self.originals['scandir']
+
+  def total(self):
+    return sum(self.counts.values())
+
+
+def run(label, func, query):
+  timings = []
+  for i in range(options.repeat):
+    with CallCounter() as counter:
+      t = time.time()
+      results = sum(1 for match in func(options.dir, query))
+      timings.append(time.time() - t)
+  print "  %-24s %8d results %9.3fs %10d fs calls  %s" % (
+    label, results, min(timings), counter.total(),
+    ' '.join('%s=%d' % item for item in sorted(counter.counts.items()) if item[1]))
+
+
+def uncached_find(root_dir, query):
+  storage.DIRECTORY_CACHE.listings.max_size = 0
+  return storage.find(root_dir, query)
+
+def cached_find(root_dir, query):
+  storage.DIRECTORY_CACHE.listings.max_size = options.files
+  storage.DIRECTORY_CACHE.racy_interval = 0
+  return storage.find(root_dir, query)
+
+
+build_tree(options.dir, options.files, options.fanout)
+if not storage.scandir:
+  print "WARNING: no scandir implementation available, the scanner falls back to listdir"
+
+for query in ('host0001.service01.metric01', 'host00*.service01.*', 'host*.service0{1,2}.metric0*', 'host*.*.*'):
+  print query
+  run('legacy walker', legacy_find, query)
+  run('scanner', uncached_find, query)
+  run('scanner + directory cache', cached_find, query)
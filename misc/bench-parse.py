@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Benchmarks the target parser against the pyparsing grammar it replaced.
+
+Parses a short target, a nested one and a sumSeries() of many path
+expressions with both, checks they read them into the same tree and reports
+the parses per second. The time a fresh interpreter takes to import each of
+them, which every worker pays at startup, is reported as well.
+
+Run from the root of a graphite checkout, for example:
+
+  misc/bench-parse.py --paths 500 --seconds 2
+"""
+
+import os, sys, time, subprocess, optparse
+from os.path import join, dirname, abspath
+
+WEBAPP_DIR = join(dirname(dirname(abspath(__file__))), 'webapp')
+sys.path.insert(0, WEBAPP_DIR)
+
+from graphite.render.grammar import grammar, freeze
+from graphite.render.parser import parse
+
+
+parser = optparse.OptionParser(usage="%prog [options]")
+parser.add_option('--paths', type='int', default=300, help="Path expressions in the wide target [default: %default]")
+parser.add_option('--seconds', type='float', default=1.0, help="Time spent parsing each target [default: %default]")
+(options, args) = parser.parse_args()
+
+
+targets = [
+  ('short', 'collectd.*.cpu-0.cpu-user'),
+  ('nested', "aliasByNode(movingAverage(sumSeries(collectd.{web,api}*.cpu-*.cpu-user), '5min'), 1)"),
+  ('wide', 'sumSeries(%s)' % ', '.join('servers.host%04d.cpu.{user,system}' % i for i in range(options.paths))),
+]
+
+
+def rate(func, target):
+  count = 0
+  t = time.time()
+  deadline = t + options.seconds
+  while time.time() < deadline:
+    func(target)
+    count += 1
+  return count / (time.time() - t)
+
+def import_time(module):
+  code = "import time; t = time.time(); import %s; print time.time() - t" % module
+  env = dict(os.environ, PYTHONPATH=WEBAPP_DIR)
+  return float(subprocess.check_output([sys.executable, '-c', code], env=env))
+
+
+print "%-8s %8s %16s %16s %10s" % ('target', 'chars', 'pyparsing /s', 'parser /s', 'speedup')
+for (name, target) in targets:
+  assert parse(target) == freeze(grammar.parseString(target)), "%s target parsed differently" % name
+  old = rate(grammar.parseString, target)
+  new = rate(parse, target)
+  print "%-8s %8d %16.0f %16.0f %9.1fx" % (name, len(target), old, new, new / old)
+
+print
+print "import graphite.render.grammar %8.1f ms" % (import_time('graphite.render.grammar') * 1000)
+print "import graphite.render.parser  %8.1f ms" % (import_time('graphite.render.parser') * 1000)
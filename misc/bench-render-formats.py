@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Benchmarks the streaming json, csv and raw render encoders.
+
+Encodes the series of a wide render the way the render view did before it
+streamed them, as one string, and with the streaming encoders, checking both
+give the same bytes. Each encoding runs in a fresh child process that builds
+the series first, and reports how much the resident set grew while encoding
+and how long it took.
+
+Run from the root of a configured graphite install, for example:
+
+  misc/bench-render-formats.py --series 1000,10000 --points 1440 --formats json,csv
+"""
+
+import os, sys, csv, time, random, resource, optparse
+from cStringIO import StringIO
+from datetime import datetime
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'webapp'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphite.settings')
+
+import django
+if hasattr(django, 'setup'):
+  django.setup()
+
+import pytz
+from graphite.util import json
+from graphite.render.datalib import TimeSeries
+from graphite.render.streaming import jsonChunks, csvChunks, rawChunks
+
+
+parser = optparse.OptionParser(usage="%prog [options]")
+parser.add_option('--series', default='1000,10000', help="Numbers of series to encode [default: %default]")
+parser.add_option('--points', type='int', default=1440, help="Values per series [default: %default]")
+parser.add_option('--nulls', type='float', default=0.05, help="Fraction of None values [default: %default]")
+parser.add_option('--formats', default='json,csv,raw', help="Formats to compare [default: %default]")
+(options, args) = parser.parse_args()
+
+TZINFO = pytz.timezone('Europe/Berlin')
+
+
+def max_rss():
+  # kilobytes on Linux, bytes on OS X
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return rss
+  return rss * 1024
+
+
+def build(count):
+  rng = random.Random(42)
+  template = [None if rng.random() < options.nulls else rng.random() * 100 for i in range(options.points)]
+  start = 1400000000
+  end = start + 60 * options.points
+  return [TimeSeries('collectd.host%05d.cpu.user' % i, start, end, 60, [None if v is None else v + i for v in template])
+          for i in range(count)]
+
+
+# How the render view encoded the formats before streaming them
+def old_json(data):
+  series_data = []
+  for series in data:
+    timestamps = range(int(series.start), int(series.end) + 1, int(series.step))
+    datapoints = zip(series, timestamps)
+    series_data.append( dict(target=series.name, datapoints=datapoints) )
+  return json.dumps(series_data)
+
+def old_csv(data):
+  response = StringIO()
+  writer = csv.writer(response, dialect='excel')
+  for series in data:
+    for i, value in enumerate(series):
+      timestamp = datetime.fromtimestamp(series.start + (i * series.step), TZINFO)
+      writer.writerow((series.name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), value))
+  return response.getvalue()
+
+def old_raw(data):
+  response = StringIO()
+  for series in data:
+    response.write( "%s,%d,%d,%d|" % (series.name, series.start, series.end, series.step) )
+    response.write( ','.join(map(str,series)) )
+    response.write('\n')
+  return response.getvalue()
+
+
+def new_chunks(format, data):
+  if format == 'json':
+    return jsonChunks([(series, xrange(int(series.start), int(series.end) + 1, int(series.step))) for series in data])
+  if format == 'csv':
+    return csvChunks(data, TZINFO)
+  return rawChunks(data)
+
+
+def measure(format, count, streaming):
+  data = build(count)
+  before = max_rss()
+  t = time.time()
+  if streaming:
+    # Stands in for the server writing each chunk out
+    digest = 0
+    size = 0
+    for chunk in new_chunks(format, data):
+      digest = hash((digest, chunk))
+      size += len(chunk)
+  else:
+    body = globals()['old_' + format](data)
+    size = len(body)
+    digest = hash(body)
+  return (max_rss() - before, time.time() - t, size)
+
+
+def in_child(*args):
+  (read, write) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read)
+    os.write(write, repr(measure(*args)))
+    os._exit(0)
+
+  os.close(write)
+  result = ''
+  while True:
+    data = os.read(read, 4096)
+    if not data:
+      break
+    result += data
+  os.close(read)
+  os.waitpid(pid, 0)
+  return eval(result)
+
+
+# The encodings must match before their speed does
+sample = build(20)
+for format in options.formats.split(','):
+  assert ''.join(new_chunks(format, sample)) == globals()['old_' + format](sample), "%s output differs" % format
+
+print "%d values per series, %d%% None" % (options.points, options.nulls * 100)
+print "%-6s %8s %12s %14s %14s %12s %12s %9s" % ('format', 'series', 'output MB', 'one string MB', 'streaming MB',
+                                                  'one string s', 'streaming s', 'speedup')
+for count in [int(count) for count in options.series.split(',')]:
+  for format in options.formats.split(','):
+    (oldGrown, oldTime, size) = in_child(format, count, False)
+    (newGrown, newTime, newSize) = in_child(format, count, True)
+    assert size == newSize
+    print "%-6s %8d %12.1f %14.1f %14.1f %12.3f %12.3f %8.1fx" % (
+      format, count, size / 1048576.0, oldGrown / 1048576.0, newGrown / 1048576.0, oldTime, newTime, oldTime / newTime)
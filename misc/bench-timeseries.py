@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Benchmarks the memory use of the TIMESERIES_BACKEND choices.
+
+Builds the series a wide render would fetch, once per backend and each time in
+a fresh child process, and reports how much the resident set grew, the bytes
+per value, and how long building the series, iterating over them and
+assigning every value in place (as scale() and offset() do) took.
+
+Run from the root of a configured graphite install, for example:
+
+  misc/bench-timeseries.py --series 10000 --points 10080 --nulls 0.05
+"""
+
+import os, sys, time, random, resource, optparse
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'webapp'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphite.settings')
+
+import django
+if hasattr(django, 'setup'):
+  django.setup()
+
+from django.conf import settings
+from graphite.render import datalib
+
+
+parser = optparse.OptionParser(usage="%prog [options]")
+parser.add_option('--series', type='int', default=1000, help="Number of series [default: %default]")
+parser.add_option('--points', type='int', default=10080, help="Values per series [default: %default]")
+parser.add_option('--nulls', type='float', default=0.05, help="Fraction of None values [default: %default]")
+parser.add_option('--backends', default='list,array', help="Backends to compare [default: %default]")
+(options, args) = parser.parse_args()
+
+
+def max_rss():
+  # kilobytes on Linux, bytes on OS X
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return rss
+  return rss * 1024
+
+
+def measure(backend):
+  settings.TIMESERIES_BACKEND = backend
+  rng = random.Random(42)
+  template = [None if rng.random() < options.nulls else rng.random() * 100 for i in range(options.points)]
+  before = max_rss()
+
+  t = time.time()
+  seriesList = []
+  for i in range(options.series):
+    # Fresh float objects for every series, as a fetch returns them
+    values = [None if v is None else v + i for v in template]
+    seriesList.append( datalib.newTimeSeries('collectd.host%05d.cpu.user' % i, 0, 60 * options.points, 60, values) )
+    del values
+  buildTime = time.time() - t
+  grown = max_rss() - before
+
+  t = time.time()
+  for series in seriesList:
+    for value in series:
+      pass
+  iterateTime = time.time() - t
+
+  t = time.time()
+  for series in seriesList:
+    for (i, value) in enumerate(series):
+      if value is not None:
+        series[i] = value + 1
+  assignTime = time.time() - t
+  return (grown, buildTime, iterateTime, assignTime)
+
+
+values = options.series * options.points
+print "%d series of %d values, %d%% None" % (options.series, options.points, options.nulls * 100)
+print "%-8s %14s %14s %12s %12s %12s" % ('backend', 'RSS growth MB', 'bytes/value', 'build s', 'iterate s', 'assign s')
+for backend in options.backends.split(','):
+  (read, write) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read)
+    os.write(write, repr(measure(backend)))
+    os._exit(0)
+
+  os.close(write)
+  result = ''
+  while True:
+    data = os.read(read, 4096)
+    if not data:
+      break
+    result += data
+  os.close(read)
+  os.waitpid(pid, 0)
+
+  (grown, buildTime, iterateTime, assignTime) = eval(result)
+  print "%-8s %14.1f %14.1f %12.3f %12.3f %12.3f" % (backend, grown / 1048576.0, float(grown) / values, buildTime, iterateTime, assignTime)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Benchmarks the cluster wire format against the pickle format.
+
+Encodes and decodes synthetic fetch results the way a remote webapp answers
+/render/?format=pickle and the requesting webapp reads the answer, and
+reports message sizes and throughput for both formats. Every round trip is
+checked to give back the original series.
+
+Run from the root of a configured graphite install, for example:
+
+  misc/bench-wire.py --series 500 --points 1440 --nulls 0.1
+"""
+
+import os, sys, time, random, optparse
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'webapp'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphite.settings')
+
+import django
+if hasattr(django, 'setup'):
+  django.setup()
+
+import cPickle as pickle
+from graphite import wireformat
+from graphite.util import unpickle
+
+
+parser = optparse.OptionParser(usage="%prog [options]")
+parser.add_option('--series', type='int', default=500, help="Series per message [default: %default]")
+parser.add_option('--points', type='int', default=1440, help="Values per series [default: %default]")
+parser.add_option('--nulls', type='float', default=0.1, help="Fraction of None values [default: %default]")
+parser.add_option('--repeat', type='int', default=5, help="Runs per format [default: %default]")
+(options, args) = parser.parse_args()
+
+
+def make_series(count, points, nulls):
+  rng = random.Random(42)
+  seriesList = []
+  for i in range(count):
+    values = [None if rng.random() < nulls else rng.random() * 100 for j in range(points)]
+    seriesList.append({
+      'name' : 'collectd.host%04d.cpu.user' % i,
+      'pathExpression' : 'collectd.*.cpu.user',
+      'start' : 1465844460,
+      'end' : 1465844460 + 60 * points,
+      'step' : 60,
+      'values' : values,
+    })
+  return seriesList
+
+
+def best(func, arg):
+  timings = []
+  for i in range(options.repeat):
+    t = time.time()
+    result = func(arg)
+    timings.append(time.time() - t)
+  return (min(timings), result)
+
+
+seriesList = make_series(options.series, options.points, options.nulls)
+values = options.series * options.points
+formats = [
+  ('pickle', lambda s: pickle.dumps(s, protocol=-1), unpickle.loads),
+  ('wire v%d' % wireformat.VERSION, wireformat.dumpSeries, wireformat.loads),
+]
+
+print "%d series of %d values, %d%% None" % (options.series, options.points, options.nulls * 100)
+print "%-10s %12s %12s %12s %16s" % ('format', 'bytes', 'encode s', 'decode s', 'decoded values/s')
+for (name, dumps, loads) in formats:
+  (encodeTime, data) = best(dumps, seriesList)
+  (decodeTime, decoded) = best(loads, data)
+  assert decoded == seriesList, "%s round trip changed the series" % name
+  print "%-10s %12d %12.4f %12.4f %16.0f" % (name, len(data), encodeTime, decodeTime, values / decodeTime)
@@ -0,0 +1,311 @@
+"""Counters, gauges and latency histograms about the webapp itself.
+
+Each webapp process keeps its own registry in memory. With
+INTERNAL_METRICS_DIR, every process writes a snapshot of its registry to a
+file of its own there every INTERNAL_METRICS_INTERVAL seconds while it is
+busy, and the /internal/metrics view adds up the snapshots of all processes,
+so preforked workers report as one webapp. Gauges report the largest value of
+any process instead, as most of them measure state the processes share or
+hold alike. Snapshots of processes that have exited are removed, which resets
+their counts. A background thread of each process writes its snapshots, so
+requests never wait for them.
+
+With INTERNAL_METRICS_CARBON_SERVER, the sums are also sent to carbon every
+INTERNAL_METRICS_INTERVAL seconds, by one process at a time."""
+import os
+import re
+import errno
+import fcntl
+import socket
+import tempfile
+import threading
+from time import time
+from django.conf import settings
+from graphite.logger import log
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+
+NAMESPACE = 'graphite_webapp_'
+
+# Upper bounds in seconds of the buckets of latency histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+SEND_TIMEOUT = 1.0
+
+
+class Registry:
+  "The counters, gauges and histograms of one process, by name and labels"
+  def __init__(self):
+    self.pid = os.getpid()
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.gauges = {}
+    self.histograms = {}
+    self.flushed = time()
+    self.flusher = None
+
+  def increment(self, key, value):
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def set(self, key, value):
+    with self.lock:
+      self.gauges[key] = value
+
+  def observe(self, key, value):
+    with self.lock:
+      histogram = self.histograms.get(key)
+      if histogram is None:
+        # The count of each bucket, then the sum and count of all values
+        histogram = self.histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+      for (i, bound) in enumerate(BUCKETS):
+        if value <= bound:
+          histogram[i] += 1
+          break
+      histogram[-2] += value
+      histogram[-1] += 1
+
+  def snapshot(self):
+    with self.lock:
+      counters = dict(self.counters)
+      gauges = dict(self.gauges)
+      histograms = dict( (key, list(histogram)) for (key, histogram) in self.histograms.items() )
+    for collect in _collectors:
+      try:
+        for (kind, name, labels, value) in collect():
+          key = (name, labelKey(labels))
+          if kind == 'counter':
+            counters[key] = counters.get(key, 0) + value
+          else:
+            gauges[key] = value
+      except:
+        log.exception("Failed to collect internal metrics from %s" % collect.__name__)
+    return dict(counters=counters, gauges=gauges, histograms=histograms)
+
+
+class Flusher(threading.Thread):
+  "Flushes a registry whenever a request found a flush due"
+  def __init__(self, registry):
+    threading.Thread.__init__(self, name='internal-metrics-flusher')
+    self.daemon = True
+    self.registry = registry
+    self.due = threading.Event()
+
+  def run(self):
+    while True:
+      self.due.wait()
+      self.due.clear()
+      try:
+        flush(self.registry)
+      except:
+        log.exception("Failed to flush internal metrics")
+
+
+_registry = None
+_registryLock = threading.Lock()
+_collectors = []
+
+def registry():
+  "Returns the registry of this process"
+  global _registry
+  # A registry inherited from the parent of a preforked worker counts for the parent
+  if _registry is None or _registry.pid != os.getpid():
+    with _registryLock:
+      if _registry is None or _registry.pid != os.getpid():
+        _registry = Registry()
+  return _registry
+
+
+def labelKey(labels):
+  return tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+  "Adds value to the counter name with labels"
+  current = registry()
+  current.increment((name, labelKey(labels)), value)
+  flushIfDue(current)
+
+
+def setGauge(name, value, **labels):
+  current = registry()
+  current.set((name, labelKey(labels)), value)
+  flushIfDue(current)
+
+
+def observe(name, seconds, **labels):
+  "Adds a duration to the latency histogram name with labels"
+  current = registry()
+  current.observe((name, labelKey(labels)), seconds)
+  flushIfDue(current)
+
+
+def addCollector(collect):
+  """Registers collect, a function returning (kind, name, labels, value) for
+  metrics other modules keep track of themselves. Kind is 'counter' or 'gauge'."""
+  _collectors.append(collect)
+
+
+def flushIfDue(current):
+  if time() - current.flushed < settings.INTERNAL_METRICS_INTERVAL:
+    return
+  if not (settings.INTERNAL_METRICS_DIR or settings.INTERNAL_METRICS_CARBON_SERVER):
+    return
+  current.flushed = time()
+  with _registryLock:
+    if current.flusher is None:
+      current.flusher = Flusher(current)
+      current.flusher.start()
+  current.flusher.due.set()
+
+
+def flush(current):
+  "Writes the snapshot of current to INTERNAL_METRICS_DIR and sends the metrics to carbon when due"
+  directory = settings.INTERNAL_METRICS_DIR
+  if directory:
+    writeSnapshot(directory, current.pid, current.snapshot())
+  if not settings.INTERNAL_METRICS_CARBON_SERVER:
+    return
+  if not directory:
+    sendToCarbon(current.snapshot())
+    return
+
+  # Whichever process gets the lock once the interval has passed sends the sums
+  with open(os.path.join(directory, 'carbon.lock'), 'a') as lock:
+    try:
+      fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      return
+    if time() - os.fstat(lock.fileno()).st_mtime >= settings.INTERNAL_METRICS_INTERVAL:
+      os.utime(lock.name, None)
+      sendToCarbon(aggregate())
+
+
+def writeSnapshot(directory, pid, snapshot):
+  (fd, path) = tempfile.mkstemp(prefix='.%d-' % pid, dir=directory)
+  with os.fdopen(fd, 'wb') as f:
+    pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+  os.rename(path, os.path.join(directory, '%d.pickle' % pid))
+
+
+def aggregate():
+  """Returns the sums of the snapshots of all webapp processes, with the largest
+  value of each gauge, or the snapshot of this one"""
+  current = registry()
+  snapshot = current.snapshot()
+  directory = settings.INTERNAL_METRICS_DIR
+  if not directory:
+    return snapshot
+
+  for filename in os.listdir(directory):
+    if not filename.endswith('.pickle'):
+      continue
+    try:
+      pid = int(filename.split('.')[0])
+    except ValueError:
+      continue
+    path = os.path.join(directory, filename)
+    if pid == current.pid:
+      continue
+    if not isAlive(pid):
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+      continue
+    try:
+      with open(path, 'rb') as f:
+        other = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+      continue
+    for (key, value) in other['counters'].items():
+      snapshot['counters'][key] = snapshot['counters'].get(key, 0) + value
+    for (key, value) in other['gauges'].items():
+      snapshot['gauges'][key] = max(snapshot['gauges'].get(key, value), value)
+    for (key, histogram) in other['histograms'].items():
+      mine = snapshot['histograms'].get(key)
+      if mine is None:
+        snapshot['histograms'][key] = histogram
+      else:
+        snapshot['histograms'][key] = [a + b for (a, b) in zip(mine, histogram)]
+
+  return snapshot
+
+
+def isAlive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError, e:
+    return e.errno == errno.EPERM
+  return True
+
+
+def exposition(snapshot):
+  "Returns snapshot in the Prometheus text exposition format"
+  lines = []
+  for (kind, values) in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+    typed = set()
+    for ((name, labels), value) in sorted(values.items()):
+      if name not in typed:
+        typed.add(name)
+        lines.append('# TYPE %s%s %s' % (NAMESPACE, name, kind))
+      lines.append('%s%s%s %s' % (NAMESPACE, name, formatLabels(labels), formatValue(value)))
+
+  typed = set()
+  for ((name, labels), histogram) in sorted(snapshot['histograms'].items()):
+    if name not in typed:
+      typed.add(name)
+      lines.append('# TYPE %s%s histogram' % (NAMESPACE, name))
+    cumulative = 0
+    for (bound, count) in zip(BUCKETS, histogram):
+      cumulative += count
+      lines.append('%s%s_bucket%s %d' % (NAMESPACE, name, formatLabels(labels + (('le', str(bound)),)), cumulative))
+    lines.append('%s%s_bucket%s %d' % (NAMESPACE, name, formatLabels(labels + (('le', '+Inf'),)), histogram[-1]))
+    lines.append('%s%s_sum%s %s' % (NAMESPACE, name, formatLabels(labels), formatValue(histogram[-2])))
+    lines.append('%s%s_count%s %d' % (NAMESPACE, name, formatLabels(labels), histogram[-1]))
+
+  return '\n'.join(lines) + '\n'
+
+
+def formatLabels(labels):
+  if not labels:
+    return ''
+  escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for (name, value) in labels)
+
+
+def formatValue(value):
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+
+def carbonLines(snapshot, timestamp):
+  "Returns the lines of the plaintext carbon protocol for snapshot"
+  prefix = settings.INTERNAL_METRICS_CARBON_PREFIX.format(host=socket.gethostname().split('.')[0])
+  def path(name, labels, suffix=''):
+    parts = [prefix, name + suffix] + [re.sub(r'[^\w-]', '_', str(value)) for (label, value) in labels]
+    return '.'.join(parts)
+
+  lines = []
+  for values in (snapshot['counters'], snapshot['gauges']):
+    for ((name, labels), value) in sorted(values.items()):
+      lines.append('%s %s %d' % (path(name, labels), formatValue(value), timestamp))
+  for ((name, labels), histogram) in sorted(snapshot['histograms'].items()):
+    lines.append('%s %s %d' % (path(name, labels, '_sum'), formatValue(histogram[-2]), timestamp))
+    lines.append('%s %d %d' % (path(name, labels, '_count'), histogram[-1], timestamp))
+  return lines
+
+
+def sendToCarbon(snapshot):
+  (host, port) = settings.INTERNAL_METRICS_CARBON_SERVER.rsplit(':', 1)
+  lines = carbonLines(snapshot, int(time()))
+  connection = socket.create_connection((host, int(port)), SEND_TIMEOUT)
+  try:
+    connection.sendall('\n'.join(lines) + '\n')
+  finally:
+    connection.close()
@@ -19,6 +19,7 @@ from django.conf import settings
 logging.addLevelName(30,"rendering")
 logging.addLevelName(30,"cache")
 logging.addLevelName(30,"metric_access")
+logging.addLevelName(30,"slow_query")
 
 class GraphiteLogger:
   def __init__(self):
@@ -28,6 +29,7 @@ class GraphiteLogger:
     self.cacheLogFile = os.path.join(settings.LOG_DIR,"cache.log")
     self.renderingLogFile = os.path.join(settings.LOG_DIR,"rendering.log")
     self.metricAccessLogFile = os.path.join(settings.LOG_DIR,"metricaccess.log")
+    self.slowQueryLogFile = os.path.join(settings.LOG_DIR,"slowquery.log")
     #Setup loggers
     self.infoLogger = logging.getLogger("info")
     self.infoLogger.setLevel(logging.INFO)
@@ -35,6 +37,7 @@ class GraphiteLogger:
     self.cacheLogger = logging.getLogger("cache")
     self.renderingLogger = logging.getLogger("rendering")
     self.metricAccessLogger = logging.getLogger("metric_access")
+    self.slowQueryLogger = logging.getLogger("slow_query")
     #Setup formatter & handlers
     self.formatter = logging.Formatter("%(asctime)s :: %(message)s","%a %b %d %H:%M:%S %Y")
     self.infoHandler = Rotater(self.infoLogFile,when="midnight",backupCount=1)
@@ -55,6 +58,11 @@ class GraphiteLogger:
       self.metricAccessHandler = Rotater(self.metricAccessLogFile,when="midnight",backupCount=10)
       self.metricAccessHandler.setFormatter(self.formatter)
       self.metricAccessLogger.addHandler(self.metricAccessHandler)
+    if settings.SLOW_QUERY_THRESHOLD > 0:
+      #One JSON object per line
+      self.slowQueryHandler = Rotater(self.slowQueryLogFile,when="midnight",backupCount=10)
+      self.slowQueryHandler.setFormatter(logging.Formatter("%(message)s"))
+      self.slowQueryLogger.addHandler(self.slowQueryHandler)
 
   def info(self,msg,*args,**kwargs):
     return self.infoLogger.info(msg,*args,**kwargs)
@@ -80,5 +88,11 @@ class GraphiteLogger:
     else:
       return
 
+  def slow_query(self,msg,*args,**kwargs):
+    if settings.SLOW_QUERY_THRESHOLD > 0:
+      return self.slowQueryLogger.log(30,msg,*args,**kwargs)
+    else:
+      return
+
 
 log = GraphiteLogger() # import-shared logger instance
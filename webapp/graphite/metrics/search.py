@@ -3,7 +3,8 @@ import subprocess
 import os.path
 from django.conf import settings
 from graphite.logger import log
-from graphite.storage import is_pattern, match_entries
+from graphite import instrumentation
+from graphite.storage import is_pattern, iter_matching_entries
 
 
 class IndexSearcher:
@@ -59,6 +60,8 @@ class IndexSearcher:
     self._tree = tree
     self.last_mtime = os.path.getmtime(self.index_path)
     log.info("[IndexSearcher] index reload took %.6f seconds (%d entries)" % (time.time() - t, total_entries))
+    instrumentation.observe('index_reload_duration_seconds', time.time() - t)
+    instrumentation.setGauge('index_entries', total_entries)
 
   def search(self, query, max_results=None, keep_query_pattern=False):
     query_parts = query.split('.')
@@ -81,7 +84,7 @@ class IndexSearcher:
     if query_parts:
       my_query = query_parts[0]
       if is_pattern(my_query):
-        matches = [root[1][node] for node in match_entries(root[1], my_query)]
+        matches = [root[1][node] for node in iter_matching_entries(root[1], my_query)]
       elif my_query in root[1]:
         matches = [root[1][my_query]]
       else:
@@ -22,6 +22,7 @@ from graphite.storage import STORE, LOCAL_STORE, RRDFile
 from graphite.metrics.search import searcher
 from graphite.render.datalib import CarbonLink
 from graphite.remote_storage import extractForwardHeaders
+from graphite import wireformat
 import fnmatch, os
 
 try:
@@ -133,6 +134,7 @@ def find_view(request):
   wildcards = int( request.REQUEST.get('wildcards', 0) )
   automatic_variants = int( request.REQUEST.get('automatic_variants', 0) )
   jsonp = request.REQUEST.get('jsonp', False)
+  wire_format = int( request.REQUEST.get('wireFormat', 0) )
   forward_headers = extractForwardHeaders(request)
 
   try:
@@ -175,6 +177,15 @@ def find_view(request):
     content = tree_json(matches, base_path, wildcards=profile.advancedUI or wildcards, contexts=contexts)
     response = json_response_for(request, content)
 
+  elif format == 'pickle' and wire_format and not contexts:
+    try:
+      content = wireformat.dumpNodes(matches)
+      response = HttpResponse(content, content_type=wireformat.CONTENT_TYPE)
+    except wireformat.WireFormatError, e:
+      log.info("Sending pickle, the nodes cannot be encoded in the wire format: %s" % e)
+      content = pickle_nodes(matches)
+      response = HttpResponse(content, content_type='application/pickle')
+
   elif format == 'pickle':
     content = pickle_nodes(matches, contexts=contexts)
     response = HttpResponse(content, content_type='application/pickle')
@@ -1,11 +1,19 @@
+import errno
+import os
 import socket
+import select
 import time
+import threading
 import httplib
+from cStringIO import StringIO
 from urllib import urlencode
-from django.core.cache import cache
 from django.conf import settings
+from graphite.logger import log
+from graphite import instrumentation
 from graphite.render.hashing import compactHash
+from graphite.render import tieredcache
 from graphite.util import unpickle
+from graphite import wireformat
 
 
 
@@ -29,6 +37,7 @@ class RemoteStore(object):
 
   def fail(self):
     self.lastFailure = time.time()
+    instrumentation.increment('remote_store_failures_total', host=self.host)
 
 
 
@@ -42,53 +51,56 @@ class FindRequest:
     self.cachedResults = None
 
 
-  def send(self, headers=None):
-    self.cachedResults = cache.get(self.cacheKey)
-
-    if self.cachedResults:
-      return
-
-    self.connection = HTTPConnectionWithTimeout(self.store.host)
-    self.connection.timeout = settings.REMOTE_STORE_FIND_TIMEOUT
-
+  def request(self, headers=None):
+    "Returns the method, url, body and headers of the find request"
     query_params = [
       ('local', '1'),
       ('format', 'pickle'),
       ('query', self.query),
     ]
+    if settings.REMOTE_STORE_USE_WIRE_FORMAT:
+      query_params.append(('wireFormat', str(wireformat.VERSION)))
     query_string = urlencode(query_params)
 
+    if settings.REMOTE_STORE_USE_POST:
+      return ('POST', '/metrics/find/', query_string, headers)
+    else:
+      return ('GET', '/metrics/find/?' + query_string, None, headers)
+
+
+  def send(self, headers=None):
+    self.cachedResults = tieredcache.get(self.cacheKey)
+
+    if self.cachedResults is not None:
+      instrumentation.increment('remote_finds_total', host=self.store.host, result='cached')
+      return
+    instrumentation.increment('remote_finds_total', host=self.store.host, result='sent')
+
+    (method, url, body, headers) = self.request(headers)
+
     try:
-      if settings.REMOTE_STORE_USE_POST:
-        self.connection.request('POST', '/metrics/find/', query_string, headers)
-      else:
-        self.connection.request('GET', '/metrics/find/?' + query_string, None, headers)
+      self.connection = getConnectionPool(self.store.host).request(method, url, body, headers, settings.REMOTE_STORE_FIND_TIMEOUT)
     except:
       self.store.fail()
       raise
 
 
   def get_results(self):
-    if self.cachedResults:
+    if self.cachedResults is not None:
       return self.cachedResults
 
     if not self.connection:
       self.send()
 
     try:
-      try: # Python 2.7+, use buffering of HTTP responses
-        response = self.connection.getresponse(buffering=True)
-      except TypeError:  # Python 2.6 and older
-        response = self.connection.getresponse()
-    except AttributeError:
+      (response, result_data) = getConnectionPool(self.store.host).getresponse(self.connection)
+    except (AttributeError, httplib.HTTPException, socket.error):
       self.store.fail()
       if not self.suppressErrors:
         raise
 
     try:
-      assert response.status == 200, "received error response %s - %s" % (response.status, response.reason)
-      result_data = response.read()
-      results = unpickle.loads(result_data)
+      results = self.parse_response(response, result_data)
     except:
       self.store.fail()
       if not self.suppressErrors:
@@ -96,8 +108,17 @@ class FindRequest:
       else:
         results = []
 
+    return self.set_results(results)
+
+
+  def parse_response(self, response, result_data):
+    assert response.status == 200, "received error response %s - %s" % (response.status, response.reason)
+    return loadResponse(response, result_data)
+
+
+  def set_results(self, results):
     resultNodes = [ RemoteNode(self.store, node['metric_path'], node['isLeaf']) for node in results ]
-    cache.set(self.cacheKey, resultNodes, settings.REMOTE_FIND_CACHE_DURATION)
+    tieredcache.set(self.cacheKey, resultNodes, settings.REMOTE_FIND_CACHE_DURATION)
     self.cachedResults = resultNodes
     return resultNodes
 
@@ -120,9 +141,11 @@ class RemoteNode:
       self.name = metric_path.split('.')[-1]
 
 
-  def fetch(self, startTime, endTime, now=None, result_queue=None, headers=None):
-    if not self.__isLeaf:
-      return []
+  def request(self, startTime, endTime, now=None, headers=None, maxDataPoints=None):
+    """Returns the method, url, body and headers of the fetch request.
+
+    With maxDataPoints, the remote webapp may read coarser archives that still
+    have that many points in the time range."""
     if self.__isBulk:
       targets = [ ('target', v) for v in self.metric_path ]
     else:
@@ -137,28 +160,38 @@ class RemoteNode:
     query_params.extend(targets)
     if now is not None:
       query_params.append(('now', str( int(now) )))
+    if maxDataPoints:
+      query_params.append(('maxDataPoints', str( int(maxDataPoints) )))
+    if settings.REMOTE_STORE_USE_WIRE_FORMAT:
+      query_params.append(('wireFormat', str(wireformat.VERSION)))
     query_string = urlencode(query_params)
 
-    connection = HTTPConnectionWithTimeout(self.store.host)
-    connection.timeout = settings.REMOTE_STORE_FETCH_TIMEOUT
     if settings.REMOTE_STORE_USE_POST:
-      connection.request('POST', '/render/', query_string, headers)
+      return ('POST', '/render/', query_string, headers)
     else:
-      connection.request('GET', '/render/?' + query_string, None, headers)
-    try:  # Python 2.7+, use buffering of HTTP responses
-      response = connection.getresponse(buffering=True)
-    except TypeError:  # Python 2.6 and older
-      response = connection.getresponse()
-    assert response.status == 200, "Failed to retrieve remote data: %d %s" % (response.status, response.reason)
-    rawData = response.read()
+      return ('GET', '/render/?' + query_string, None, headers)
 
-    seriesList = unpickle.loads(rawData)
+
+  def fetch(self, startTime, endTime, now=None, result_queue=None, headers=None, maxDataPoints=None):
+    if not self.__isLeaf:
+      return []
+
+    (method, url, body, headers) = self.request(startTime, endTime, now, headers, maxDataPoints)
+    pool = getConnectionPool(self.store.host)
+    connection = pool.request(method, url, body, headers, settings.REMOTE_STORE_FETCH_TIMEOUT)
+    (response, rawData) = pool.getresponse(connection)
+    seriesList = self.parse_response(response, rawData)
 
     if result_queue:
       result_queue.put( (self.store.host, seriesList) )
     else:
       return seriesList
 
+
+  def parse_response(self, response, rawData):
+    assert response.status == 200, "Failed to retrieve remote data: %d %s" % (response.status, response.reason)
+    return loadResponse(response, rawData)
+
   def isLeaf(self):
     return self.__isLeaf
 
@@ -167,6 +200,14 @@ class RemoteNode:
 
 
 
+def loadResponse(response, data):
+  "Decodes a pickle response, or a wire format one from webapps that support it"
+  if response.getheader('content-type') == wireformat.CONTENT_TYPE:
+    return wireformat.loads(data)
+  return unpickle.loads(data)
+
+
+
 # This is a hack to put a timeout in the connect() of an HTTP request.
 # Python 2.6 supports this already, but many Graphite installations
 # are not on 2.6 yet.
@@ -196,6 +237,463 @@ class HTTPConnectionWithTimeout(httplib.HTTPConnection):
       raise socket.error, msg
 
 
+class HTTPConnectionPool:
+  """A size-bounded, thread-safe pool of keep-alive connections to one host.
+
+  Connections go back to the pool once their response has been read in full,
+  unless the server asked to close them. Idle connections the server closed in
+  the meantime are detected when they are taken out of the pool, and a request
+  a reused connection was closed under before any response arrived is retried
+  once on a fresh one."""
+  def __init__(self, host, max_size):
+    self.host = host
+    self.max_size = max_size
+    self.idle = []
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.stale = 0
+
+  def request(self, method, url, body, headers, timeout):
+    "Sends a request on a pooled connection and returns the connection"
+    connection = self.acquire(timeout)
+    try:
+      self._send(connection, method, url, body, headers, timeout)
+    except (httplib.HTTPException, socket.error):
+      connection.close()
+      if not connection.reused:
+        raise
+      self.countStale()
+      connection = self.connect(timeout)
+      self._send(connection, method, url, body, headers, timeout)
+    return connection
+
+  def getresponse(self, connection):
+    """Reads the response to the request sent on connection and hands the
+    connection back to the pool. Returns (response, data)"""
+    try:
+      response = self._begin(connection)
+    except (httplib.HTTPException, socket.error), e:
+      connection.close()
+      if not (connection.reused and isUnanswered(e)):
+        raise
+      self.countStale()
+      (method, url, body, headers, timeout) = connection.pending_request
+      connection = self.connect(timeout)
+      self._send(connection, method, url, body, headers, timeout)
+      response = self._begin(connection)
+
+    try:
+      data = response.read()
+    except:
+      connection.close()
+      raise
+    if response.will_close:
+      connection.close()
+    else:
+      self.release(connection)
+    return (response, data)
+
+  def acquire(self, timeout):
+    while True:
+      with self.lock:
+        if not self.idle:
+          self.misses += 1
+          break
+        connection = self.idle.pop()
+      if isStale(connection):
+        self.countStale()
+        connection.close()
+        continue
+      with self.lock:
+        self.hits += 1
+      connection.reused = True
+      return connection
+
+    return self.connect(timeout)
+
+  def countStale(self):
+    with self.lock:
+      self.stale += 1
+
+  def connect(self, timeout):
+    connection = HTTPConnectionWithTimeout(self.host)
+    connection.timeout = timeout
+    connection.reused = False
+    return connection
+
+  def release(self, connection):
+    with self.lock:
+      if len(self.idle) < self.max_size:
+        self.idle.append(connection)
+        return
+    connection.close()
+
+  def _send(self, connection, method, url, body, headers, timeout):
+    connection.timeout = timeout
+    connection.pending_request = (method, url, body, headers, timeout)
+    if connection.sock is None:
+      connection.connect()
+    connection.sock.settimeout( float(timeout) )
+    connection.request(method, url, body, headers or {})
+
+  def _begin(self, connection):
+    try: # Python 2.7+, use buffering of HTTP responses
+      return connection.getresponse(buffering=True)
+    except TypeError: # Python 2.6 and older
+      return connection.getresponse()
+
+
+def isUnanswered(e):
+  """Tells whether e means the server closed a reused connection before
+  answering, so the request can be sent again. A timeout is never retried, as
+  the server may still be working on the request."""
+  if isinstance(e, httplib.BadStatusLine):
+    return True
+  if isinstance(e, socket.timeout) or not isinstance(e, socket.error):
+    return False
+  return bool(e.args) and e.args[0] in (errno.ECONNRESET, errno.EPIPE)
+
+
+def isStale(connection):
+  "An idle keep-alive connection only becomes readable when the server closed it"
+  if connection.sock is None:
+    return True
+  try:
+    return bool( select.select([connection.sock], [], [], 0)[0] )
+  except (select.error, socket.error, ValueError):
+    return True
+
+
+connectionPools = {}
+connectionPoolsLock = threading.Lock()
+
+def getConnectionPool(host):
+  with connectionPoolsLock:
+    try:
+      return connectionPools[host]
+    except KeyError:
+      pool = connectionPools[host] = HTTPConnectionPool(host, settings.REMOTE_STORE_POOL_SIZE)
+      return pool
+
+
+def connectionPoolStats():
+  "Returns the hit, miss and stale connection counters of every pool, by host"
+  return dict( (host, dict(hits=pool.hits, misses=pool.misses, stale=pool.stale, idle=len(pool.idle)))
+               for (host, pool) in connectionPools.items() )
+
+
+def collectMetrics():
+  for (host, stats) in connectionPoolStats().items():
+    yield ('counter', 'remote_connections_total', dict(host=host, result='reused'), stats['hits'])
+    yield ('counter', 'remote_connections_total', dict(host=host, result='opened'), stats['misses'])
+    yield ('counter', 'remote_connections_total', dict(host=host, result='stale'), stats['stale'])
+    yield ('gauge', 'remote_connections_idle', dict(host=host), stats['idle'])
+
+instrumentation.addCollector(collectMetrics)
+
+
+class RequestLoop:
+  """Multiplexes HTTP requests to remote webapps over non-blocking sockets.
+
+  Every request runs in the calling thread and all of them share a single
+  deadline, instead of taking a thread each. Connections are taken from and
+  handed back to the same keep-alive pools the threaded requests use."""
+  def __init__(self):
+    self.requests = []
+
+  def add(self, host, request, callback, errback):
+    """Queues request, a (method, url, body, headers) tuple. Calls
+    callback(response, data) once it completed, errback(exception) otherwise"""
+    (method, url, body, headers) = request
+    self.requests.append( PendingRequest(getConnectionPool(host), method, url, body, headers, callback, errback) )
+
+  def run(self, timeout):
+    deadline = time.time() + timeout
+    pending = []
+    for request in self.requests:
+      if request.start():
+        pending.append(request)
+
+    while pending:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      for request in waitForRequests(pending, remaining):
+        if not request.step():
+          pending.remove(request)
+
+    for request in pending:
+      request.fail( socket.timeout("no response from %s within %ss" % (request.pool.host, timeout)) )
+
+
+class PendingRequest:
+  "A request driven by a RequestLoop, from connecting to reading the whole response"
+  def __init__(self, pool, method, url, body, headers, callback, errback):
+    self.pool = pool
+    self.method = method
+    self.data = renderRequest(pool.host, method, url, body, headers)
+    self.callback = callback
+    self.errback = errback
+    self.connection = None
+
+  def start(self, connection=None):
+    "Starts sending the request, returns False if it already finished"
+    self.connection = connection or self.pool.acquire(None)
+    self.connecting = self.connection.sock is None
+    self.writing = True
+    self.sent = 0
+    self.received = []
+    self.receivedLength = 0
+    self.bodyStart = None
+    self.expectedLength = None
+
+    try:
+      if self.connecting:
+        connectNonBlocking(self.connection)
+      else:
+        self.connection.sock.setblocking(0)
+    except socket.error, e:
+      return self.retryOrFail(e)
+    return True
+
+  def fileno(self):
+    return self.connection.sock.fileno()
+
+  def step(self):
+    "Makes progress once the socket is ready, returns False once the request finished"
+    try:
+      if self.writing:
+        return self.send()
+      else:
+        return self.receive()
+    except (httplib.HTTPException, socket.error), e:
+      return self.retryOrFail(e)
+    except Exception, e:
+      self.connection.close()
+      self.fail(e)
+      return False
+
+  def send(self):
+    if self.connecting:
+      error = self.connection.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error:
+        raise socket.error(error, os.strerror(error))
+      self.connecting = False
+
+    self.sent += self.connection.sock.send(self.data[self.sent:])
+    self.writing = self.sent < len(self.data)
+    return True
+
+  def receive(self):
+    chunk = self.connection.sock.recv(65536)
+    if not chunk:
+      if not self.received:
+        raise httplib.BadStatusLine('')
+      return self.finish(closed=True)
+
+    self.received.append(chunk)
+    self.receivedLength += len(chunk)
+    if self.isComplete():
+      return self.finish(closed=False)
+    return True
+
+  def isComplete(self):
+    if self.bodyStart is None:
+      data = ''.join(self.received)
+      self.received = [data]
+      end = data.find('\r\n\r\n')
+      if end < 0:
+        return False
+      self.bodyStart = end + 4
+      self.expectedLength = responseLength(data[:end], self.method)
+
+    if self.expectedLength is None:
+      return False # delimited by the server closing the connection
+    if self.expectedLength == 'chunked':
+      data = ''.join(self.received)
+      self.received = [data]
+      return isLastChunkIn(data, self.bodyStart)
+    return self.receivedLength - self.bodyStart >= self.expectedLength
+
+  def finish(self, closed):
+    response = httplib.HTTPResponse(ResponseBuffer(''.join(self.received)), method=self.method)
+    response.begin()
+    data = response.read()
+
+    if closed or response.will_close:
+      self.connection.close()
+    else:
+      self.connection.sock.setblocking(1)
+      self.pool.release(self.connection)
+    self.connection = None
+
+    try:
+      self.callback(response, data)
+    except Exception, e:
+      self.fail(e)
+    return False
+
+  def retryOrFail(self, e):
+    self.connection.close()
+    if self.connection.reused and not self.received:
+      self.pool.countStale()
+      return self.start( self.pool.connect(None) )
+    self.fail(e)
+    return False
+
+  def fail(self, e):
+    if self.connection is not None:
+      self.connection.close()
+    self.errback(e)
+
+
+class ResponseBuffer:
+  "Lets httplib parse a response that was already read"
+  def __init__(self, data):
+    self.data = data
+
+  def makefile(self, *args, **kwargs):
+    return StringIO(self.data)
+
+
+class RequestRenderer(httplib.HTTPConnection):
+  "Renders requests exactly as httplib sends them, without sending them"
+  def send(self, data):
+    self.rendered.append(data)
+
+
+def renderRequest(host, method, url, body, headers):
+  renderer = RequestRenderer(host)
+  renderer.rendered = []
+  renderer.request(method, url, body, headers or {})
+  return ''.join(renderer.rendered)
+
+
+def connectNonBlocking(connection):
+  (family, socktype, proto, canonname, address) = socket.getaddrinfo(connection.host, connection.port, 0, socket.SOCK_STREAM)[0]
+  sock = socket.socket(family, socktype, proto)
+  sock.setblocking(0)
+  error = sock.connect_ex(address)
+  if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+    sock.close()
+    raise socket.error(error, os.strerror(error))
+  connection.sock = sock
+
+
+def responseLength(head, method):
+  """Returns the body length announced by the response headers, 'chunked', or
+  None if the body ends when the connection closes"""
+  lines = head.split('\r\n')
+  status = int(lines[0].split(None, 2)[1])
+  if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+    return 0
+
+  headers = dict( (name.strip().lower(), value.strip()) for (name, _, value) in
+                  (line.partition(':') for line in lines[1:]) )
+  if 'chunked' in headers.get('transfer-encoding', '').lower():
+    return 'chunked'
+  if 'content-length' in headers:
+    return int(headers['content-length'])
+  return None
+
+
+def isLastChunkIn(data, position):
+  "Tells whether the chunked body starting at position is complete"
+  while True:
+    eol = data.find('\r\n', position)
+    if eol < 0:
+      return False
+    size = int(data[position:eol].split(';', 1)[0], 16)
+    if size == 0:
+      return data.find('\r\n\r\n', eol) >= 0 # trailers end with an empty line
+    position = eol + 2 + size + 2
+    if position > len(data):
+      return False
+
+
+def waitForRequests(requests, timeout):
+  "Returns the requests whose sockets are ready to make progress"
+  if hasattr(select, 'poll'):
+    poller = select.poll()
+    byFileno = {}
+    for request in requests:
+      byFileno[request.fileno()] = request
+      poller.register(request.fileno(), select.POLLOUT if request.writing else select.POLLIN)
+    try:
+      return [ byFileno[fd] for (fd, event) in poller.poll(timeout * 1000) ]
+    except select.error, e:
+      if e.args[0] == errno.EINTR:
+        return []
+      raise
+
+  readers = [ r for r in requests if not r.writing ]
+  writers = [ r for r in requests if r.writing ]
+  try:
+    (readable, writable, _) = select.select(readers, writers, [], timeout)
+  except select.error, e:
+    if e.args[0] == errno.EINTR:
+      return []
+    raise
+  return readable + writable
+
+
+def parallelFind(stores, query, headers=None):
+  "Runs a find on every store on a single RequestLoop, returns the completed FindRequests"
+  loop = RequestLoop()
+  requests = []
+
+  def completer(request):
+    def callback(response, data):
+      try:
+        request.set_results( request.parse_response(response, data) )
+        requests.append(request)
+      except:
+        request.store.fail()
+        log.exception("Failed to find %s on %s" % (query, request.store.host))
+
+    def errback(e):
+      request.store.fail()
+      log.info("Failed to find %s on %s: %s" % (query, request.store.host, e))
+
+    return (callback, errback)
+
+  for store in stores:
+    request = FindRequest(store, query)
+    request.cachedResults = tieredcache.get(request.cacheKey)
+    if request.cachedResults is not None:
+      instrumentation.increment('remote_finds_total', host=store.host, result='cached')
+      requests.append(request)
+      continue
+    instrumentation.increment('remote_finds_total', host=store.host, result='sent')
+    (callback, errback) = completer(request)
+    loop.add(store.host, request.request(headers), callback, errback)
+
+  loop.run(settings.REMOTE_STORE_FIND_TIMEOUT)
+  return requests
+
+
+def parallelFetch(fetches, headers=None, maxDataPoints=None):
+  """Runs fetches, a list of (node, startTime, endTime, now, result_queue), on
+  a single RequestLoop. Each one puts (host, seriesList) into its result_queue"""
+  loop = RequestLoop()
+
+  def completer(node, result_queue):
+    def callback(response, data):
+      result_queue.put( (node.store.host, node.parse_response(response, data)) )
+
+    def errback(e):
+      log.info("Failed to fetch %s from %s: %s" % (node.metric_path, node.store.host, e))
+
+    return (callback, errback)
+
+  for (node, startTime, endTime, now, result_queue) in fetches:
+    (callback, errback) = completer(node, result_queue)
+    loop.add(node.store.host, node.request(startTime, endTime, now, headers, maxDataPoints), callback, errback)
+
+  loop.run(settings.REMOTE_STORE_FETCH_TIMEOUT)
+
+
 def extractForwardHeaders(request):
     headers = {}
     for name in settings.REMOTE_STORE_FORWARD_HEADERS:
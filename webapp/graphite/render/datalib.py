@@ -12,16 +12,23 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
+import os
+import errno
 import socket
 import struct
 import time
 import threading
 import Queue
+from array import array
+from multiprocessing.pool import ThreadPool
 from django.conf import settings
 from graphite.logger import log
-from graphite.storage import STORE, LOCAL_STORE
-from graphite.remote_storage import RemoteNode
-from graphite.render.hashing import ConsistentHashRing
+from graphite import instrumentation
+from graphite.storage import STORE, LOCAL_STORE, WhisperFile, whisper_fetch_window, whisper_archive_fetch
+from graphite.remote_storage import RemoteNode, parallelFetch, waitForRequests
+from graphite.render.hashing import ConsistentHashRing, compactHash
+from graphite.render import tieredcache
+from graphite.render.profiling import stage, count
 from graphite.util import unpickle, epoch
 
 try:
@@ -29,6 +36,11 @@ try:
 except ImportError:
   import pickle
 
+try:
+  import numpy
+except ImportError:
+  numpy = False
+
 
 class TimeSeries(list):
   def __init__(self, name, start, end, step, values, consolidate='average'):
@@ -40,48 +52,92 @@ class TimeSeries(list):
     self.consolidationFunc = consolidate
     self.valuesPerPoint = 1
     self.options = {}
+    self.consolidated = None
 
 
   def __iter__(self):
     if self.valuesPerPoint > 1:
-      return self.__consolidatingGenerator( list.__iter__(self) )
+      return iter( self.consolidatedValues() )
     else:
       return list.__iter__(self)
 
 
+  def consolidatedValues(self):
+    "The values consolidated by valuesPerPoint, computed once until the series changes or is consolidated again"
+    key = (self.valuesPerPoint, self.consolidationFunc, len(self))
+    cached = getattr(self, 'consolidated', None)
+    if cached and cached[0] == key:
+      return cached[1]
+
+    with stage('consolidation'):
+      values = consolidateValues(self[:], self.valuesPerPoint, self.consolidationFunc)
+    self.consolidated = (key, values)
+    return values
+
+
   def consolidate(self, valuesPerPoint):
     self.valuesPerPoint = int(valuesPerPoint)
+    self.consolidated = None
 
 
-  def __consolidatingGenerator(self, gen):
-    buf = []
-    for x in gen:
-      buf.append(x)
-      if len(buf) == self.valuesPerPoint:
-        while None in buf: buf.remove(None)
-        if buf:
-          yield self.__consolidate(buf)
-          buf = []
-        else:
-          yield None
-    while None in buf: buf.remove(None)
-    if buf: yield self.__consolidate(buf)
-    else: yield None
-    raise StopIteration
-
-
-  def __consolidate(self, values):
-    usable = [v for v in values if v is not None]
-    if not usable: return None
-    if self.consolidationFunc == 'sum':
-      return sum(usable)
-    if self.consolidationFunc == 'average':
-      return float(sum(usable)) / len(usable)
-    if self.consolidationFunc == 'max':
-      return max(usable)
-    if self.consolidationFunc == 'min':
-      return min(usable)
-    raise Exception, "Invalid consolidation function!"
+  # Changing the values in place drops their consolidation. Item assignment is
+  # left to list: scale() and friends assign every value, and overriding either
+  # __setitem__ or __delitem__ slows down both, so the values written one at a
+  # time are consolidated again by the next consolidate() call and deleted ones
+  # by the length of the series being part of the cache key
+  def __setslice__(self, i, j, values):
+    self.consolidated = None
+    list.__setslice__(self, i, j, values)
+
+
+  def __delslice__(self, i, j):
+    self.consolidated = None
+    list.__delslice__(self, i, j)
+
+
+  def __iadd__(self, other):
+    self.consolidated = None
+    return list.__iadd__(self, other)
+
+
+  def __imul__(self, n):
+    self.consolidated = None
+    return list.__imul__(self, n)
+
+
+  def append(self, value):
+    self.consolidated = None
+    list.append(self, value)
+
+
+  def extend(self, values):
+    self.consolidated = None
+    list.extend(self, values)
+
+
+  def insert(self, index, value):
+    self.consolidated = None
+    list.insert(self, index, value)
+
+
+  def pop(self, index=-1):
+    self.consolidated = None
+    return list.pop(self, index)
+
+
+  def remove(self, value):
+    self.consolidated = None
+    list.remove(self, value)
+
+
+  def reverse(self):
+    self.consolidated = None
+    list.reverse(self)
+
+
+  def sort(self, *args, **kwargs):
+    self.consolidated = None
+    list.sort(self, *args, **kwargs)
 
 
   def __repr__(self):
@@ -100,6 +156,317 @@ class TimeSeries(list):
     }
 
 
+class CompactTimeSeries(object):
+  """A TimeSeries that keeps its values in a float64 array and a byte per value
+  flagging the Nones, instead of a list of float objects. Takes about 9 bytes
+  per value instead of 32.
+
+  Behaves like TimeSeries: it iterates over consolidated values, indexes and
+  slices raw values (slices are lists) and supports the list methods. Numbers
+  are stored as floats."""
+
+  def __init__(self, name, start, end, step, values, consolidate='average'):
+    self.name = name
+    self.start = start
+    self.end = end
+    self.step = step
+    (self.values, self.nulls) = packValues(values)
+    self.consolidationFunc = consolidate
+    self.valuesPerPoint = 1
+    self.options = {}
+    self.consolidated = None
+
+
+  def __iter__(self):
+    if self.valuesPerPoint > 1:
+      return iter( self.consolidatedValues() )
+    else:
+      return iter(self.tolist())
+
+
+  def consolidatedValues(self):
+    "The values consolidated by valuesPerPoint, computed once until the series changes or is consolidated again"
+    key = (self.valuesPerPoint, self.consolidationFunc)
+    if self.consolidated and self.consolidated[0] == key:
+      return self.consolidated[1]
+
+    with stage('consolidation'):
+      if numpy:
+        values = consolidateArray(self.values, self.nulls, self.valuesPerPoint, self.consolidationFunc)
+      else:
+        values = consolidateValues(self.tolist(), self.valuesPerPoint, self.consolidationFunc)
+    self.consolidated = (key, values)
+    return values
+
+
+  def consolidate(self, valuesPerPoint):
+    self.valuesPerPoint = int(valuesPerPoint)
+
+
+  def tolist(self):
+    "The raw values as a list of floats and Nones"
+    return unpackValues(self.values, self.nulls)
+
+
+  def __len__(self):
+    return len(self.values)
+
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [ None if null else value for (value, null) in zip(self.values[index], self.nulls[index]) ]
+    if self.nulls[index]:
+      return None
+    return self.values[index]
+
+
+  def __setitem__(self, index, value):
+    self.consolidated = None
+    if isinstance(index, slice):
+      (self.values[index], self.nulls[index]) = packValues(value)
+    elif value is None:
+      self.nulls[index] = 1
+      self.values[index] = 0.0
+    else:
+      self.values[index] = value
+      self.nulls[index] = 0
+
+
+  def __delitem__(self, index):
+    self.consolidated = None
+    del self.values[index]
+    del self.nulls[index]
+
+
+  def __getslice__(self, i, j):
+    return self.__getitem__(slice(max(0, i), max(0, j)))
+
+
+  def __setslice__(self, i, j, values):
+    self.__setitem__(slice(max(0, i), max(0, j)), values)
+
+
+  def __delslice__(self, i, j):
+    self.__delitem__(slice(max(0, i), max(0, j)))
+
+
+  def __contains__(self, value):
+    if value is None:
+      return 1 in self.nulls
+    return value in self.tolist()
+
+
+  def __eq__(self, other):
+    try:
+      return len(self) == len(other) and self.tolist() == list(other)
+    except TypeError:
+      return NotImplemented
+
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    if equal is NotImplemented:
+      return equal
+    return not equal
+
+
+  __hash__ = None
+
+
+  def __add__(self, other):
+    return self.tolist() + list(other)
+
+
+  def __radd__(self, other):
+    return list(other) + self.tolist()
+
+
+  def __iadd__(self, other):
+    self.extend(other)
+    return self
+
+
+  def append(self, value):
+    self.consolidated = None
+    self.values.append(0.0 if value is None else value)
+    self.nulls.append(value is None)
+
+
+  def extend(self, values):
+    self.consolidated = None
+    (values, nulls) = packValues(values)
+    self.values.extend(values)
+    self.nulls.extend(nulls)
+
+
+  def insert(self, index, value):
+    self.consolidated = None
+    self.values.insert(index, 0.0 if value is None else value)
+    self.nulls.insert(index, value is None)
+
+
+  def pop(self, index=-1):
+    value = self[index]
+    del self[index]
+    return value
+
+
+  def remove(self, value):
+    del self[self.index(value)]
+
+
+  def index(self, value, *args):
+    return self.tolist().index(value, *args)
+
+
+  def count(self, value):
+    if value is None:
+      return self.nulls.count('\x01')
+    return self.tolist().count(value)
+
+
+  def reverse(self):
+    self.consolidated = None
+    self.values.reverse()
+    self.nulls.reverse()
+
+
+  def sort(self, *args, **kwargs):
+    self.consolidated = None
+    values = self.tolist()
+    values.sort(*args, **kwargs)
+    (self.values, self.nulls) = packValues(values)
+
+
+  def __repr__(self):
+    return 'TimeSeries(name=%s, start=%s, end=%s, step=%s)' % (self.name, self.start, self.end, self.step)
+
+
+  def getInfo(self):
+    """Pickle-friendly representation of the series"""
+    return {
+      'name' : self.name,
+      'start' : self.start,
+      'end' : self.end,
+      'step' : self.step,
+      'values' : list(self),
+      'pathExpression' : self.pathExpression
+    }
+
+
+def packValues(values):
+  "Returns a float64 array of values, 0.0 in place of None, and a bytearray flagging the Nones"
+  if not isinstance(values, list):
+    values = list(values)
+  nulls = bytearray(len(values))
+  try: # series without gaps
+    return (array('d', values), nulls)
+  except TypeError:
+    pass
+
+  values = list(values)
+  i = -1
+  try:
+    while True:
+      i = values.index(None, i + 1)
+      values[i] = 0.0
+      nulls[i] = 1
+  except ValueError:
+    pass
+  return (array('d', values), nulls)
+
+
+def unpackValues(values, nulls):
+  "Returns the list of floats and Nones packValues() packed into values and nulls"
+  values = values.tolist()
+  i = nulls.find('\x01')
+  while i != -1:
+    values[i] = None
+    i = nulls.find('\x01', i + 1)
+  return values
+
+
+def isTimeSeries(series):
+  return isinstance(series, (TimeSeries, CompactTimeSeries))
+
+
+def newTimeSeries(name, start, end, step, values):
+  "Creates a series of fetched data, in the class TIMESERIES_BACKEND selects"
+  if settings.TIMESERIES_BACKEND == 'array':
+    return CompactTimeSeries(name, start, end, step, values)
+  return TimeSeries(name, start, end, step, values)
+
+
+CONSOLIDATION_FUNCTIONS = {
+  'sum' : sum,
+  'average' : lambda usable: float(sum(usable)) / len(usable),
+  'max' : max,
+  'min' : min,
+  'first' : lambda usable: usable[0],
+  'last' : lambda usable: usable[-1],
+}
+
+def consolidateValues(values, valuesPerPoint, consolidationFunc):
+  """Consolidates every valuesPerPoint values into one, ignoring Nones. Values
+  that are all None consolidate to None. A None is appended when the values
+  divide into whole buckets, as series have always ended with one then."""
+  if consolidationFunc not in CONSOLIDATION_FUNCTIONS:
+    raise Exception, "Invalid consolidation function!"
+  func = CONSOLIDATION_FUNCTIONS[consolidationFunc]
+
+  consolidated = []
+  for i in xrange(0, len(values), valuesPerPoint):
+    usable = [v for v in values[i:i + valuesPerPoint] if v is not None]
+    consolidated.append( func(usable) if usable else None )
+
+  if len(values) % valuesPerPoint == 0:
+    consolidated.append(None)
+  return consolidated
+
+def consolidateArray(values, nulls, valuesPerPoint, consolidationFunc):
+  """consolidateValues() for the float64 array and null flags of a
+  CompactTimeSeries, computed for all buckets at once with numpy"""
+  if consolidationFunc not in CONSOLIDATION_FUNCTIONS:
+    raise Exception, "Invalid consolidation function!"
+  if not values:
+    return [None]
+
+  count = len(values)
+  buckets = (count + valuesPerPoint - 1) // valuesPerPoint
+  points = numpy.zeros(buckets * valuesPerPoint)
+  points[:count] = numpy.frombuffer(values, dtype=numpy.float64)
+  missing = numpy.ones(buckets * valuesPerPoint, dtype=bool)
+  missing[:count] = numpy.frombuffer(nulls, dtype=numpy.uint8)
+  points = points.reshape(buckets, valuesPerPoint)
+  missing = missing.reshape(buckets, valuesPerPoint)
+  present = numpy.logical_not(missing)
+  usable = present.sum(axis=1)
+
+  if consolidationFunc in ('sum', 'average'):
+    # cumsum adds left to right like sum(), so the results are the same to the bit
+    result = numpy.where(missing, 0.0, points).cumsum(axis=1)[:, -1]
+    if consolidationFunc == 'average':
+      result = result / numpy.maximum(usable, 1)
+  elif consolidationFunc == 'max':
+    result = numpy.where(missing, -numpy.inf, points).max(axis=1)
+  elif consolidationFunc == 'min':
+    result = numpy.where(missing, numpy.inf, points).min(axis=1)
+  else:
+    if consolidationFunc == 'first':
+      column = present.argmax(axis=1)
+    else:
+      column = valuesPerPoint - 1 - present[:, ::-1].argmax(axis=1)
+    result = points[numpy.arange(buckets), column]
+
+  consolidated = result.tolist()
+  for bucket in numpy.flatnonzero(usable == 0):
+    consolidated[bucket] = None
+
+  if count % valuesPerPoint == 0:
+    consolidated.append(None)
+  return consolidated
+
+
 
 class CarbonLinkPool:
   def __init__(self, hosts, timeout):
@@ -117,28 +484,54 @@ class CarbonLinkPool:
     "Returns the carbon host that has data for the given metric"
     return self.hash_ring.get_node(metric)
 
-  def get_connection(self, host):
+  def get_connection(self, host, blocking=True):
     # First try to take one out of the pool for this host
     (server, instance) = host
     port = self.ports[host]
     connectionPool = self.connections[host]
     try:
-      return connectionPool.pop()
+      connection = connectionPool.pop()
     except KeyError:
       pass #nothing left in the pool, gotta make a new connection
+    else:
+      if not blocking:
+        connection.setblocking(0)
+      return connection
 
     log.cache("CarbonLink creating a new socket for %s" % str(host))
     connection = socket.socket()
-    connection.settimeout(self.timeout)
     try:
-      connection.connect( (server, port) )
+      if blocking:
+        connection.settimeout(self.timeout)
+        connection.connect( (server, port) )
+      else:
+        connection.setblocking(0)
+        error = connection.connect_ex( (server, port) )
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+          raise socket.error(error, os.strerror(error))
     except:
+      connection.close()
       self.last_failure[host] = time.time()
+      instrumentation.increment('carbonlink_failures_total')
       raise
     else:
       connection.setsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 )
       return connection
 
+  def release_connection(self, host, connection):
+    connection.settimeout(self.timeout)
+    self.connections[host].add(connection)
+
+  def metrics_by_host(self, metrics):
+    metricsByHost = {}
+    for real_metric in metrics:
+      host = self.select_host(real_metric)
+      if metricsByHost.get(host):
+         metricsByHost[host].append(real_metric)
+      else:
+         metricsByHost[host] = [real_metric]
+    return metricsByHost
+
   def query(self, metric):
     if not self.hosts:
       return []
@@ -147,44 +540,94 @@ class CarbonLinkPool:
     log.cache("CarbonLink cache-query request for %s returned %d datapoints" % (metric, len(results['datapoints'])))
     return results['datapoints']
 
-  def query_bulk(self, metrics):
+  def query_many(self, metrics):
+    "Sends a cache-query request per metric, pipelined on one connection per host"
     cacheResultsByMetric = {}
-    metricsByHost = {}
     if not self.hosts:
       return cacheResultsByMetric
 
-    for real_metric in metrics:
-      host = self.select_host(real_metric)
-      if metricsByHost.get(host):
-         metricsByHost[host].append(real_metric)
+    requestsByHost = {}
+    for host, hostMetrics in self.metrics_by_host(metrics).items():
+      requestsByHost[host] = [ dict(type='cache-query', metric=metric) for metric in hostMetrics ]
+
+    datapointsCounter = 0
+    for (host, request, result) in self.send_requests(requestsByHost):
+      if 'error' in result:
+        log.cache("CarbonLink cache-query error for %s: %s" % (request['metric'], result['error']))
       else:
-         metricsByHost[host] = [real_metric]
+        cacheResultsByMetric[request['metric']] = result['datapoints']
+        datapointsCounter += len(result['datapoints'])
+
+    log.cache("CarbonLink cache-query requests for %d metrics returned %d datapoints" % (len(metrics), datapointsCounter))
+    return cacheResultsByMetric
+
+  def query_bulk(self, metrics):
+    cacheResultsByMetric = {}
+    if not self.hosts:
+      return cacheResultsByMetric
+
+    # Large requests are split up so carbon can answer the first chunks while
+    # it reads the next ones
+    chunkSize = max(1, settings.CARBONLINK_QUERY_BULK_CHUNK_SIZE)
+    requestsByHost = {}
+    for host, hostMetrics in self.metrics_by_host(metrics).items():
+      requestsByHost[host] = [ dict(type='cache-query-bulk', metrics=hostMetrics[i:i + chunkSize])
+                               for i in range(0, len(hostMetrics), chunkSize) ]
 
     datapointsCounter = 0
-    for host, metrics in metricsByHost.items():
-       request = dict(type='cache-query-bulk', metrics=metrics)
-       serialized_request = pickle.dumps(request, protocol=-1)
-       len_prefix = struct.pack("!L", len(serialized_request))
-       request_packet = len_prefix + serialized_request
-
-       conn = self.get_connection(host)
-       try:
-         conn.sendall(request_packet)
-         result = self.recv_response(conn)
-       except:
-         self.last_failure[host] = time.time()
-         log.exception()
-       else:
-         self.connections[host].add(conn)
-         if 'error' in result:
-           log.cache("CarbonLink cache-query-bulk error %s" % result['error'])
-         else:
-           cacheResultsByMetric.update(result['datapointsByMetric'])
-           datapointsCounter += len(result['datapointsByMetric'])
+    for (host, request, result) in self.send_requests(requestsByHost):
+      if 'error' in result:
+        log.cache("CarbonLink cache-query-bulk error %s" % result['error'])
+      else:
+        cacheResultsByMetric.update(result['datapointsByMetric'])
+        datapointsCounter += len(result['datapointsByMetric'])
 
     log.cache("CarbonLink cache-query-bulk request returned %d datapoints" % datapointsCounter)
     return cacheResultsByMetric
 
+  def send_requests(self, requestsByHost):
+    """Sends every host its requests back to back on one connection, and reads
+    the responses from all hosts concurrently until CARBONLINK_TIMEOUT runs out.
+    Returns (host, request, result) for every response received in time"""
+    started = time.time()
+    deadline = started + self.timeout
+    pipelines = []
+    for host, requests in requestsByHost.items():
+      try:
+        pipelines.append( CarbonLinkPipeline(self, host, requests) )
+      except:
+        log.exception("CarbonLink failed to connect to %s" % str(host))
+
+    pending = list(pipelines)
+    while pending:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+
+      for pipeline in waitForRequests(pending, remaining):
+        try:
+          pipeline.step()
+        except:
+          pending.remove(pipeline)
+          pipeline.fail()
+          log.exception("CarbonLink request to %s failed" % str(pipeline.host))
+          continue
+
+        if pipeline.isComplete():
+          pending.remove(pipeline)
+          self.release_connection(pipeline.host, pipeline.connection)
+
+    for pipeline in pending:
+      pipeline.fail()
+      log.cache("CarbonLink requests to %s timed out with %d of %d responses" %
+                (str(pipeline.host), len(pipeline.results), len(pipeline.requests)))
+
+    if pipelines:
+      instrumentation.observe('carbonlink_request_duration_seconds', time.time() - started)
+
+    return [ (pipeline.host, request, result) for pipeline in pipelines
+             for (request, result) in zip(pipeline.requests, pipeline.results) ]
+
   def get_metadata(self, metric, key):
     request = dict(type='get-metadata', metric=metric, key=key)
     results = self.send_request(request)
@@ -199,20 +642,21 @@ class CarbonLinkPool:
 
   def send_request(self, request):
     metric = request['metric']
-    serialized_request = pickle.dumps(request, protocol=-1)
-    len_prefix = struct.pack("!L", len(serialized_request))
-    request_packet = len_prefix + serialized_request
+    request_packet = serialize_request(request)
 
     host = self.select_host(metric)
     conn = self.get_connection(host)
+    t = time.time()
     try:
       conn.sendall(request_packet)
       result = self.recv_response(conn)
     except:
       self.last_failure[host] = time.time()
+      instrumentation.increment('carbonlink_failures_total')
       raise
     else:
-      self.connections[host].add(conn)
+      self.release_connection(host, conn)
+      instrumentation.observe('carbonlink_request_duration_seconds', time.time() - t)
       if 'error' in result:
         raise CarbonLinkRequestError(result['error'])
       else:
@@ -225,10 +669,78 @@ class CarbonLinkPool:
     return unpickle.loads(body)
 
 
+class CarbonLinkPipeline:
+  "Requests to one carbon-cache, written back to back and answered in order"
+
+  def __init__(self, pool, host, requests):
+    self.pool = pool
+    self.host = host
+    self.requests = requests
+    self.results = []
+    self.packets = ''.join(serialize_request(request) for request in requests)
+    self.sent = 0
+    self.writing = True
+    self.chunks = []
+    self.received = 0
+    self.needed = 4
+    self.connection = pool.get_connection(host, blocking=False)
+
+  def fileno(self):
+    return self.connection.fileno()
+
+  def step(self):
+    try:
+      if self.writing:
+        self.sent += self.connection.send( buffer(self.packets, self.sent) )
+        self.writing = self.sent < len(self.packets)
+      else:
+        data = self.connection.recv(65536)
+        if not data:
+          raise Exception("Connection lost")
+        self.receive(data)
+    except socket.error, e:
+      if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        raise
+
+  def receive(self, data):
+    self.chunks.append(data)
+    self.received += len(data)
+    if self.received < self.needed:
+      return
+
+    buf = ''.join(self.chunks)
+    offset = 0
+    while len(buf) - offset >= 4:
+      body_size = struct.unpack_from("!L", buf, offset)[0]
+      if len(buf) - offset - 4 < body_size:
+        self.needed = body_size + 4
+        break
+      self.results.append( unpickle.loads(buf[offset + 4:offset + 4 + body_size]) )
+      offset += 4 + body_size
+    else:
+      self.needed = 4
+
+    self.chunks = [ buf[offset:] ]
+    self.received = len(buf) - offset
+
+  def isComplete(self):
+    return len(self.results) == len(self.requests)
+
+  def fail(self):
+    self.pool.last_failure[self.host] = time.time()
+    instrumentation.increment('carbonlink_failures_total')
+    self.connection.close()
+
+
 # Utilities
 class CarbonLinkRequestError(Exception):
   pass
 
+def serialize_request(request):
+  serialized_request = pickle.dumps(request, protocol=-1)
+  len_prefix = struct.pack("!L", len(serialized_request))
+  return len_prefix + serialized_request
+
 def recv_exactly(conn, num_bytes):
   buf = ''
   while len(buf) < num_bytes:
@@ -271,12 +783,44 @@ def prefetchRemoteData(requestContext, pathExpressions):
   # if required, fetch data from all remote nodes
   # storing the result in a big hash of the form:
   # data[node][hash(originalPathExpression, start, end)] = [ matchingSeries, matchingSeries2, ... ]
+  fetchWindows = { (requestContext['startTime'], requestContext['endTime']) : pathExpressions }
+  return batchRemoteData(requestContext, fetchWindows)
+
+
+def batchRemoteData(requestContext, fetchWindows):
+  """Fetches all data a render needs from the remote nodes in advance.
+
+  fetchWindows maps (startTime, endTime) time ranges to the path expressions
+  fetched for them, see evaluator.extractFetchWindows(). Every remote node
+  gets one bulk request per time range, all of them sent at once. The results
+  are keyed like prefetchRemoteData() keys them."""
   prefetchedRemoteData = {}
   if requestContext['localOnly']:
     return prefetchedRemoteData
 
+  windows = []
+  remote_fetches = []
+  nodes_to_fetch = []
+  for ((startTime, endTime), pathExpressions) in sorted(fetchWindows.items()):
+    windowContext = requestContext.copy()
+    windowContext['startTime'] = startTime
+    windowContext['endTime'] = endTime
+    pathExpressions = sorted(pathExpressions)
+    result_queue = Queue.Queue()
+    (threads, fetches) = startRemoteFetches(windowContext, pathExpressions, result_queue, False)
+    remote_fetches.extend(threads)
+    nodes_to_fetch.extend(fetches)
+    windows.append( (windowContext, pathExpressions, result_queue) )
+
+  finishRemoteFetches(remote_fetches, nodes_to_fetch, requestContext.get('forwardHeaders'), requestContext.get('maxDataPoints'))
+
+  for (windowContext, pathExpressions, result_queue) in windows:
+    _storePrefetchedData(prefetchedRemoteData, windowContext, pathExpressions, result_queue)
+  return prefetchedRemoteData
+
+
+def _storePrefetchedData(prefetchedRemoteData, requestContext, pathExpressions, result_queue):
   (startTime, endTime, now) = _timebounds(requestContext)
-  result_queue = fetchRemoteData(requestContext, pathExpressions, False)
   while not result_queue.empty():
     try:
       (node, results) = result_queue.get_nowait()
@@ -285,9 +829,9 @@ def prefetchRemoteData(requestContext, pathExpressions):
 
     # prefill result with empty list
     # Needed to be able to detect if a query has already been made
-    prefetchedRemoteData[node] = {}
+    nodeData = prefetchedRemoteData.setdefault(node, {})
     for pe in pathExpressions:
-      prefetchedRemoteData[node][_prefetchMetricKey(pe, startTime, endTime)] = []
+      nodeData[_prefetchMetricKey(pe, startTime, endTime)] = []
 
     for series in results:
       # series.pathExpression is original target, ie. containing wildcards
@@ -298,14 +842,12 @@ def prefetchRemoteData(requestContext, pathExpressions):
         log.exception("Remote node %s doesn't support prefetching data... upgrade!" % node)
         raise
         
-      if prefetchedRemoteData[node].get(k) is None:
+      if nodeData.get(k) is None:
         # This should not be needed because of above filling with [],
         # but could happen if backend sends unexpected stuff
-        prefetchedRemoteData[node][k] = [series]
+        nodeData[k] = [series]
       else:
-        prefetchedRemoteData[node][k].append(series)
-
-  return prefetchedRemoteData
+        nodeData[k].append(series)
   
 
 def prefetchLookup(requestContext, node):
@@ -321,6 +863,14 @@ def prefetchLookup(requestContext, node):
   return r
 
 def fetchRemoteData(requestContext, pathExpr, usePrefetchCache=settings.REMOTE_PREFETCH_DATA):
+  result_queue = Queue.Queue()
+  (remote_fetches, nodes_to_fetch) = startRemoteFetches(requestContext, pathExpr, result_queue, usePrefetchCache)
+  finishRemoteFetches(remote_fetches, nodes_to_fetch, requestContext.get('forwardHeaders'), requestContext.get('maxDataPoints'))
+  return result_queue
+
+def startRemoteFetches(requestContext, pathExpr, result_queue, usePrefetchCache):
+  """Starts a fetch thread per remote node, returns the threads and the
+  fetches left for the event loop"""
   (startTime, endTime, now) = _timebounds(requestContext)
   remote_nodes = [ RemoteNode(store, pathExpr, True) for store in STORE.remote_stores ]
 
@@ -329,7 +879,7 @@ def fetchRemoteData(requestContext, pathExpr, usePrefetchCache=settings.REMOTE_P
   # Notable: return the 'seriesList' result from each node.fetch into result_queue
   # instead of directly from the method. Queue.Queue() is threadsafe.
   remote_fetches = []
-  result_queue = Queue.Queue()
+  nodes_to_fetch = []
   for node in remote_nodes:
       need_fetch = True
       if usePrefetchCache:
@@ -341,52 +891,347 @@ def fetchRemoteData(requestContext, pathExpr, usePrefetchCache=settings.REMOTE_P
         if series is not None:
           result_queue.put( (node, series) )
           need_fetch = False
-      if need_fetch:
+      if need_fetch and settings.REMOTE_STORE_FANOUT == 'eventloop':
+        nodes_to_fetch.append( (node, startTime, endTime, now, result_queue) )
+      elif need_fetch:
         fetch_thread = threading.Thread(target=node.fetch, name=node.store.host,
-                                        args=(startTime, endTime, now, result_queue, requestContext.get('forwardHeaders')))
+                                        args=(startTime, endTime, now, result_queue, requestContext.get('forwardHeaders'),
+                                              requestContext.get('maxDataPoints')))
         fetch_thread.start()
         remote_fetches.append(fetch_thread)
 
-  # Once the remote_fetches have started, wait for them all to finish. Assuming an
-  # upper bound of REMOTE_STORE_FETCH_TIMEOUT per thread, this should take about that
-  # amount of time (6s by default) at the longest. If every thread blocks permanently,
-  # then this could take a horrible REMOTE_STORE_FETCH_TIMEOUT * num(remote_fetches),
-  # but then that would imply that remote_storage's HTTPConnectionWithTimeout class isn't
-  # working correctly :-)
-  for fetch_thread in remote_fetches:
-    try:
-      fetch_thread.join(settings.REMOTE_STORE_FETCH_TIMEOUT)
-      if fetch_thread.is_alive():
-        log.exception("Failed to join remote_fetch thread %s within %ss" % (fetch_thread.name, settings.REMOTE_STORE_FETCH_TIMEOUT))
-    except:
-      log.exception("Exception during remote_fetch thread %s" % (fetch_thread.name))
+  return (remote_fetches, nodes_to_fetch)
+
+def finishRemoteFetches(remote_fetches, nodes_to_fetch, headers=None, maxDataPoints=None):
+  with stage('fetch.remote'):
+    # All requests of the event loop share a single REMOTE_STORE_FETCH_TIMEOUT
+    if nodes_to_fetch:
+      parallelFetch(nodes_to_fetch, headers, maxDataPoints)
+
+    # Once the remote_fetches have started, wait for them all to finish. Assuming an
+    # upper bound of REMOTE_STORE_FETCH_TIMEOUT per thread, this should take about that
+    # amount of time (6s by default) at the longest. If every thread blocks permanently,
+    # then this could take a horrible REMOTE_STORE_FETCH_TIMEOUT * num(remote_fetches),
+    # but then that would imply that remote_storage's HTTPConnectionWithTimeout class isn't
+    # working correctly :-)
+    for fetch_thread in remote_fetches:
+      try:
+        fetch_thread.join(settings.REMOTE_STORE_FETCH_TIMEOUT)
+        if fetch_thread.is_alive():
+          log.exception("Failed to join remote_fetch thread %s within %ss" % (fetch_thread.name, settings.REMOTE_STORE_FETCH_TIMEOUT))
+      except:
+        log.exception("Exception during remote_fetch thread %s" % (fetch_thread.name))
+
+_localFetchPool = None
+_localFetchPoolLock = threading.Lock()
+
+def getLocalFetchPool():
+  "Returns the process-wide pool of local fetch threads, None if fetches run serially"
+  global _localFetchPool
+  if settings.LOCAL_FETCH_THREADS <= 1:
+    return None
+
+  with _localFetchPoolLock:
+    # A pool inherited from the parent of a preforked worker has no threads
+    if _localFetchPool is None or _localFetchPool[0] != os.getpid():
+      _localFetchPool = (os.getpid(), ThreadPool(settings.LOCAL_FETCH_THREADS))
+    return _localFetchPool[1]
+
+def fetchLocalData(dbFiles, startTime, endTime, now, maxDataPoints=None):
+  "Fetches dbFiles concurrently on the local fetch pool, returns the results in the same order"
+  if maxDataPoints:
+    fetch = lambda dbFile: dbFile.fetch(startTime, endTime, now, maxDataPoints)
+  else:
+    fetch = lambda dbFile: dbFile.fetch(startTime, endTime, now)
 
-  return result_queue
+  if settings.DATA_CHUNK_SIZE > 0:
+    fetch = ChunkedFetch(dbFiles, startTime, endTime, now, maxDataPoints, fetch)
 
-# Data retrieval API
-def fetchData(requestContext, pathExpr):
-  seriesList = {}
-  (startTime, endTime, now) = _timebounds(requestContext)
+  pool = getLocalFetchPool()
+  if pool is None or len(dbFiles) < 2:
+    results = [fetch(dbFile) for dbFile in dbFiles]
+  else:
+    results = pool.map(fetch, dbFiles)
+
+  if settings.DATA_CHUNK_SIZE > 0:
+    fetch.save()
+  return results
+
+class ChunkedFetch:
+  """Fetches whisper files from chunks of DATA_CHUNK_SIZE seconds kept in the
+  cache, reading only the chunks it lacks from the files.
+
+  Chunks are aligned to multiples of their size and hold the points of one
+  archive, the one whisper.fetch() would read the whole time range from, so the
+  values are the same as when the files are read. Only chunks that ended
+  DATA_CHUNK_SETTLE_TIME seconds ago are cached, later points may still be
+  written. A render refreshing the same time range every minute thus reads the
+  newest chunks and takes the older ones from the cache.
+
+  Chunks are keyed by the inode and size of their file besides its path, so a
+  resized or recreated file is read again. Points backfilled into settled
+  chunks of the same file are only seen once those expire.
+
+  Other files are fetched with fetch, which returns what dbFile.fetch() does."""
+
+  def __init__(self, dbFiles, startTime, endTime, now, maxDataPoints, fetch):
+    if now is None:
+      now = int( time.time() )
+    self.fallback = fetch
+    self.plans = {}
+    self.saved = {}
+    settled = now - settings.DATA_CHUNK_SETTLE_TIME
+
+    for dbFile in dbFiles:
+      if dbFile.__class__ is not WhisperFile:
+        continue
+      try:
+        stat = os.stat(dbFile.fs_path)
+        window = whisper_fetch_window(dbFile.getInfo(), startTime, endTime, now, maxDataPoints)
+      except:
+        log.exception("Failed to read the header of %s" % dbFile.fs_path)
+        continue
+      if window is None:
+        continue
+
+      (archive, timeInfo) = window
+      (fromInterval, untilInterval, step) = timeInfo
+      size = max(1, settings.DATA_CHUNK_SIZE // step) * step
+      chunks = []
+      for chunkStart in xrange(fromInterval - fromInterval % size, untilInterval, size):
+        if chunkStart + size <= settled:
+          key = self.key(dbFile.fs_path, stat, step, chunkStart, size)
+        else:
+          key = None
+        chunks.append( (chunkStart, key) )
+      self.plans[dbFile.fs_path] = (archive, timeInfo, size, chunks)
+
+    keys = [key for (archive, timeInfo, size, chunks) in self.plans.values() for (chunkStart, key) in chunks if key]
+    self.cached = tieredcache.get_many(keys) if keys else {}
+    log.cache("Data-Chunk-Cache found %d of %d chunks" % (len(self.cached), len(keys)))
+
+  @staticmethod
+  def key(path, stat, step, chunkStart, size):
+    return 'chunk-' + compactHash('%s:%s:%d:%d:%d:%d:%d' % (STORE.local_host, path, stat.st_ino, stat.st_size, step, chunkStart, size))
+
+  def __call__(self, dbFile):
+    plan = self.plans.get(dbFile.fs_path)
+    if plan is None:
+      return self.fallback(dbFile)
+
+    (archive, timeInfo, size, chunks) = plan
+    (fromInterval, untilInterval, step) = timeInfo
+    missing = [chunkStart for (chunkStart, key) in chunks if key not in self.cached]
+    if missing:
+      read = whisper_archive_fetch(dbFile.fs_path, archive, missing[0], missing[-1] + size)
+
+    values = []
+    for (chunkStart, key) in chunks:
+      if key in self.cached:
+        values.extend(self.cached[key])
+        continue
+      offset = (chunkStart - missing[0]) // step
+      chunkValues = read[offset:offset + size // step]
+      if key:
+        self.saved[key] = chunkValues
+      values.extend(chunkValues)
+
+    lead = (fromInterval - chunks[0][0]) // step
+    return (timeInfo, values[lead:lead + (untilInterval - fromInterval) // step])
+
+  def save(self):
+    "Caches the settled chunks read from the files"
+    if self.saved:
+      tieredcache.set_many(self.saved, settings.DATA_CHUNK_CACHE_DURATION)
+
+class FetchMemo:
+  """The series one render has fetched, by path expression and time range.
+
+  Functions like movingAverage, timeShift or summarize evaluate their series
+  again for other time ranges, and targets repeat path expressions. The memo
+  serves a repeated fetch with copies of the series fetched before, and a time
+  range within one fetched before with slices of those series, as long as the
+  headers of the whisper files show that whisper would read the narrower range
+  from the same archive. Series with data from remote webapps are never sliced.
+
+  The memo mostly holds the local series planFetches() reads ahead of
+  evaluation, which fetchData() serves copies of and completes with remote
+  data. Series fetched during evaluation belong to the function that fetched
+  them, so the memo only keeps copies of those planFetches() expects to be
+  fetched again, and of those fetched a second time during evaluation, like
+  the series functions such as useSeriesAbove evaluate for each series.
+
+  maxDataPoints is the one the render fetches with, see whisper_fetch_window()."""
+
+  def __init__(self, maxDataPoints=None):
+    self.maxDataPoints = maxDataPoints
+    self.fetches = {}
+    self.localFetches = {}
+    # The (pathExpr, startTime, endTime, now) fetched more than once, None to keep every fetch
+    self.repeated = None
+    self.added = set()
+
+  def get(self, pathExpr, startTime, endTime, now):
+    "Returns copies of the series of pathExpr over the time range, None if they have to be fetched"
+    fetched = self.find(self.fetches, pathExpr, startTime, endTime, now)
+    if fetched is None:
+      return None
+    return [ series for (series, dbFile) in fetched ]
+
+  def getLocal(self, pathExpr, startTime, endTime, now):
+    "Returns (series, dbFile) pairs with copies of the local series of pathExpr, None if they have to be read"
+    return self.find(self.localFetches, pathExpr, startTime, endTime, now)
+
+  def add(self, pathExpr, startTime, endTime, now, fetched):
+    """Keeps copies of the (series, dbFile) pairs fetched if the same fetch is
+    expected again, dbFile is None for series with remote data"""
+    key = (pathExpr, startTime, endTime, now)
+    if self.repeated is not None and key not in self.repeated and key not in self.added:
+      self.added.add(key)
+      return
+    fetched = [ (sliceSeries(series, series.start, series.end), dbFile) for (series, dbFile) in fetched ]
+    self.keep(self.fetches, pathExpr, startTime, endTime, now, fetched)
+
+  def addLocal(self, pathExpr, startTime, endTime, now, fetched):
+    "Keeps the (series, dbFile) pairs fetchLocalSeries() read ahead, which nothing else holds"
+    self.keep(self.localFetches, pathExpr, startTime, endTime, now, fetched)
+
+  def keep(self, fetches, pathExpr, startTime, endTime, now, fetched):
+    fetches.setdefault(pathExpr, []).append( (startTime, endTime, now, fetched) )
+
+  def find(self, fetches, pathExpr, startTime, endTime, now):
+    for (fetchStart, fetchEnd, fetchNow, fetched) in fetches.get(pathExpr, []):
+      if (fetchStart, fetchEnd, fetchNow) == (startTime, endTime, now):
+        return [ (sliceSeries(series, series.start, series.end), dbFile) for (series, dbFile) in fetched ]
+
+    for (fetchStart, fetchEnd, fetchNow, fetched) in fetches.get(pathExpr, []):
+      if fetchNow == now and fetchStart <= startTime and endTime <= fetchEnd:
+        sliced = self.slice(fetched, startTime, endTime, now)
+        if sliced is not None:
+          return sliced
+
+    return None
+
+  def slice(self, fetched, startTime, endTime, now):
+    sliced = []
+    for (series, dbFile) in fetched:
+      # Only plain whisper files have headers that can be read without fetching
+      if dbFile is None or dbFile.__class__ is not WhisperFile:
+        return None
+      try:
+        window = whisper_fetch_window(dbFile.getInfo(), startTime, endTime, now, self.maxDataPoints)
+      except:
+        log.exception("Failed to read the header of %s" % dbFile.fs_path)
+        return None
+      if window is None:
+        return None
+
+      (fromInterval, untilInterval, step) = window[1]
+      first = (fromInterval - series.start) // step
+      last = (untilInterval - series.start) // step
+      if step != series.step or first < 0 or last > len(series):
+        return None
+      sliced.append( (sliceSeries(series, fromInterval, untilInterval, first, last), dbFile) )
+
+    return sliced
+
+
+def sliceSeries(series, start, end, first=0, last=None):
+  "Copies the raw values first to last of a fetched series into a new series from start to end"
+  if last is None:
+    last = len(series)
+  if isinstance(series, CompactTimeSeries):
+    copy = CompactTimeSeries(series.name, start, end, series.step, [], series.consolidationFunc)
+    copy.values = series.values[first:last]
+    copy.nulls = series.nulls[first:last]
+  else:
+    copy = TimeSeries(series.name, start, end, series.step, series[first:last], series.consolidationFunc)
+  copy.pathExpression = series.pathExpression
+  return copy
+
+
+def planFetches(requestContext, fetchWindows, fetchCounts=None):
+  """Reads the local series of each path expression once for every group of
+  overlapping time ranges the targets fetch it for, into the fetch memo of
+  requestContext.
+
+  fetchWindows and fetchCounts are what evaluator.extractFetchWindows()
+  returns and counts. Evaluation then serves the narrower time ranges from
+  slices of the wider read, wherever the fetch memo finds that whisper would
+  read them from the same archive, and completes them with remote data. As
+  remote data can only be reused for the exact time range it was fetched for,
+  the memo keeps the series of the time ranges fetched more than once."""
+  fetchMemo = requestContext.get('fetchMemo')
+  if fetchMemo is None:
+    return
+
+  fetchMemo.repeated = set()
+  windowsByPath = {}
+  for ((startTime, endTime), pathExprs) in fetchWindows.items():
+    # Functions may fetch for naive times, which only compare once they are epochs
+    (fromTime, untilTime, now) = _timebounds( dict(requestContext, startTime=startTime, endTime=endTime) )
+    for pathExpr in pathExprs:
+      times = (fetchCounts or {}).get( (startTime, endTime, pathExpr), 1 )
+      windowsByPath.setdefault(pathExpr, []).extend( [(fromTime, untilTime)] * times )
+      if times > 1:
+        fetchMemo.repeated.add( (pathExpr, fromTime, untilTime, now) )
+
+  for pathExpr in sorted(windowsByPath):
+    for (fromTime, untilTime, consumers) in mergeWindows(windowsByPath[pathExpr]):
+      # A time range only one consumer needs is fetched during evaluation
+      if consumers < 2:
+        continue
 
-  dbFiles = [dbFile for dbFile in LOCAL_STORE.find(pathExpr)]
+      try:
+        localSeries = fetchLocalSeries(pathExpr, fromTime, untilTime, now, requestContext.get('maxDataPoints'))
+        fetchMemo.addLocal(pathExpr, fromTime, untilTime, now, localSeries)
+      except:
+        log.exception("Failed to read %s ahead of evaluation" % pathExpr)
+
+def mergeWindows(windows):
+  "Merges overlapping (startTime, endTime) windows, returns (startTime, endTime, number merged)"
+  merged = []
+  for (startTime, endTime) in sorted(windows):
+    if merged and startTime <= merged[-1][1]:
+      (mergedStart, mergedEnd, consumers) = merged[-1]
+      merged[-1] = (mergedStart, max(mergedEnd, endTime), consumers + 1)
+    else:
+      merged.append( (startTime, endTime, 1) )
+  return merged
+
+
+# Data retrieval API
+def fetchLocalSeries(pathExpr, startTime, endTime, now, maxDataPoints=None):
+  "Reads the local data files of pathExpr, merged with carbon's cache, returns (series, dbFile) pairs"
+  fetched = []
+  with stage('find.local'):
+    dbFiles = [dbFile for dbFile in LOCAL_STORE.find(pathExpr)]
+  count('files', len(dbFiles))
+
+  cachedMetrics = [dbFile.real_metric for dbFile in dbFiles if dbFile.isLocal()]
+  if not cachedMetrics:
+    cacheResultsByMetric = {}
+  elif settings.CARBONLINK_QUERY_BULK:
+    with stage('carbonlink'):
+      cacheResultsByMetric = CarbonLink.query_bulk(cachedMetrics)
+  else:
+    with stage('carbonlink'):
+      cacheResultsByMetric = CarbonLink.query_many(cachedMetrics)
 
-  if settings.CARBONLINK_QUERY_BULK:
-    cacheResultsByMetric = CarbonLink.query_bulk([dbFile.real_metric for dbFile in dbFiles])
+  with stage('read.whisper'):
+    allDbResults = fetchLocalData(dbFiles, startTime, endTime, now, maxDataPoints)
 
-  for dbFile in dbFiles:
+  for (dbFile, dbResults) in zip(dbFiles, allDbResults):
     log.metric_access(dbFile.metric_path)
-    dbResults = dbFile.fetch(startTime, endTime, now)
 
     if dbFile.isLocal():
       try:
-        if settings.CARBONLINK_QUERY_BULK:
-          cachedResults = cacheResultsByMetric.get(dbFile.real_metric,[])
-        else:
-          cachedResults = CarbonLink.query(dbFile.real_metric)
+        cachedResults = cacheResultsByMetric.get(dbFile.real_metric,[])
         if cachedResults:
           meta_info = dbFile.getInfo()
           lowest_step = min([i['secondsPerPoint'] for i in meta_info['archives']])
-          dbResults = mergeResults(dbResults, cachedResults, lowest_step)
+          with stage('carbonlink'):
+            dbResults = mergeResults(dbResults, cachedResults, lowest_step)
       except:
         log.exception("Failed CarbonLink query '%s'" % dbFile.real_metric)
 
@@ -395,9 +1240,29 @@ def fetchData(requestContext, pathExpr):
 
     (timeInfo,values) = dbResults
     (start,end,step) = timeInfo
-    series = TimeSeries(dbFile.metric_path, start, end, step, values)
+    series = newTimeSeries(dbFile.metric_path, start, end, step, values)
     series.pathExpression = pathExpr #hack to pass expressions through to render functions
-    seriesList[series.name] = series
+    fetched.append( (series, dbFile) )
+
+  return fetched
+
+def fetchData(requestContext, pathExpr):
+  (startTime, endTime, now) = _timebounds(requestContext)
+
+  fetchMemo = requestContext.get('fetchMemo')
+  localSeries = None
+  if fetchMemo is not None:
+    memoized = fetchMemo.get(pathExpr, startTime, endTime, now)
+    if memoized is not None:
+      return memoized
+    localSeries = fetchMemo.getLocal(pathExpr, startTime, endTime, now)
+  readAhead = localSeries is not None
+
+  t = time.time()
+  if localSeries is None:
+    localSeries = fetchLocalSeries(pathExpr, startTime, endTime, now, requestContext.get('maxDataPoints'))
+  seriesList = dict( (series.name, series) for (series, dbFile) in localSeries )
+  localFiles = dict( (series.name, dbFile) for (series, dbFile) in localSeries )
 
   if not requestContext['localOnly']:
     result_queue = fetchRemoteData(requestContext, pathExpr)
@@ -415,8 +1280,9 @@ def fetchData(requestContext, pathExpr):
         log.exception("result_queue not empty, but unable to retrieve results")
 
       for series in results:
-        ts = TimeSeries(series['name'], series['start'], series['end'], series['step'], series['values'])
+        ts = newTimeSeries(series['name'], series['start'], series['end'], series['step'], series['values'])
         ts.pathExpression = pathExpr # hack as above
+        localFiles[ts.name] = None
 
         if ts.name in seriesList:
           # This counts the Nones in each series, and is unfortunately O(n) for each
@@ -475,7 +1341,15 @@ def fetchData(requestContext, pathExpr):
 
   # Stabilize the order of the results by ordering the resulting series by name.
   # This returns the result ordering to the behavior observed pre PR#1010.
-  return [ seriesList[k] for k in sorted(seriesList) ]
+  seriesList = [ seriesList[k] for k in sorted(seriesList) ]
+
+  # Local series read ahead are served from the memo again anyway
+  localOnly = requestContext['localOnly'] or not STORE.remote_stores
+  if fetchMemo is not None and not (readAhead and localOnly):
+    fetchMemo.add(pathExpr, startTime, endTime, now, [ (series, localFiles[series.name]) for series in seriesList ])
+  instrumentation.observe('fetch_duration_seconds', time.time() - t)
+  instrumentation.increment('fetched_series_total', len(seriesList))
+  return seriesList
 
 
 def mergeResults(dbResults, cacheResults, lowest_step):
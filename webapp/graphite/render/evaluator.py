@@ -1,15 +1,91 @@
 import datetime
 import time
 from django.conf import settings
-from graphite.render.grammar import grammar
-from graphite.render.datalib import fetchData, TimeSeries
+from graphite.logger import log
+from graphite import instrumentation
+from graphite.render.parser import parse
+from graphite.render.datalib import fetchData, isTimeSeries, batchRemoteData, planFetches
+from graphite.render.profiling import stage
+from graphite.util import LRUCache
+
+
+PARSED_TARGETS = LRUCache(settings.PARSED_TARGET_CACHE_SIZE)
+
+
+def parseTarget(target):
+  """Returns the tokens of target, parsing it only if it is not cached.
+
+  The tokens are immutable and shared by every request asking for the same
+  target, so they must not be modified."""
+  tokens = PARSED_TARGETS.get(target)
+  if tokens is None:
+    with stage('parse'):
+      tokens = parse(target)
+    PARSED_TARGETS.set(target, tokens)
+  return tokens
+
+
+def parseCacheStats():
+  "Returns the hit and miss counters and the size of the parsed target cache"
+  lookups = PARSED_TARGETS.hits + PARSED_TARGETS.misses
+  return dict(hits=PARSED_TARGETS.hits, misses=PARSED_TARGETS.misses,
+              hitRate=float(PARSED_TARGETS.hits) / lookups if lookups else 0.0,
+              size=len(PARSED_TARGETS), maxSize=PARSED_TARGETS.max_size)
+
+
+def collectMetrics():
+  yield ('counter', 'parsed_target_cache_hits_total', {}, PARSED_TARGETS.hits)
+  yield ('counter', 'parsed_target_cache_misses_total', {}, PARSED_TARGETS.misses)
+  yield ('gauge', 'parsed_target_cache_size', {}, len(PARSED_TARGETS))
+
+instrumentation.addCollector(collectMetrics)
+
+
+def downsamplingSafe(targets):
+  """Whether the targets give the same results on series read from coarser
+  archives as on every point, see functions.DownsampleFunctions"""
+  def safe(tokens):
+    if tokens.expression:
+      return safe(tokens.expression)
+    elif tokens.call:
+      return tokens.call.func in DownsampleFunctions and all(safe(arg) for arg in tokens.call.args)
+    return True
+
+  return all(safe(parseTarget(target)) for target in targets if target.strip())
+
+
+def evaluateTargets(requestContext, targets):
+  """Evaluates targets one after the other and returns the series of all of them.
+
+  Remote data is prefetched and overlapping local reads are planned ahead of
+  the evaluation when the settings and requestContext ask for it."""
+  fetchCounts = {}
+  if settings.REMOTE_PREFETCH_DATA or 'fetchMemo' in requestContext:
+    fetchWindows = extractFetchWindows(requestContext, targets, fetchCounts)
+  if settings.REMOTE_PREFETCH_DATA:
+    t = time.time()
+    requestContext['prefetchedRemoteData'] = batchRemoteData(requestContext, fetchWindows)
+    log.rendering("Prefetching remote data took %.6f" % (time.time() - t))
+  if 'fetchMemo' in requestContext:
+    t = time.time()
+    planFetches(requestContext, fetchWindows, fetchCounts)
+    log.rendering("Reading data ahead of evaluation took %.6f" % (time.time() - t))
+
+  seriesList = []
+  for target in targets:
+    if not target.strip():
+      continue
+    t = time.time()
+    seriesList.extend( evaluateTarget(requestContext, target) )
+    log.rendering("Retrieval of %s took %.6f" % (target, time.time() - t))
+  return seriesList
 
 
 def evaluateTarget(requestContext, target):
-  tokens = grammar.parseString(target)
+  tokens = parseTarget(target)
   result = evaluateTokens(requestContext, tokens)
 
-  if type(result) is TimeSeries:
+  if isTimeSeries(result):
     return [result] #we have to return a list of TimeSeries objects
 
   else:
@@ -28,7 +104,8 @@ def evaluateTokens(requestContext, tokens):
     args = [evaluateTokens(requestContext, arg) for arg in tokens.call.args]
     requestContext['args'] = tokens.call.args
     try:
-      return func(requestContext, *args)
+      with stage('function.' + tokens.call.func):
+        return func(requestContext, *args)
     except NormalizeEmptyResultError:
       return []
 
@@ -38,13 +115,13 @@ def evaluateTokens(requestContext, tokens):
     elif tokens.number.float:
       return float(tokens.number.float)
     elif tokens.number.scientific:
-      return float(tokens.number.scientific[0])
+      return float(tokens.number.scientific)
 
   elif tokens.string:
     return str(tokens.string)[1:-1]
 
   elif tokens.boolean:
-    return tokens.boolean[0] == 'true'
+    return tokens.boolean == 'true'
 
 
 def extractPathExpressions(targets):
@@ -61,7 +138,7 @@ def extractPathExpressions(targets):
       [extractPathExpression(arg) for arg in tokens.call.args]
 
   for target in targets:
-    tokens = grammar.parseString(target)
+    tokens = parseTarget(target)
     extractPathExpression(tokens)
 
   s = set(pathExpressions)
@@ -69,5 +146,47 @@ def extractPathExpressions(targets):
   return pathExpressions
 
 
+def extractFetchWindows(requestContext, targets, fetchCounts=None):
+  """Returns the path expressions the targets fetch, by (startTime, endTime).
+
+  Besides the time range of requestContext, this covers the ranges functions
+  like movingAverage or timeShift fetch their series for. Ranges that depend
+  on the fetched data itself are left out. fetchCounts, when given, is filled
+  with the number of times each (startTime, endTime, pathExpression) is fetched."""
+  fetchWindows = {}
+
+  def extractWindows(context, tokens):
+    if tokens.expression:
+      extractWindows(context, tokens.expression)
+    elif tokens.pathExpression:
+      window = (context['startTime'], context['endTime'])
+      fetchWindows.setdefault(window, set()).add(tokens.pathExpression)
+      if fetchCounts is not None:
+        key = window + (tokens.pathExpression,)
+        fetchCounts[key] = fetchCounts.get(key, 0) + 1
+    elif tokens.call:
+      args = tokens.call.args
+      for arg in args:
+        extractWindows(context, arg)
+
+      contexts = FetchContexts.get(tokens.call.func)
+      if contexts is None or not args:
+        return
+      if [arg for arg in args[1:] if arg.expression or arg.pathExpression or arg.call]:
+        return
+      try:
+        otherContexts = contexts(context, *[evaluateTokens(context, arg) for arg in args[1:]])
+      except Exception:
+        return # the function itself reports bad arguments
+      for otherContext in otherContexts:
+        extractWindows(otherContext, args[0])
+
+  for target in targets:
+    if target.strip():
+      extractWindows(requestContext, parseTarget(target))
+
+  return fetchWindows
+
+
 #Avoid import circularities
-from graphite.render.functions import SeriesFunctions,NormalizeEmptyResultError
+from graphite.render.functions import SeriesFunctions,NormalizeEmptyResultError,FetchContexts,DownsampleFunctions
@@ -789,12 +789,13 @@ def consolidateBy(requestContext, seriesList, consolidationFunc):
   """
   Takes one metric or a wildcard seriesList and a consolidation function name.
 
-  Valid function names are 'sum', 'average', 'min', and 'max'
+  Valid function names are 'sum', 'average', 'min', 'max', 'first' and 'last'
 
   When a graph is drawn where width of the graph size in pixels is smaller than
   the number of datapoints to be graphed, Graphite consolidates the values to
   to prevent line overlap. The consolidateBy() function changes the consolidation
-  function from the default of 'average' to one of 'sum', 'max', or 'min'. This is
+  function from the default of 'average' to one of 'sum', 'max', 'min', 'first'
+  or 'last'. This is
   especially useful in sales graphs, where fractional values make no sense and a 'sum'
   of consolidated values is appropriate.
 
@@ -2455,14 +2456,7 @@ def smartSummarize(requestContext, seriesList, intervalString, func='sum', align
   interval = delta.seconds + (delta.days * 86400)
 
   # Adjust the start time to fit an entire day for intervals >= 1 day
-  requestContext = requestContext.copy()
-  s = requestContext['startTime']
-  if interval >= DAY:
-    requestContext['startTime'] = datetime(s.year, s.month, s.day)
-  elif interval >= HOUR:
-    requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour)
-  elif interval >= MINUTE:
-    requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, s.minute)
+  requestContext = _alignedContext(requestContext, interval)
 
   for i,series in enumerate(seriesList):
     # XXX: breaks with summarize(metric.{a,b})
@@ -2630,14 +2624,7 @@ def hitcount(requestContext, seriesList, intervalString, alignToInterval = False
   interval = int(delta.seconds + (delta.days * 86400))
 
   if alignToInterval:
-    requestContext = requestContext.copy()
-    s = requestContext['startTime']
-    if interval >= DAY:
-      requestContext['startTime'] = datetime(s.year, s.month, s.day)
-    elif interval >= HOUR:
-      requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour)
-    elif interval >= MINUTE:
-      requestContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, s.minute)
+    requestContext = _alignedContext(requestContext, interval)
 
     for i,series in enumerate(seriesList):
       newSeries = evaluateTarget(requestContext, series.pathExpression)[0]
@@ -2969,5 +2956,89 @@ SeriesFunctions = {
 }
 
 
+# Functions that fetch their first argument again for other time ranges than
+# the one they are evaluated for. Given the request context and the literal
+# values of the remaining arguments, these return the contexts the first
+# argument gets fetched for, so that the batching stage can fetch it upfront.
+
+def _movingWindowContexts(requestContext, windowSize, *args):
+  if type(windowSize) is not str:
+    return [] # the preview is a number of points of a step we do not know yet
+  delta = parseTimeOffset(windowSize)
+  return _previewContexts(requestContext, abs(delta.seconds + (delta.days * 86400)))
+
+def _holtWintersContexts(requestContext, *args):
+  return _previewContexts(requestContext, 7 * 86400)
+
+def _previewContexts(requestContext, previewSeconds):
+  newContext = requestContext.copy()
+  newContext['startTime'] = requestContext['startTime'] - timedelta(seconds=previewSeconds)
+  return [newContext]
+
+def _timeShiftContexts(requestContext, timeShift, *args):
+  if timeShift[0].isdigit():
+    timeShift = '-' + timeShift
+  return [_shiftedContext(requestContext, parseTimeOffset(timeShift))]
+
+def _timeStackContexts(requestContext, timeShiftUnit, timeShiftStart, timeShiftEnd):
+  if timeShiftUnit[0].isdigit():
+    timeShiftUnit = '-' + timeShiftUnit
+  delta = parseTimeOffset(timeShiftUnit)
+  return [_shiftedContext(requestContext, delta * shft) for shft in range(int(timeShiftStart), int(timeShiftEnd))]
+
+def _summarizeContexts(requestContext, intervalString, *args):
+  delta = parseTimeOffset(intervalString)
+  return [_alignedContext(requestContext, delta.seconds + (delta.days * 86400))]
+
+def _hitcountContexts(requestContext, intervalString, alignToInterval=False):
+  if not alignToInterval:
+    return []
+  return _summarizeContexts(requestContext, intervalString)
+
+def _alignedContext(requestContext, interval):
+  "Starts requestContext at the day, hour or minute it starts in, by interval"
+  myContext = requestContext.copy()
+  s = requestContext['startTime']
+  if interval >= DAY:
+    myContext['startTime'] = datetime(s.year, s.month, s.day)
+  elif interval >= HOUR:
+    myContext['startTime'] = datetime(s.year, s.month, s.day, s.hour)
+  elif interval >= MINUTE:
+    myContext['startTime'] = datetime(s.year, s.month, s.day, s.hour, s.minute)
+  return myContext
+
+def _shiftedContext(requestContext, delta):
+  myContext = requestContext.copy()
+  myContext['startTime'] = requestContext['startTime'] + delta
+  myContext['endTime'] = requestContext['endTime'] + delta
+  return myContext
+
+FetchContexts = {
+  'movingAverage' : _movingWindowContexts,
+  'movingMedian' : _movingWindowContexts,
+  'holtWintersForecast' : _holtWintersContexts,
+  'holtWintersConfidenceBands' : _holtWintersContexts,
+  'holtWintersConfidenceArea' : _holtWintersContexts,
+  'holtWintersAberration' : _holtWintersContexts,
+  'timeShift' : _timeShiftContexts,
+  'timeStack' : _timeStackContexts,
+  'smartSummarize' : _summarizeContexts,
+  'hitcount' : _hitcountContexts,
+}
+
+
+# Functions that give the same results on series read from coarser whisper
+# archives, which average their points, as when their results get averaged
+# into fewer points by the render. They combine series linearly or change
+# only names and styles. Renders calling other functions read every point.
+DownsampleFunctions = set([
+  'sumSeries', 'sum', 'averageSeries', 'avg', 'sumSeriesWithWildcards',
+  'averageSeriesWithWildcards', 'diffSeries', 'scale', 'offset', 'timeShift',
+  'timeStack', 'alias', 'aliasSub', 'aliasByNode', 'aliasByMetric', 'color',
+  'alpha', 'secondYAxis', 'lineWidth', 'dashed', 'stacked', 'substr', 'group',
+  'sortByName', 'limit', 'exclude', 'constantLine', 'threshold', 'identity',
+])
+
+
 #Avoid import circularity
 from graphite.render.evaluator import evaluateTarget, evaluateTokens
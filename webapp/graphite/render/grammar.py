@@ -1,4 +1,5 @@
 from graphite.thirdparty.pyparsing import *
+from graphite.render.parser import Tokens
 
 ParserElement.enablePackrat()
 grammar = Forward()
@@ -67,6 +68,25 @@ expression << Group(call | pathExpression)('expression')
 
 grammar << expression
 
+
+def freeze(tokens):
+  "Copies the results of grammar.parseString, or of one of its groups, into Tokens"
+  if tokens.expression:
+    return Tokens(expression=freeze(tokens.expression))
+  elif tokens.call:
+    args = tuple(freeze(arg) for arg in tokens.call.args)
+    return Tokens(call=Tokens(func=tokens.call.func, args=args))
+  elif tokens.number:
+    number = tokens.number
+    if number.scientific:
+      return Tokens(number=Tokens(scientific=number.scientific[0]))
+    return Tokens(number=Tokens(integer=number.integer, float=number.float))
+  elif tokens.string:
+    return Tokens(string=tokens.string)
+  elif tokens.boolean:
+    return Tokens(boolean=tokens.boolean[0])
+  return Tokens(pathExpression=tokens.pathExpression)
+
 def enableDebug():
   for name,obj in globals().items():
     try:
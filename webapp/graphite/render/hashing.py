@@ -41,21 +41,32 @@ except ImportError:
       hval = (hval * fnv_32_prime) % uint32_max
     return hval
 
-def hashRequest(request):
+TimeParams = frozenset(['from', 'until', 'now'])
+
+def hashRequest(request, window=None):
+  """Hashes the parameters of request, except cache busters like _salt.
+
+  With window, the resolved times of the time range of request, the time
+  range parameters are hashed as those times instead, so requests for the
+  same time range share the hash however they write it."""
   # Normalize the request parameters so ensure we're deterministic
   queryParams = ["%s=%s" % (key, '&'.join(values))
                  for (key,values) in chain(request.POST.lists(), request.GET.lists())
-                 if not key.startswith('_')]
+                 if not key.startswith('_') and not (window is not None and key in TimeParams)]
+  if window is not None:
+    queryParams.append('window=%s' % ':'.join(map(str, window)))
 
   normalizedParams = ','.join( sorted(queryParams) )
   return compactHash(normalizedParams)
 
 
-def hashData(targets, startTime, endTime, node):
+def hashData(targets, startTime, endTime, node, maxDataPoints=None):
   targetsString = ','.join(sorted(targets))
   startTimeString = startTime.strftime("%Y%m%d_%H%M")
   endTimeString = endTime.strftime("%Y%m%d_%H%M")
   myHash = targetsString + '@' + startTimeString + ':' + endTimeString + '/' + node
+  if maxDataPoints:
+    myHash += '#%d' % maxDataPoints
   return compactHash(myHash)
 
 
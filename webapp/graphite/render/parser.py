@@ -0,0 +1,147 @@
+"""A recursive descent parser for render targets.
+
+parse() reads a target into the same tree graphite.render.grammar builds with
+pyparsing, including its quirks: whitespace is allowed between tokens but not
+within numbers or path expressions, a number must be followed by ',', ')' or
+the end of a line, anything a call cannot parse is read as a path expression
+and whatever follows the first complete expression is ignored. It is a lot
+faster than pyparsing and does not need it to be imported."""
+import re
+
+
+class Tokens(object):
+  """An immutable copy of the tokens a target is parsed into.
+
+  Names are looked up as on the results of grammar.parseString, and names a
+  target lacks are '' there as well, so evaluation can share one copy between
+  requests and threads."""
+  __slots__ = ('expression', 'pathExpression', 'call', 'func', 'args', 'number',
+               'integer', 'float', 'scientific', 'string', 'boolean')
+
+  def __init__(self, **values):
+    for name in self.__slots__:
+      object.__setattr__(self, name, values.pop(name, ''))
+    if values:
+      raise TypeError("Unknown tokens %s" % ', '.join(sorted(values)))
+
+  def __setattr__(self, name, value):
+    raise AttributeError("Tokens are immutable")
+
+  def __delattr__(self, name):
+    raise AttributeError("Tokens are immutable")
+
+  def __eq__(self, other):
+    if not isinstance(other, Tokens):
+      return NotImplemented
+    return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    if equal is NotImplemented:
+      return equal
+    return not equal
+
+  __hash__ = None
+
+  def __repr__(self):
+    values = ['%s=%r' % (name, getattr(self, name)) for name in self.__slots__ if getattr(self, name) != '']
+    return 'Tokens(%s)' % ', '.join(values)
+
+
+validMetricChars = r'''!#$%&"'*+-.:;<=>?@[\]^_`|~'''
+metricChars = '[A-Za-z0-9%s]' % re.escape(validMetricChars)
+braceChars = '[A-Za-z0-9,%s]' % re.escape(validMetricChars)
+
+WHITESPACE = re.compile(r'[ \n\t\r]*')
+LINE_WHITESPACE = re.compile(r'[ \t]*')
+FUNC = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+PATH_EXPRESSION = re.compile(r'%s*(?:\{%s+\}%s*)*' % (metricChars, braceChars, metricChars))
+SCIENTIFIC = re.compile(r'(-?[0-9]+(?:\.[0-9]+)?)[eE](-?[0-9]+)')
+FLOAT = re.compile(r'-?[0-9]+\.[0-9]+')
+INTEGER = re.compile(r'-?[0-9]+')
+STRING = re.compile(r'''(?:"(?:[^"\n\r\\]|(?:"")|(?:\\x[0-9a-fA-F]+)|(?:\\.))*")|(?:'(?:[^'\n\r\\]|(?:'')|(?:\\x[0-9a-fA-F]+)|(?:\\.))*')''')
+KEYWORD_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$')
+
+
+def parse(target):
+  "Returns the Tokens of target"
+  target = target.expandtabs()
+  (expression, pos) = parseExpression(target, 0)
+  return Tokens(expression=expression)
+
+
+def parseExpression(target, pos):
+  pos = WHITESPACE.match(target, pos).end()
+  result = parseCall(target, pos)
+  if result is not None:
+    (call, pos) = result
+    return (Tokens(call=call), pos)
+
+  end = PATH_EXPRESSION.match(target, pos).end()
+  return (Tokens(pathExpression=target[pos:end]), end)
+
+
+def parseCall(target, pos):
+  match = FUNC.match(target, pos)
+  if match is None:
+    return None
+  pos = WHITESPACE.match(target, match.end()).end()
+  if target[pos:pos+1] != '(':
+    return None
+
+  args = []
+  while True:
+    (arg, pos) = parseArg(target, pos + 1)
+    args.append(arg)
+    pos = WHITESPACE.match(target, pos).end()
+    separator = target[pos:pos+1]
+    if separator == ')':
+      return (Tokens(func=match.group(), args=tuple(args)), pos + 1)
+    elif separator != ',':
+      return None
+
+
+def parseArg(target, pos):
+  pos = WHITESPACE.match(target, pos).end()
+
+  for word in ('true', 'false'):
+    end = pos + len(word)
+    if target[pos:end].upper() == word.upper() and (end >= len(target) or target[end].upper() not in KEYWORD_CHARS):
+      return (Tokens(boolean=word), end)
+
+  number = parseNumber(target, pos)
+  if number is not None:
+    return number
+
+  match = STRING.match(target, pos)
+  if match is not None:
+    return (Tokens(string=match.group()), match.end())
+
+  (expression, pos) = parseExpression(target, pos)
+  return (Tokens(expression=expression), pos)
+
+
+def parseNumber(target, pos):
+  match = SCIENTIFIC.match(target, pos)
+  if match is not None and endsNumber(target, match.end()):
+    scientific = '%se%s' % match.groups()
+    return (Tokens(number=Tokens(scientific=scientific)), match.end())
+
+  match = FLOAT.match(target, pos)
+  if match is not None and endsNumber(target, match.end()):
+    return (Tokens(number=Tokens(float=match.group())), match.end())
+
+  match = INTEGER.match(target, pos)
+  if match is not None and endsNumber(target, match.end()):
+    return (Tokens(number=Tokens(integer=match.group())), match.end())
+
+  return None
+
+
+def endsNumber(target, pos):
+  "Whether a ',', a ')' or the end of a line follows a number ending at pos"
+  end = WHITESPACE.match(target, pos).end()
+  if target[end:end+1] in (',', ')') and end < len(target):
+    return True
+  end = LINE_WHITESPACE.match(target, pos).end()
+  return end == len(target) or target[end] == '\n'
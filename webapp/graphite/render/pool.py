@@ -0,0 +1,203 @@
+"""Evaluates the targets of a render on a pool of worker processes.
+
+Each webapp process starts RENDER_PROCESSES workers when graphite.wsgi loads
+it, or the first time it needs them. A render hands its targets to them and
+keeps at most RENDER_PROCESSES_PER_REQUEST of its targets in flight at a time,
+so a single render cannot take up the whole pool. A render that gives up on a
+target after RENDER_PROCESS_TIMEOUT terminates the pool, so the target does
+not keep a worker busy, and the next render starts a new one.
+
+Workers can only be forked, and other threads may hold locks at that time,
+which would never be released in the worker. Workers replace the locks of the
+webapp and of logging they use, forking them before the process serves
+requests avoids the rest.
+
+The series a worker evaluates come back through a file in /dev/shm, which is
+shared memory, as float64 values and null flags instead of being pickled
+through the pool's pipes. Series holding anything but floats and Nones, such
+as ints, are pickled, so they render exactly as they would in the request
+thread."""
+import os
+import logging
+import threading
+import tempfile
+import multiprocessing
+from array import array
+from collections import deque
+from time import time
+from django.conf import settings
+from graphite.logger import log
+from graphite import instrumentation, remote_storage
+from graphite.render import datalib, profiling
+from graphite.render.datalib import TimeSeries, CompactTimeSeries, FetchMemo, packValues, unpackValues
+from graphite.render.evaluator import evaluateTargets
+
+
+if os.path.isdir('/dev/shm'):
+  SHARED_MEMORY_DIR = '/dev/shm'
+else:
+  SHARED_MEMORY_DIR = tempfile.gettempdir()
+
+FLOAT_TYPES = frozenset([float, type(None)])
+
+# The parts of a requestContext a worker needs to evaluate a target
+CONTEXT_KEYS = ('startTime', 'endTime', 'now', 'localOnly', 'forwardHeaders', 'maxDataPoints')
+
+_renderPool = None
+_renderPoolLock = threading.Lock()
+
+def getRenderPool():
+  "Returns the process-wide pool of render worker processes, None if targets are evaluated in the request thread"
+  global _renderPool
+  if settings.RENDER_PROCESSES <= 0:
+    return None
+
+  with _renderPoolLock:
+    # A pool inherited from the parent of a preforked worker has no processes
+    if _renderPool is None or _renderPool[0] != os.getpid():
+      _renderPool = (os.getpid(), multiprocessing.Pool(settings.RENDER_PROCESSES, initWorker))
+    return _renderPool[1]
+
+
+def discardRenderPool(pool):
+  "Terminates pool, whose workers may still be evaluating targets, the next render starts a new pool"
+  global _renderPool
+  with _renderPoolLock:
+    if _renderPool is not None and _renderPool[1] is pool:
+      _renderPool = None
+  pool.terminate()
+
+
+def initWorker():
+  """Replaces the locks a worker inherits, other threads may have held them when
+  it was forked, and forgets the connections the webapp process keeps using and
+  the profile of the render that started the pool. LRUCache and the local cache
+  tier replace their own locks."""
+  logging._lock = threading.RLock()
+  for reference in logging._handlerList:
+    handler = reference()
+    if handler is not None:
+      handler.createLock()
+  instrumentation._registryLock = threading.Lock()
+  datalib._localFetchPoolLock = threading.Lock()
+  remote_storage.connectionPoolsLock = threading.Lock()
+
+  remote_storage.connectionPools.clear()
+  for connections in datalib.CarbonLink.connections.values():
+    connections.clear()
+  profiling.stop()
+
+
+def evaluateTargetsInPool(pool, requestContext, targets):
+  """Evaluates targets on the worker processes of pool and returns the series of
+  all of them, in the order of the targets"""
+  context = dict( (key, requestContext[key]) for key in CONTEXT_KEYS if key in requestContext )
+  budget = max(1, settings.RENDER_PROCESSES_PER_REQUEST)
+  paths = []
+  pending = deque()
+  seriesList = []
+  try:
+    for target in targets:
+      (fd, path) = tempfile.mkstemp(prefix='graphite-render-', dir=SHARED_MEMORY_DIR)
+      os.close(fd)
+      paths.append(path)
+      result = pool.apply_async(evaluateInWorker, (context, target, path))
+      pending.append( (pool, target, path, time(), result) )
+      if len(pending) >= budget:
+        seriesList.extend( collectSeriesList(*pending.popleft()) )
+
+    while pending:
+      seriesList.extend( collectSeriesList(*pending.popleft()) )
+  finally:
+    # Workers still evaluating fail to open their removed file
+    for path in paths:
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+
+  return seriesList
+
+
+def collectSeriesList(pool, target, path, started, result):
+  try:
+    descriptions = result.get(settings.RENDER_PROCESS_TIMEOUT)
+  except multiprocessing.TimeoutError:
+    log.rendering("Terminating the render workers, %s took longer than %s seconds" % (target, settings.RENDER_PROCESS_TIMEOUT))
+    discardRenderPool(pool)
+    raise
+  seriesList = readSeriesList(path, descriptions)
+  log.rendering("Retrieval of %s in a worker process took %.6f" % (target, time() - started))
+  return seriesList
+
+
+def evaluateInWorker(context, target, path):
+  "Evaluates target in a worker process, writes its series to path and returns their descriptions"
+  requestContext = dict(context, prefetchedRemoteData={}, data=[])
+  if settings.MEMOIZE_FETCHES:
+    requestContext['fetchMemo'] = FetchMemo(context.get('maxDataPoints'))
+  return writeSeriesList(evaluateTargets(requestContext, [target]), path)
+
+
+def packSeries(series):
+  "Returns the values and null flags of series, None if it must be pickled"
+  if series.__class__ is CompactTimeSeries:
+    return (series.values, series.nulls)
+  if series.__class__ is TimeSeries:
+    values = series[:]
+    if set(map(type, values)) <= FLOAT_TYPES:
+      return packValues(values)
+  return None
+
+
+def writeSeriesList(seriesList, path):
+  """Writes the values of seriesList to the existing file at path and returns
+  (class, attributes, offset, length) for each series, what readSeriesList()
+  needs to build it again. Series that cannot be written are returned whole,
+  as (None, series, None, None)."""
+  descriptions = []
+  offset = 0
+  with open(path, 'r+b') as f:
+    for series in seriesList:
+      packed = packSeries(series)
+      if packed is None:
+        descriptions.append( (None, series, None, None) )
+        continue
+
+      (values, nulls) = packed
+      f.write(values.tostring())
+      f.write(str(nulls))
+      attributes = dict(series.__dict__)
+      for name in ('values', 'nulls', 'consolidated'):
+        attributes.pop(name, None)
+      descriptions.append( (series.__class__, attributes, offset, len(values)) )
+      offset += len(values) * (values.itemsize + 1)
+
+  return descriptions
+
+
+def readSeriesList(path, descriptions):
+  "Builds the series writeSeriesList() wrote to path again"
+  with open(path, 'rb') as f:
+    data = f.read()
+
+  seriesList = []
+  for (cls, attributes, offset, length) in descriptions:
+    if cls is None:
+      seriesList.append(attributes)
+      continue
+
+    values = array('d')
+    values.fromstring(data[offset:offset + length * values.itemsize])
+    nulls = bytearray(data[offset + length * values.itemsize:offset + length * (values.itemsize + 1)])
+    series = cls.__new__(cls)
+    if cls is TimeSeries:
+      list.extend(series, unpackValues(values, nulls))
+    else:
+      series.values = values
+      series.nulls = nulls
+    series.__dict__.update(attributes)
+    series.consolidated = None
+    seriesList.append(series)
+
+  return seriesList
@@ -0,0 +1,126 @@
+"""Timing of the stages of a render, for profile=1 and the slow query log.
+
+The render view starts a Profile in the thread of a request that asks for
+profile=1, or for every request when SLOW_QUERY_THRESHOLD is set. The code of
+each stage times itself with stage(), which does nothing in threads without
+a profile. The local fetch pool threads and the worker processes of
+RENDER_PROCESSES have none, so their work counts towards the stage of the
+request thread waiting for it.
+
+Stages nest. A stage's time excludes the stages it runs, so a function's time
+excludes the fetches it makes, and the stage times add up to the time spent
+in any stage."""
+import threading
+from time import time
+
+
+_current = threading.local()
+
+
+class Profile:
+  "Seconds spent and calls made in each stage of a render, and counts of what it handled"
+  def __init__(self):
+    self.started = time()
+    self.stages = {}
+    self.counts = {}
+    self.running = []
+
+  def enter(self, name):
+    self.running.append([name, time(), 0.0])
+
+  def exit(self):
+    (name, started, nested) = self.running.pop()
+    elapsed = time() - started
+    totals = self.stages.get(name)
+    if totals is None:
+      totals = self.stages[name] = [0.0, 0]
+    totals[0] += elapsed - nested
+    totals[1] += 1
+    if self.running:
+      self.running[-1][2] += elapsed
+
+  def count(self, name, number):
+    self.counts[name] = self.counts.get(name, 0) + number
+
+  def asDict(self):
+    stages = dict( (name, dict(seconds=round(seconds, 6), calls=calls))
+                   for (name, (seconds, calls)) in self.stages.items() )
+    return dict(total=round(time() - self.started, 6), stages=stages, counts=dict(self.counts))
+
+
+class Stage:
+  def __init__(self, profile, name):
+    self.profile = profile
+    self.name = name
+
+  def __enter__(self):
+    self.profile.enter(self.name)
+
+  def __exit__(self, *exc_info):
+    self.profile.exit()
+
+
+class NoStage:
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc_info):
+    pass
+
+NO_STAGE = NoStage()
+
+
+def start():
+  "Starts profiling the render in the current thread and returns its Profile"
+  profile = _current.profile = Profile()
+  return profile
+
+
+def stop():
+  "Stops profiling the render in the current thread and returns its Profile, None if there was none"
+  profile = current()
+  _current.profile = None
+  return profile
+
+
+def current():
+  return getattr(_current, 'profile', None)
+
+
+def stage(name):
+  "Returns a context manager timing a stage of the render profiled in the current thread"
+  profile = current()
+  if profile is None:
+    return NO_STAGE
+  return Stage(profile, name)
+
+
+def count(name, number=1):
+  "Adds number to a count of the render profiled in the current thread"
+  profile = current()
+  if profile is not None:
+    profile.count(name, number)
+
+
+def timedChunks(chunks, profile, name, finish):
+  """Yields the chunks of a streamed response, timing their encoding as a stage
+  of profile, and calls finish() once the response is done.
+
+  The response is encoded after the render view returns, so profile is the one
+  of the current thread again while each chunk is encoded."""
+  try:
+    iterator = iter(chunks)
+    while True:
+      previous = current()
+      _current.profile = profile
+      profile.enter(name)
+      try:
+        chunk = next(iterator)
+      finally:
+        profile.exit()
+        _current.profile = previous
+      yield chunk
+  except StopIteration:
+    pass
+  finally:
+    finish()
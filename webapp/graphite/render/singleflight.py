@@ -0,0 +1,141 @@
+"""Single-flight computation of the cached results of renders.
+
+When a popular cache entry expires, every render asking for it at that time
+misses, and each of them would fetch and render the same result. cached()
+lets one of them compute it while the others wait: threads of a webapp
+process wait for the first of them, and processes wait for the one that added
+a lock key to the Django cache, polling the cache for its result.
+
+With STALE_CACHE_DURATION, entries are kept in the cache that much longer than
+their timeout. Expired entries are then served while one render refreshes
+them, instead of making everybody wait."""
+import threading
+from time import time, sleep
+from django.conf import settings
+from django.core.cache import cache
+from graphite.logger import log
+from graphite import instrumentation
+from graphite.render import tieredcache
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+
+POLL_INTERVAL = 0.05
+
+# Marks the entries kept for STALE_CACHE_DURATION with the time they expire
+ENVELOPE = 'singleflight'
+
+
+class Flight:
+  "A computation of a cache entry the other threads of the process wait for"
+  def __init__(self):
+    self.done = threading.Event()
+    self.followers = 0
+    self.result = None
+
+_flights = {}
+_flightsLock = threading.Lock()
+
+
+def cached(key, compute, timeout, name='Cache'):
+  """Returns the value cached under key, or else the one compute() returns,
+  which is cached for timeout seconds unless it is false.
+
+  Values go through pickle before other renders get them, as they do through
+  the cache, so each render may change the one it gets."""
+  (value, fresh) = lookup(key)
+  if fresh:
+    log.cache('%s hit [%s]' % (name, key))
+    instrumentation.increment('cache_lookups_total', cache=name, result='hit')
+    return value
+  instrumentation.increment('cache_lookups_total', cache=name, result='stale' if value is not None else 'miss')
+  if settings.SINGLE_FLIGHT_TIMEOUT <= 0:
+    log.cache('%s miss [%s]' % (name, key))
+    return store(key, compute(), timeout)
+
+  with _flightsLock:
+    flight = _flights.get(key)
+    if flight is None:
+      flight = _flights[key] = Flight()
+      leader = True
+    else:
+      flight.followers += 1
+      leader = False
+
+  if not leader:
+    if value is not None:
+      log.cache('%s stale hit [%s], another render refreshes it' % (name, key))
+      return value
+    log.cache('%s miss [%s], waiting for another render' % (name, key))
+    flight.done.wait(settings.SINGLE_FLIGHT_TIMEOUT)
+    if flight.result is not None:
+      return pickle.loads(flight.result)
+    return store(key, compute(), timeout)
+
+  result = None
+  try:
+    result = lead(key, value, compute, timeout, name)
+    return result
+  finally:
+    with _flightsLock:
+      del _flights[key]
+    # No more followers can join once the flight is gone
+    if flight.followers and result:
+      flight.result = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    flight.done.set()
+
+
+def lead(key, value, compute, timeout, name):
+  "Computes the value of key for the threads of this process, unless another process does"
+  lockKey = key + ':lock'
+  if cache.add(lockKey, True, settings.SINGLE_FLIGHT_TIMEOUT):
+    log.cache('%s miss [%s]' % (name, key))
+    try:
+      return store(key, compute(), timeout)
+    finally:
+      cache.delete(lockKey)
+
+  if value is not None:
+    log.cache('%s stale hit [%s], another process refreshes it' % (name, key))
+    return value
+
+  log.cache('%s miss [%s], waiting for another process' % (name, key))
+  deadline = time() + settings.SINGLE_FLIGHT_TIMEOUT
+  while time() < deadline:
+    sleep(POLL_INTERVAL)
+    entries = tieredcache.get_many([key, lockKey])
+    (value, fresh) = unwrap(entries.get(key))
+    if fresh:
+      return value
+    if lockKey not in entries:
+      break
+
+  return store(key, compute(), timeout)
+
+
+def lookup(key):
+  "Returns the value cached under key, None if there is none, and whether it is fresh"
+  return unwrap(tieredcache.get(key))
+
+
+def unwrap(entry):
+  if entry.__class__ is tuple and len(entry) == 3 and entry[0] == ENVELOPE:
+    (marker, expires, value) = entry
+    return (value, time() < expires)
+  if entry:
+    return (entry, True)
+  return (None, False)
+
+
+def store(key, value, timeout):
+  "Caches value under key for timeout seconds, unless it is false, and returns it"
+  if value:
+    # Only fresh values are kept in the memory of the process
+    if settings.STALE_CACHE_DURATION > 0:
+      tieredcache.set(key, (ENVELOPE, time() + timeout, value), timeout + settings.STALE_CACHE_DURATION, timeout)
+    else:
+      tieredcache.set(key, value, timeout)
+  return value
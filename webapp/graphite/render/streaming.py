@@ -0,0 +1,88 @@
+"""Encoders writing render results a chunk at a time.
+
+Each encoder is a generator of strings that add up to the same bytes the
+render view used to build as one string, so responses can be streamed series
+by series and, for long series, a few thousand points at a time instead of
+holding several copies of the data in memory."""
+import csv
+from cStringIO import StringIO
+from datetime import datetime
+from itertools import islice, izip
+from graphite.util import json
+
+
+POINTS_PER_CHUNK = 4096
+
+DATAPOINTS = '"datapoints": []'
+
+
+def chunked(iterable, size=None):
+  "Yields lists of up to size items of iterable, POINTS_PER_CHUNK by default"
+  size = size or POINTS_PER_CHUNK
+  iterator = iter(iterable)
+  while True:
+    chunk = list(islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk
+
+
+def jsonChunks(seriesTimestamps, jsonp=None):
+  """Encodes (series, timestamps) pairs as json.dumps() does a list of
+  dict(target=series.name, datapoints=zip(series, timestamps))"""
+  if jsonp is not None:
+    yield '%s(' % jsonp
+  yield '['
+
+  for (i, (series, timestamps)) in enumerate(seriesTimestamps):
+    if i:
+      yield ', '
+    # json.dumps() decides where the datapoints go among the keys
+    head = json.dumps(dict(target=series.name, datapoints=[]))
+    split = head.index(DATAPOINTS)
+    yield head[:split] + DATAPOINTS[:-1]
+    for (j, datapoints) in enumerate(chunked(izip(series, timestamps))):
+      encoded = json.dumps(datapoints)
+      if j:
+        yield ', ' + encoded[1:-1]
+      else:
+        yield encoded[1:-1]
+    yield DATAPOINTS[-1:] + head[split + len(DATAPOINTS):]
+
+  yield ']'
+  if jsonp is not None:
+    yield ')'
+
+
+def csvChunks(data, tzinfo):
+  "Encodes data as rows of series name, formatted timestamp and value"
+  buffer = StringIO()
+  writer = csv.writer(buffer, dialect='excel')
+  # Series mostly share their timestamps, which are formatted once
+  formatted = {}
+
+  for series in data:
+    for chunk in chunked(enumerate(series)):
+      rows = []
+      for (i, value) in chunk:
+        timestamp = series.start + (i * series.step)
+        text = formatted.get(timestamp)
+        if text is None:
+          text = formatted[timestamp] = datetime.fromtimestamp(timestamp, tzinfo).strftime("%Y-%m-%d %H:%M:%S")
+        rows.append( (series.name, text, value) )
+      writer.writerows(rows)
+      yield buffer.getvalue()
+      buffer.seek(0)
+      buffer.truncate()
+
+
+def rawChunks(data):
+  "Encodes data as a line of name, start, end, step and values per series"
+  for series in data:
+    yield "%s,%d,%d,%d|" % (series.name, series.start, series.end, series.step)
+    for (i, values) in enumerate(chunked(series)):
+      if i:
+        yield ',' + ','.join(map(str, values))
+      else:
+        yield ','.join(map(str, values))
+    yield '\n'
@@ -0,0 +1,189 @@
+"""A cache tier in the memory of each webapp process, in front of the Django cache.
+
+With LOCAL_CACHE_MAX_BYTES, each process keeps up to that many bytes of the
+values renders cache, pickled, and serves hot dashboards their graphs, series
+and finds without a round trip to memcached. The least recently used values
+are dropped first. Values written to the Django cache carry the time they
+expire, so a process keeps the values it reads from there only as long as
+the Django cache does.
+
+With CACHE_COMPRESSION_MIN_BYTES, values that pickle to at least that many
+bytes are compressed with zlib before they are written to the Django cache.
+
+While both are disabled, values go to the Django cache as they are."""
+import threading
+import zlib
+from collections import OrderedDict
+from multiprocessing.util import register_after_fork
+from time import time
+from django.conf import settings
+from django.core.cache import cache
+from graphite import instrumentation
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+
+# Marks the values written to the Django cache with the time they expire
+ENVELOPE = 'tieredcache'
+
+COMPRESSION_LEVEL = 1
+
+
+class Counters:
+  "Hits, misses and bytes read and written of a cache tier"
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self.bytesRead = 0
+    self.bytesWritten = 0
+
+  def asDict(self):
+    return dict(hits=self.hits, misses=self.misses, bytesRead=self.bytesRead, bytesWritten=self.bytesWritten)
+
+
+class LocalCache:
+  "Pickled values by key, up to LOCAL_CACHE_MAX_BYTES of them, the least recently used dropped first"
+  def __init__(self):
+    self.entries = OrderedDict()
+    self.size = 0
+    self.lock = threading.Lock()
+    self.counters = Counters()
+    # Render workers may be forked while another thread holds the lock
+    register_after_fork(self, LocalCache.resetLock)
+
+  def resetLock(self):
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None:
+        return None
+      (expires, data) = entry
+      if expires <= time():
+        self.size -= len(data)
+        return None
+      self.entries[key] = entry
+      return data
+
+  def set(self, key, data, expires):
+    maxBytes = settings.LOCAL_CACHE_MAX_BYTES
+    with self.lock:
+      self.discard(key)
+      if len(data) > maxBytes:
+        return
+      self.entries[key] = (expires, data)
+      self.size += len(data)
+      while self.size > maxBytes:
+        (oldest, (oldestExpires, oldestData)) = self.entries.popitem(last=False)
+        self.size -= len(oldestData)
+
+  def discard(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.size -= len(entry[1])
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+local = LocalCache()
+shared = Counters()
+
+
+def enabled():
+  return settings.LOCAL_CACHE_MAX_BYTES > 0 or settings.CACHE_COMPRESSION_MIN_BYTES > 0
+
+
+def get(key):
+  "Returns the value cached under key, None if there is none"
+  return get_many([key]).get(key)
+
+
+def get_many(keys):
+  "Returns the values cached under keys, by key, looking them up in this process first"
+  values = {}
+  missing = keys
+  if settings.LOCAL_CACHE_MAX_BYTES > 0:
+    missing = []
+    for key in keys:
+      data = local.get(key)
+      if data is None:
+        missing.append(key)
+        continue
+      local.counters.hits += 1
+      local.counters.bytesRead += len(data)
+      values[key] = pickle.loads(data)
+    local.counters.misses += len(missing)
+
+  if missing:
+    entries = cache.get_many(missing)
+    shared.hits += len(entries)
+    shared.misses += len(missing) - len(entries)
+    for (key, entry) in entries.items():
+      values[key] = unwrap(key, entry)
+
+  return values
+
+
+def unwrap(key, entry):
+  # Values in the Django cache from before either tier was enabled carry no envelope
+  if entry.__class__ is not tuple or len(entry) != 4 or entry[0] != ENVELOPE:
+    return entry
+  (marker, expires, compressed, data) = entry
+  shared.bytesRead += len(data)
+  if compressed:
+    data = zlib.decompress(data)
+  if settings.LOCAL_CACHE_MAX_BYTES > 0 and expires > time():
+    local.set(key, data, expires)
+  return pickle.loads(data)
+
+
+def set(key, value, timeout, localTimeout=None):
+  """Caches value under key for timeout seconds, and in this process for
+  localTimeout of them if given"""
+  set_many({key: value}, timeout, localTimeout)
+
+
+def set_many(values, timeout, localTimeout=None):
+  "Caches the values by key for timeout seconds, and in this process for localTimeout of them if given"
+  if not enabled():
+    cache.set_many(values, timeout)
+    return
+
+  if localTimeout is None:
+    localTimeout = timeout
+  expires = time() + localTimeout
+  entries = {}
+  for (key, value) in values.items():
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if settings.LOCAL_CACHE_MAX_BYTES > 0:
+      local.set(key, data, expires)
+      local.counters.bytesWritten += len(data)
+    compressed = 0 < settings.CACHE_COMPRESSION_MIN_BYTES <= len(data)
+    if compressed:
+      data = zlib.compress(data, COMPRESSION_LEVEL)
+    shared.bytesWritten += len(data)
+    entries[key] = (ENVELOPE, expires, compressed, data)
+  cache.set_many(entries, timeout)
+
+
+def stats():
+  "Returns the counters of both tiers, and the size of the one in this process"
+  return dict(local=dict(local.counters.asDict(), entries=len(local.entries), size=local.size),
+              shared=shared.asDict())
+
+
+def collectMetrics():
+  for (tier, counters) in (('local', local.counters), ('shared', shared)):
+    yield ('counter', 'cache_tier_hits_total', dict(tier=tier), counters.hits)
+    yield ('counter', 'cache_tier_misses_total', dict(tier=tier), counters.misses)
+    yield ('counter', 'cache_tier_read_bytes_total', dict(tier=tier), counters.bytesRead)
+    yield ('counter', 'cache_tier_written_bytes_total', dict(tier=tier), counters.bytesWritten)
+  yield ('gauge', 'cache_tier_size_bytes', dict(tier='local'), local.size)
+
+instrumentation.addCollector(collectMetrics)
@@ -11,7 +11,6 @@ distributed under the License is distributed on an "AS IS" BASIS,
 WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
-import csv
 import math
 from datetime import datetime
 from time import time
@@ -31,29 +30,70 @@ try:  # See if there is a system installation of pytz first
 except ImportError:  # Otherwise we fall back to Graphite's bundled version
   from graphite.thirdparty import pytz
 
-from graphite.util import getProfileByUsername, json, unpickle
+from graphite.util import getProfileByUsername, json, unpickle, epoch
+from graphite import wireformat, instrumentation
 from graphite.remote_storage import HTTPConnectionWithTimeout, extractForwardHeaders
 from graphite.logger import log
-from graphite.render.evaluator import evaluateTarget, extractPathExpressions
-from graphite.render.datalib import prefetchRemoteData
+from graphite.render.evaluator import evaluateTarget, evaluateTargets, downsamplingSafe
+from graphite.render.datalib import FetchMemo
+from graphite.render.pool import getRenderPool, evaluateTargetsInPool
 from graphite.render.attime import parseATTime
 from graphite.render.functions import PieFunctions
 from graphite.render.hashing import hashRequest, hashData
+from graphite.render import singleflight, profiling
+from graphite.render.profiling import stage
 from graphite.render.glyph import GraphTypes
+from graphite.render.streaming import jsonChunks, csvChunks, rawChunks
 from graphite.storage import STORE
 
 from django.http import HttpResponse, HttpResponseServerError, HttpResponseRedirect
+try:
+  from django.http import StreamingHttpResponse
+except ImportError: # Django < 1.5 streams iterators given to HttpResponse
+  StreamingHttpResponse = HttpResponse
 from django.template import Context, loader
-from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
 from django.conf import settings
 from django.utils.timezone import get_current_timezone
 from django.utils.cache import add_never_cache_headers, patch_response_headers
 
 
+# Formats of line graph data rather than graph images
+DataFormats = ('csv', 'json', 'raw', 'pickle')
+ImageFormats = ('png', 'svg', 'pdf')
+
+# Seconds the step of the data of a graph is remembered for its cache keys
+STEP_HINT_DURATION = 86400
+
+
 def renderView(request):
   start = time()
-  (graphOptions, requestOptions) = parseOptions(request)
+  format = request.REQUEST.get('format', 'png')
+  if format not in DataFormats and format not in ImageFormats:
+    format = 'other'
+  try:
+    showProfile = request.REQUEST.get('profile') in ('1', 'true')
+    if not showProfile and settings.SLOW_QUERY_THRESHOLD <= 0:
+      return renderCached(request, start)
+
+    profile = profiling.start()
+    try:
+      response = renderCached(request, start)
+    finally:
+      profiling.stop()
+    return profiledResponse(request, response, profile, showProfile)
+  except:
+    instrumentation.increment('render_errors_total', format=format)
+    raise
+  finally:
+    instrumentation.observe('render_duration_seconds', time() - start, format=format)
+
+
+def renderCached(request, start):
+  "Returns the response to a render request, from the request cache when it has one"
+  with stage('parse'):
+    (graphOptions, requestOptions) = parseOptions(request)
   useCache = 'noCache' not in requestOptions
   cacheTimeout = requestOptions['cacheTimeout']
   requestContext = {
@@ -65,18 +105,80 @@ def renderView(request):
     'prefetchedRemoteData' : {},
     'data' : []
   }
-  data = requestContext['data']
+  if settings.DOWNSAMPLE_READS:
+    maxDataPoints = resolutionHint(graphOptions, requestOptions)
+    if maxDataPoints:
+      requestContext['maxDataPoints'] = maxDataPoints
+  if settings.MEMOIZE_FETCHES:
+    requestContext['fetchMemo'] = FetchMemo(requestContext.get('maxDataPoints'))
+
+  # First we check the request cache, only graphs are cached there
+  if useCache and (requestOptions['graphType'] == 'pie' or requestOptions.get('format') not in DataFormats):
+    (requestKey, stepKey, granularity) = requestCacheKey(request, requestOptions)
+    render = lambda: renderRequest(graphOptions, requestOptions, requestContext, start)
+    response = singleflight.cached(requestKey, render, cacheTimeout, 'Request-Cache')
+    patch_response_headers(response, cache_timeout=cacheTimeout)
+
+    # Remember the step of the data for the keys of the next requests
+    if requestOptions['graphType'] == 'line' and requestContext['data']:
+      step = min(series.step for series in requestContext['data'])
+      if step != granularity:
+        cache.set(stepKey, step, STEP_HINT_DURATION)
+    return response
+
+  return renderRequest(graphOptions, requestOptions, requestContext, start)
+
+
+def profiledResponse(request, response, profile, showProfile):
+  """Returns response with the profile of its render in a header if the request
+  asked for it, and logs the render once it is done if it took more than
+  SLOW_QUERY_THRESHOLD seconds"""
+  profiled = []
+  def finish():
+    profiled.append(profile.asDict())
+    threshold = settings.SLOW_QUERY_THRESHOLD
+    if threshold > 0 and profiled[0]['total'] >= threshold:
+      log.slow_query(json.dumps(dict(profiled[0], time=int(profile.started), url=request.get_full_path())))
+
+  if getattr(response, 'streaming', False):
+    chunks = profiling.timedChunks(response.streaming_content, profile, 'serialization', finish)
+    if not showProfile:
+      response.streaming_content = chunks
+      return response
+
+    # Headers go out before the content, which is encoded here to be timed
+    streamed = response
+    response = HttpResponse(''.join(chunks))
+    for (header, value) in streamed.items():
+      response[header] = value
+  else:
+    finish()
+
+  if showProfile:
+    response['X-Graphite-Profile'] = json.dumps(profiled[0])
+  return response
 
-  # First we check the request cache
-  if useCache:
-    requestKey = hashRequest(request)
-    cachedResponse = cache.get(requestKey)
-    if cachedResponse:
-      log.cache('Request-Cache hit [%s]' % requestKey)
-      log.rendering('Returned cached response in %.6f' % (time() - start))
-      return cachedResponse
-    else:
-      log.cache('Request-Cache miss [%s]' % requestKey)
+
+def requestCacheKey(request, requestOptions):
+  """Returns the request cache key of a graph request, the cache key of the
+  step of its data and the granularity of its time range in the request key.
+
+  The time range is resolved and rounded down to the finest step of the data
+  the last render of the same graph fetched, or to RENDER_CACHE_GRANULARITY
+  seconds before there was one. Time ranges rounded down to the same step fetch
+  the same points of data at that step from whisper, so the graph a request gets
+  from the cache is the one it would render, as of the time it was cached."""
+  stepKey = 'step-' + hashRequest(request, ())
+  granularity = max(1, cache.get(stepKey) or settings.RENDER_CACHE_GRANULARITY)
+  window = [int(epoch(requestOptions[name])) // granularity * granularity for name in ('startTime', 'endTime', 'now')]
+  return (hashRequest(request, window), stepKey, granularity)
+
+
+def renderRequest(graphOptions, requestOptions, requestContext, start):
+  "Renders the response to a request the request cache has no response for"
+  useCache = 'noCache' not in requestOptions
+  cacheTimeout = requestOptions['cacheTimeout']
+  data = requestContext['data']
 
   # Now we prepare the requested data
   if requestOptions['graphType'] == 'pie':
@@ -101,46 +203,17 @@ def renderView(request):
       targets = requestOptions['targets']
       startTime = requestOptions['startTime']
       endTime = requestOptions['endTime']
-      dataKey = hashData(targets, startTime, endTime, STORE.local_host)
-      cachedData = cache.get(dataKey)
-      if cachedData:
-        log.cache("Data-Cache hit [%s]" % dataKey)
-      else:
-        log.cache("Data-Cache miss [%s]" % dataKey)
-    else:
-      cachedData = None
-
-    if cachedData is not None:
-      requestContext['data'] = data = cachedData
+      dataKey = hashData(targets, startTime, endTime, STORE.local_host, requestContext.get('maxDataPoints'))
+      evaluate = lambda: evaluateRequest(requestOptions, requestContext)
+      requestContext['data'] = data = singleflight.cached(dataKey, evaluate, cacheTimeout, 'Data-Cache')
     else: # Have to actually retrieve the data now
-      targets = requestOptions['targets']
-      if settings.REMOTE_PREFETCH_DATA:
-        t = time()
-        pathExpressions = extractPathExpressions(targets)
-        requestContext['prefetchedRemoteData'] = prefetchRemoteData(requestContext, pathExpressions)
-        log.rendering("Prefetching remote data took %.6f" % (time() - t))
-      for target in targets:
-        if not target.strip():
-          continue
-        t = time()
-        seriesList = evaluateTarget(requestContext, target)
-        log.rendering("Retrieval of %s took %.6f" % (target, time() - t))
-        data.extend(seriesList)
-
-      if useCache and data:
-        cache.add(dataKey, data, cacheTimeout)
+      data.extend( evaluateRequest(requestOptions, requestContext) )
+    profiling.count('series', len(data))
+    profiling.count('points', sum(len(series) for series in data))
 
     format = requestOptions.get('format')
     if format == 'csv':
-      response = HttpResponse(content_type='text/csv')
-      writer = csv.writer(response, dialect='excel')
-
-      for series in data:
-        for i, value in enumerate(series):
-          timestamp = datetime.fromtimestamp(series.start + (i * series.step), requestOptions['tzinfo'])
-          writer.writerow((series.name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), value))
-
-      return response
+      return StreamingHttpResponse(csvChunks(data, requestOptions['tzinfo']), content_type='text/csv')
 
     if format == 'json':
       series_data = []
@@ -162,23 +235,19 @@ def renderView(request):
             for r in range(1, valuesToLose):
               del series[0]
             series.consolidate(valuesPerPoint)
-            timestamps = range(int(series.start), int(series.end) + 1, int(secondsPerPoint))
+            timestamps = xrange(int(series.start), int(series.end) + 1, int(secondsPerPoint))
           else:
-            timestamps = range(int(series.start), int(series.end) + 1, int(series.step))
-          datapoints = zip(series, timestamps)
-          series_data.append(dict(target=series.name, datapoints=datapoints))
+            timestamps = xrange(int(series.start), int(series.end) + 1, int(series.step))
+          series_data.append( (series, timestamps) )
       else:
         for series in data:
-          timestamps = range(int(series.start), int(series.end) + 1, int(series.step))
-          datapoints = zip(series, timestamps)
-          series_data.append( dict(target=series.name, datapoints=datapoints) )
+          timestamps = xrange(int(series.start), int(series.end) + 1, int(series.step))
+          series_data.append( (series, timestamps) )
 
       if 'jsonp' in requestOptions:
-        response = HttpResponse(
-          content="%s(%s)" % (requestOptions['jsonp'], json.dumps(series_data)),
-          content_type='text/javascript')
+        response = StreamingHttpResponse(jsonChunks(series_data, requestOptions['jsonp']), content_type='text/javascript')
       else:
-        response = HttpResponse(content=json.dumps(series_data), content_type='application/json')
+        response = StreamingHttpResponse(jsonChunks(series_data), content_type='application/json')
 
       if useCache:
         patch_response_headers(response, cache_timeout=cacheTimeout)
@@ -187,14 +256,7 @@ def renderView(request):
       return response
 
     if format == 'raw':
-      response = HttpResponse(content_type='text/plain')
-      for series in data:
-        response.write( "%s,%d,%d,%d|" % (series.name, series.start, series.end, series.step) )
-        response.write( ','.join(map(str,series)) )
-        response.write('\n')
-
-      log.rendering('Total rawData rendering time %.6f' % (time() - start))
-      return response
+      return StreamingHttpResponse(rawChunks(data), content_type='text/plain')
 
     if format == 'svg':
       graphOptions['outputFormat'] = 'svg'
@@ -202,10 +264,20 @@ def renderView(request):
     if format == 'pdf':
       graphOptions['outputFormat'] = 'pdf'
 
+    if format == 'pickle' and requestOptions.get('wireFormat'):
+      try:
+        with stage('serialization'):
+          response = HttpResponse(wireformat.dumpSeries(data), content_type=wireformat.CONTENT_TYPE)
+        log.rendering('Total wire format rendering time %.6f' % (time() - start))
+        return response
+      except wireformat.WireFormatError, e:
+        log.rendering("Sending pickle, the series cannot be encoded in the wire format: %s" % e)
+
     if format == 'pickle':
       response = HttpResponse(content_type='application/pickle')
-      seriesInfo = [series.getInfo() for series in data]
-      pickle.dump(seriesInfo, response, protocol=-1)
+      with stage('serialization'):
+        seriesInfo = [series.getInfo() for series in data]
+        pickle.dump(seriesInfo, response, protocol=-1)
 
       log.rendering('Total pickle rendering time %.6f' % (time() - start))
       return response
@@ -214,30 +286,61 @@ def renderView(request):
   # We've got the data, now to render it
   graphOptions['data'] = data
   if settings.REMOTE_RENDERING: # Rendering on other machines is faster in some situations
-    image = delegateRendering(requestOptions['graphType'], graphOptions, requestContext['forwardHeaders'])
+    with stage('render.remote'):
+      image = delegateRendering(requestOptions['graphType'], graphOptions, requestContext['forwardHeaders'])
   else:
-    image = doImageRender(requestOptions['graphClass'], graphOptions)
+    with stage('render.cairo'):
+      image = doImageRender(requestOptions['graphClass'], graphOptions)
 
   useSVG = graphOptions.get('outputFormat') == 'svg'
   if useSVG and 'jsonp' in requestOptions:
-    response = HttpResponse(
-      content="%s(%s)" % (requestOptions['jsonp'], json.dumps(image)),
-      content_type='text/javascript')
+    with stage('serialization'):
+      content = "%s(%s)" % (requestOptions['jsonp'], json.dumps(image))
+    response = HttpResponse(content=content, content_type='text/javascript')
   elif graphOptions.get('outputFormat') == 'pdf':
     response = buildResponse(image, 'application/x-pdf')
   else:
     response = buildResponse(image, useSVG and 'image/svg+xml' or 'image/png')
 
-  if useCache:
-    cache.add(requestKey, response, cacheTimeout)
-    patch_response_headers(response, cache_timeout=cacheTimeout)
-  else:
+  if not useCache:
     add_never_cache_headers(response)
 
   log.rendering('Total rendering time %.6f seconds' % (time() - start))
   return response
 
 
+def evaluateRequest(requestOptions, requestContext):
+  "Returns the series of the targets of a line graph request"
+  targets = [target for target in requestOptions['targets'] if target.strip()]
+  pool = getRenderPool()
+  if pool and len(targets) > 1:
+    with stage('evaluate.workers'):
+      return evaluateTargetsInPool(pool, requestContext, targets)
+  return evaluateTargets(requestContext, targets)
+
+
+def resolutionHint(graphOptions, requestOptions):
+  """Returns the number of points per series a line render needs at most, which
+  lets storage read coarser archives, or None if it needs every point.
+
+  That is maxDataPoints when given, or the width of a graph image. Targets
+  calling functions that depend on every point being read get None."""
+  if requestOptions['graphType'] != 'line':
+    return None
+  if 'maxDataPoints' in requestOptions:
+    maxDataPoints = requestOptions['maxDataPoints']
+  elif requestOptions.get('format') in (None, 'png', 'svg', 'pdf'):
+    maxDataPoints = graphOptions['width']
+  else:
+    return None
+
+  if not isinstance(maxDataPoints, (int, long, float)) or maxDataPoints < 1:
+    return None
+  if not downsamplingSafe(requestOptions['targets']):
+    return None
+  return int(maxDataPoints)
+
+
 def parseOptions(request):
   queryParams = request.REQUEST
 
@@ -278,6 +381,8 @@ def parseOptions(request):
     requestOptions['format'] = queryParams['format']
     if 'jsonp' in queryParams:
       requestOptions['jsonp'] = queryParams['jsonp']
+  if 'wireFormat' in queryParams and queryParams['wireFormat'].isdigit():
+    requestOptions['wireFormat'] = int(queryParams['wireFormat'])
   if 'noCache' in queryParams:
     requestOptions['noCache'] = True
   if 'maxDataPoints' in queryParams and queryParams['maxDataPoints'].isdigit():
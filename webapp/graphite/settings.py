@@ -59,13 +59,34 @@ sys.path.append(THIRDPARTY_DIR)
 # Memcache settings
 MEMCACHE_HOSTS = []
 DEFAULT_CACHE_DURATION = 60 #metric data and graphs are cached for one minute by default
+SINGLE_FLIGHT_TIMEOUT = 30 #seconds renders wait for another one computing the same cache entry, 0 disables waiting
+STALE_CACHE_DURATION = 0 #seconds expired data and graphs are served while one render refreshes them
+RENDER_CACHE_GRANULARITY = 60 #seconds graph time ranges are rounded down to in cache keys until the step of their data is known
+LOCAL_CACHE_MAX_BYTES = 0 #bytes of cached values each webapp process keeps in memory in front of memcached, 0 disables
+CACHE_COMPRESSION_MIN_BYTES = 0 #cached values of at least this many bytes are compressed before going to memcached, 0 disables
 LOG_CACHE_PERFORMANCE = False
+DIRECTORY_CACHE_SIZE = 10000 #number of directory listings find() keeps in memory, 0 disables
+WHISPER_READER = 'whisper' #'mmap' decodes whisper files through memory maps, requires numpy
+LOCAL_FETCH_THREADS = 1 #threads fetching local data files concurrently, 1 fetches them serially
+TIMESERIES_BACKEND = 'list' #'array' keeps fetched series in float64 arrays
+MEMOIZE_FETCHES = True #renders fetch each path expression and time range once
+PARSED_TARGET_CACHE_SIZE = 10000 #number of parsed targets kept in memory, 0 disables
+RENDER_PROCESSES = 0 #worker processes evaluating the targets of renders, 0 evaluates them in the request thread
+RENDER_PROCESSES_PER_REQUEST = 2 #targets of one render evaluated on worker processes at a time
+RENDER_PROCESS_TIMEOUT = 60 #seconds a render waits for a target evaluated on a worker process
+DOWNSAMPLE_READS = False #read coarser whisper archives when renders need fewer points
+DATA_CHUNK_SIZE = 0 #seconds of whisper data per chunk kept in the cache, 0 disables
+DATA_CHUNK_SETTLE_TIME = 600 #seconds after which carbon is assumed to have written the points of a chunk
+DATA_CHUNK_CACHE_DURATION = 86400 #seconds chunks of whisper data are cached
 
 # Remote store settings
 REMOTE_STORE_FETCH_TIMEOUT = 6
 REMOTE_STORE_FIND_TIMEOUT = 2.5
 REMOTE_STORE_RETRY_DELAY = 60
 REMOTE_STORE_USE_POST = False
+REMOTE_STORE_USE_WIRE_FORMAT = False #ask remote webapps for the binary wire format instead of pickle
+REMOTE_STORE_POOL_SIZE = 4 #idle keep-alive connections kept per remote webapp, 0 disables reuse
+REMOTE_STORE_FANOUT = 'threads' #'eventloop' multiplexes remote requests on non-blocking sockets
 REMOTE_FIND_CACHE_DURATION = 300
 REMOTE_PREFETCH_DATA = False
 REMOTE_STORE_MERGE_RESULTS = True
@@ -81,10 +102,16 @@ LOG_RENDERING_PERFORMANCE = False
 CARBONLINK_HOSTS = ["127.0.0.1:7002"]
 CARBONLINK_TIMEOUT = 1.0
 CARBONLINK_QUERY_BULK = False
+CARBONLINK_QUERY_BULK_CHUNK_SIZE = 1000
 CARBONLINK_HASHING_TYPE = 'carbon_ch'
 DOCUMENTATION_URL = "http://graphite.readthedocs.org/"
 ALLOW_ANONYMOUS_CLI = True
 LOG_METRIC_ACCESS = False
+SLOW_QUERY_THRESHOLD = 0 #seconds after which renders are logged with their profile to slowquery.log, 0 disables
+INTERNAL_METRICS_DIR = '' #directory where webapp processes share their internal metrics, '' reports each process alone
+INTERNAL_METRICS_INTERVAL = 60 #seconds between writes of the internal metrics of a process and sends to carbon
+INTERNAL_METRICS_CARBON_SERVER = '' #host:port of a carbon plaintext receiver the internal metrics are sent to, '' disables
+INTERNAL_METRICS_CARBON_PREFIX = 'graphite.webapp.{host}'
 LEGEND_MAX_ITEMS = 10
 RRD_CF = 'AVERAGE'
 
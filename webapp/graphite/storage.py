@@ -1,4 +1,4 @@
-import os, time, fnmatch, socket, errno, re
+import os, time, socket, errno, re, mmap, struct
 from django.conf import settings
 from os.path import isdir, isfile, join, exists, splitext, basename, realpath
 import whisper
@@ -6,8 +6,8 @@ import Queue
 import threading
 
 from graphite.logger import log
-from graphite.remote_storage import RemoteStore
-from graphite.util import unpickle
+from graphite.remote_storage import RemoteStore, parallelFind
+from graphite.util import unpickle, LRUCache
 
 try:
   import rrdtool
@@ -19,6 +19,19 @@ try:
 except ImportError:
   gzip = False
 
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = False
+
+try:
+  import numpy
+except ImportError:
+  numpy = False
+
 try:
   import cPickle as pickle
 except ImportError:
@@ -27,6 +40,11 @@ except ImportError:
 
 DATASOURCE_DELIMETER = '::RRD_DATASOURCE::'
 EXPAND_BRACES_RE = re.compile(r'(\{([^\{\}]*)\})')
+COMPILED_PATTERNS = LRUCache(4096)
+WHISPER_HEADERS = LRUCache(10000)
+
+if numpy:
+  WHISPER_POINT = numpy.dtype([('interval', '>u4'), ('value', '>f8')])
 
 
 class Store:
@@ -63,6 +81,9 @@ class Store:
 
 
   def _parallel_remote_find(self, query, headers=None):
+    if settings.REMOTE_STORE_FANOUT == 'eventloop':
+      return parallelFind([ r for r in self.remote_stores if r.available ], query, headers)
+
     remote_finds = []
     results = []
     result_queue = Queue.Queue()
@@ -163,7 +184,7 @@ def find(root_dir, pattern):
   clean_pattern = pattern.replace('\\', '')
   pattern_parts = clean_pattern.split('.')
 
-  for absolute_path in _find(root_dir, pattern_parts):
+  for (absolute_path, is_dir) in _find(root_dir, pattern_parts):
 
     if DATASOURCE_DELIMETER in basename(absolute_path):
       (absolute_path,datasource_pattern) = absolute_path.rsplit(DATASOURCE_DELIMETER,1)
@@ -179,10 +200,10 @@ def find(root_dir, pattern):
       metric_path_parts[field_index] = pattern_parts[field_index].replace('\\', '')
     metric_path = '.'.join(metric_path_parts)
 
-    if isdir(absolute_path):
+    if is_dir:
       yield Branch(absolute_path, metric_path)
 
-    elif isfile(absolute_path):
+    else:
       (metric_path,extension) = splitext(metric_path)
 
       if extension == '.wsp':
@@ -200,66 +221,265 @@ def find(root_dir, pattern):
 
         else:
           for source in rrd.getDataSources():
-            if fnmatch.fnmatch(source.name, datasource_pattern):
+            if compile_pattern(datasource_pattern)(source.name):
               yield source
 
 
 def _find(current_dir, patterns):
-  """Recursively generates absolute paths whose components underneath current_dir
-  match the corresponding pattern in patterns"""
+  """Recursively generates (absolute_path, is_dir) tuples for the paths whose
+  components underneath current_dir match the corresponding pattern in patterns"""
   pattern = patterns[0]
   patterns = patterns[1:]
   try:
-    entries = os.listdir(current_dir)
+    listing = DIRECTORY_CACHE.listdir(current_dir)
   except OSError as e:
     log.exception(e)
-    entries = []
-
-  subdirs = [e for e in entries if isdir( join(current_dir,e) )]
-  matching_subdirs = match_entries(subdirs, pattern)
+    listing = DirectoryListing([], [])
 
   if len(patterns) == 1 and rrdtool: #the last pattern may apply to RRD data sources
-    files = [e for e in entries if isfile( join(current_dir,e) )]
-    rrd_files = match_entries(files, pattern + ".rrd")
+    rrd_files = listing.match_files(pattern + ".rrd")
 
     if rrd_files: #let's assume it does
       datasource_pattern = patterns[0]
 
       for rrd_file in rrd_files:
         absolute_path = join(current_dir, rrd_file)
-        yield absolute_path + DATASOURCE_DELIMETER + datasource_pattern
+        yield (absolute_path + DATASOURCE_DELIMETER + datasource_pattern, False)
 
   if patterns: #we've still got more directories to traverse
-    for subdir in matching_subdirs:
+    for subdir in listing.match_subdirs(pattern):
 
       absolute_path = join(current_dir, subdir)
       for match in _find(absolute_path, patterns):
         yield match
 
   else: #we've got the last pattern
-    files = [e for e in entries if isfile( join(current_dir,e) )]
-    matching_files = match_entries(files, pattern + '.*')
+    for basename in listing.match_metric_files(pattern):
+      yield (join(current_dir, basename), False)
+    for basename in listing.match_subdirs(pattern):
+      yield (join(current_dir, basename), True)
+
+
+class DirectoryListing:
+  """The names of the subdirectories and files directly beneath a directory.
+
+  Glob patterns are matched with compile_pattern(), plain names are looked up
+  in indexes built the first time they are needed."""
+  def __init__(self, subdirs, files):
+    self.subdirs = subdirs
+    self.files = files
+    self.subdir_names = None
+    self.file_names = None
+    self.files_by_metric = None
+
+  def match_subdirs(self, pattern):
+    if is_pattern(pattern):
+      return iter_matching_entries(self.subdirs, pattern)
+
+    if self.subdir_names is None:
+      self.subdir_names = frozenset(self.subdirs)
+    return [pattern] if pattern in self.subdir_names else []
+
+  def match_files(self, pattern):
+    if is_pattern(pattern):
+      return match_entries(self.files, pattern)
+
+    if self.file_names is None:
+      self.file_names = frozenset(self.files)
+    return [pattern] if pattern in self.file_names else []
+
+  def match_metric_files(self, pattern):
+    "Matches the files named after pattern plus an extension, ie. pattern + '.*'"
+    if is_pattern(pattern):
+      return iter_matching_entries(self.files, pattern + '.*')
+
+    if self.files_by_metric is None:
+      files_by_metric = {}
+      for name in self.files:
+        if '.' in name:
+          files_by_metric.setdefault(name.split('.', 1)[0], []).append(name)
+      self.files_by_metric = files_by_metric
+    return self.files_by_metric.get(pattern, [])
+
+
+class DirectoryCache:
+  """Process-wide cache of directory listings used by find().
+
+  Each listing remembers the directory's mtime and is only revalidated (with a
+  single stat) when that directory is visited again. Creating, removing or
+  renaming an entry updates the mtime of its parent, so a changed directory is
+  listed again while unchanged ones cost no further syscalls."""
+
+  # Listings of directories modified this recently are not cached, a second
+  # change within the filesystem's timestamp granularity would go unnoticed
+  racy_interval = 1.0
+
+  def __init__(self, max_size):
+    self.listings = LRUCache(max_size)
+
+  def listdir(self, path):
+    "Returns the DirectoryListing of path"
+    if self.listings.max_size <= 0:
+      return _listdir(path)
 
-    for basename in matching_files + matching_subdirs:
-      yield join(current_dir, basename)
+    try:
+      mtime = os.stat(path).st_mtime
+    except OSError:
+      self.listings.pop(path)
+      raise
+
+    cached = self.listings.get(path)
+    if cached is not None and cached[0] == mtime:
+      return cached[1]
+
+    listing = _listdir(path)
+    if time.time() - mtime > self.racy_interval:
+      self.listings.set(path, (mtime, listing))
+    else:
+      self.listings.pop(path)
+    return listing
 
+  def clear(self):
+    self.listings.clear()
 
-def _deduplicate(entries):
-  yielded = set()
-  for entry in entries:
-    if entry not in yielded:
-      yielded.add(entry)
-      yield entry
+
+def _listdir(path):
+  """Returns the DirectoryListing of path.
+
+  Entries are classified in a single pass over the directory using the file
+  type reported by readdir(), only symlinks (and filesystems that do not report
+  a type) need an extra stat. Falls back to listdir() plus a stat per entry when
+  no scandir implementation is available."""
+  subdirs = []
+  files = []
+
+  if not scandir:
+    for entry in os.listdir(path):
+      absolute_path = join(path, entry)
+      if isdir(absolute_path):
+        subdirs.append(entry)
+      elif isfile(absolute_path):
+        files.append(entry)
+    return DirectoryListing(subdirs, files)
+
+  for entry in scandir(path):
+    try:
+      if entry.is_dir():
+        subdirs.append(entry.name)
+      elif entry.is_file():
+        files.append(entry.name)
+    except OSError: #dangling symlink or entry removed while scanning
+      continue
+  return DirectoryListing(subdirs, files)
 
 
 def match_entries(entries, pattern):
-  # First we check for pattern variants (ie. {foo,bar}baz = foobaz or barbaz)
-  matching = []
+  return list(iter_matching_entries(entries, pattern))
+
 
-  for variant in expand_braces(pattern):
-    matching.extend(fnmatch.filter(entries, variant))
+def iter_matching_entries(entries, pattern):
+  "Lazily generates the entries matching pattern, in the order they are given"
+  matcher = compile_pattern(pattern)
 
-  return list(_deduplicate(matching))
+  for entry in entries:
+    if matcher(entry):
+      yield entry
+
+
+def compile_pattern(pattern):
+  """Returns a function that tells whether a name matches the glob pattern.
+
+  Brace groups (ie. {foo,bar}baz = foobaz or barbaz) become alternations of a
+  single regular expression instead of being expanded into every variant, so
+  matching a name costs one regex call however many variants there are.
+  Compiled patterns are shared by every caller through an LRU cache."""
+  matcher = COMPILED_PATTERNS.get(pattern)
+  if matcher is None:
+    if is_pattern(pattern):
+      matcher = re.compile(_translate_pattern(pattern) + r'\Z', re.DOTALL).match
+    else:
+      matcher = lambda name: name == pattern
+    COMPILED_PATTERNS.set(pattern, matcher)
+  return matcher
+
+
+def _translate_pattern(pattern):
+  if '[' in pattern and '{' in pattern:
+    # A character class could straddle a brace group, let expand_braces sort it out
+    return '(?:%s)' % '|'.join(_translate_glob(variant) for variant in expand_braces(pattern))
+
+  # Pair up the braces like expand_braces does, unbalanced ones are literals
+  groups = {}
+  opened = []
+  for (i, char) in enumerate(pattern):
+    if char == '{':
+      opened.append(i)
+    elif char == '}' and opened:
+      groups[opened.pop()] = i
+
+  return _translate_braces(pattern, 0, len(pattern), groups)
+
+
+def _translate_braces(pattern, start, end, groups):
+  parts = []
+  literal_start = i = start
+  while i < end:
+    if i not in groups:
+      i += 1
+      continue
+
+    parts.append(_translate_glob(pattern[literal_start:i]))
+    close = groups[i]
+    alternatives = []
+    alternative_start = j = i + 1
+    while j < close:
+      if j in groups: #commas of nested groups belong to them
+        j = groups[j] + 1
+        continue
+      if pattern[j] == ',':
+        alternatives.append(_translate_braces(pattern, alternative_start, j, groups))
+        alternative_start = j + 1
+      j += 1
+    alternatives.append(_translate_braces(pattern, alternative_start, close, groups))
+    parts.append('(?:%s)' % '|'.join(alternatives))
+    literal_start = i = close + 1
+
+  parts.append(_translate_glob(pattern[literal_start:end]))
+  return ''.join(parts)
+
+
+def _translate_glob(pattern):
+  "Same as fnmatch.translate() but without the end of string anchor"
+  i, n = 0, len(pattern)
+  res = ''
+  while i < n:
+    c = pattern[i]
+    i += 1
+    if c == '*':
+      res += '.*'
+    elif c == '?':
+      res += '.'
+    elif c == '[':
+      j = i
+      if j < n and pattern[j] == '!':
+        j += 1
+      if j < n and pattern[j] == ']':
+        j += 1
+      while j < n and pattern[j] != ']':
+        j += 1
+      if j >= n:
+        res += '\\['
+      else:
+        stuff = pattern[i:j].replace('\\', '\\\\')
+        i = j + 1
+        if stuff[0] == '!':
+          stuff = '^' + stuff[1:]
+        elif stuff[0] == '^':
+          stuff = '\\' + stuff
+        res = '%s[%s]' % (res, stuff)
+    else:
+      res += re.escape(c)
+  return res
 
 
 """
@@ -305,7 +525,7 @@ class Node:
 
 class Branch(Node):
   "Node with children"
-  def fetch(self, startTime, endTime, now=None):
+  def fetch(self, startTime, endTime, now=None, maxDataPoints=None):
     "No-op to make all Node's fetch-able"
     return []
 
@@ -326,13 +546,27 @@ class WhisperFile(Leaf):
 
   def __init__(self, *args, **kwargs):
     Leaf.__init__(self, *args, **kwargs)
+    # Resolving symlinks costs an lstat per path component, so real_metric
+    # is only computed once somebody asks for it
+    del self.real_metric
+    self.cached_real_metric = None
+
+  @property
+  def real_metric(self):
+    if self.cached_real_metric is not None:
+      return self.cached_real_metric
+
+    real_metric = self.metric_path
     real_fs_path = realpath(self.fs_path)
 
     if real_fs_path != self.fs_path:
       relative_fs_path = self.metric_path.replace('.', '/') + self.extension
       base_fs_path = realpath(self.fs_path[ :-len(relative_fs_path) ])
       relative_real_fs_path = real_fs_path[ len(base_fs_path)+1: ]
-      self.real_metric = relative_real_fs_path[ :-len(self.extension) ].replace('/', '.')
+      real_metric = relative_real_fs_path[ :-len(self.extension) ].replace('/', '.')
+
+    self.cached_real_metric = real_metric
+    return real_metric
 
   def getIntervals(self):
     start = time.time() - whisper.info(self.fs_path)['maxRetention']
@@ -340,9 +574,22 @@ class WhisperFile(Leaf):
     return [ (start, end) ]
 
   def getInfo(self):
+    if settings.WHISPER_READER == 'mmap' and numpy:
+      return whisper_mmap_info(self.fs_path)
     return whisper.info(self.fs_path)
 
-  def fetch(self, startTime, endTime, now=None):
+  def fetch(self, startTime, endTime, now=None, maxDataPoints=None):
+    """Reads the time range from the archive whisper.fetch() would read it from,
+    or from a coarser one when maxDataPoints points are enough, see
+    whisper_fetch_window()"""
+    if settings.WHISPER_READER == 'mmap' and numpy:
+      result = whisper_mmap_fetch(self.fs_path, startTime, endTime, now, maxDataPoints)
+      if result is None:
+        return None
+      (timeInfo, values, nulls) = result
+      return (timeInfo, value_list(values, nulls))
+    if maxDataPoints:
+      return whisper_downsampled_fetch(self.fs_path, startTime, endTime, now, maxDataPoints)
     return whisper.fetch(self.fs_path, startTime, endTime, now)
 
   @property
@@ -371,10 +618,228 @@ class WhisperFile(Leaf):
     fh.close()
 
 
+# Memory-mapped whisper reader (WHISPER_READER = 'mmap')
+def whisper_mmap_info(path):
+  "Same as whisper.info() but served from the header cache when the file is unchanged"
+  with open(path, 'rb') as fh:
+    data = _mmap_whisper_file(fh, path)
+    try:
+      return _whisper_mmap_header(data, path, os.fstat(fh.fileno()))
+    finally:
+      data.close()
+
+
+def whisper_mmap_fetch(path, fromTime, untilTime=None, now=None, maxDataPoints=None):
+  """Memory-mapped equivalent of whisper.fetch().
+
+  The archive slice is decoded straight from the mapped file into numpy arrays
+  instead of being read, unpacked into a tuple and copied into a list point by
+  point. Returns a ((fromInterval, untilInterval, step), values, nulls) tuple
+  where values is a float64 array and nulls a boolean array flagging the missing
+  points, or None if no data can be returned."""
+  with open(path, 'rb') as fh:
+    data = _mmap_whisper_file(fh, path)
+    try:
+      header = _whisper_mmap_header(data, path, os.fstat(fh.fileno()))
+      return _whisper_mmap_fetch(data, header, fromTime, untilTime, now, maxDataPoints)
+    finally:
+      data.close()
+
+
+def value_list(values, nulls):
+  "Turns the values and nulls arrays of whisper_mmap_fetch() into a list of floats and Nones"
+  valueList = values.astype(object)
+  valueList[nulls] = None
+  return valueList.tolist()
+
+
+def _mmap_whisper_file(fh, path):
+  try:
+    return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+  except ValueError: #empty file
+    raise whisper.CorruptWhisperFile("Unable to read header", path)
+
+
+def _whisper_mmap_header(data, path, stat):
+  # Keyed by inode and validated by size, as carbon changes the mtime with
+  # every write but only a resize or a recreated file changes the archives.
+  # A new aggregation method or xFilesFactor set in place is not seen until
+  # the header is evicted, which only matters to writers.
+  key = (stat.st_dev, stat.st_ino)
+  cached = WHISPER_HEADERS.get(key)
+  if cached is not None and cached[0] == stat.st_size:
+    return cached[1]
+
+  try:
+    (aggregationType,maxRetention,xff,archiveCount) = struct.unpack_from(whisper.metadataFormat, data, 0)
+  except struct.error:
+    raise whisper.CorruptWhisperFile("Unable to read header", path)
+
+  archives = []
+  for i in xrange(archiveCount):
+    try:
+      offset = whisper.metadataSize + (i * whisper.archiveInfoSize)
+      (offset,secondsPerPoint,points) = struct.unpack_from(whisper.archiveInfoFormat, data, offset)
+    except struct.error:
+      raise whisper.CorruptWhisperFile("Unable to read archive%d metadata" % i, path)
+
+    archives.append({
+      'offset' : offset,
+      'secondsPerPoint' : secondsPerPoint,
+      'points' : points,
+      'retention' : secondsPerPoint * points,
+      'size' : points * whisper.pointSize,
+    })
+
+  header = {
+    'aggregationMethod' : whisper.aggregationTypeToMethod.get(aggregationType, 'average'),
+    'maxRetention' : maxRetention,
+    'xFilesFactor' : xff,
+    'archives' : archives,
+  }
+  WHISPER_HEADERS.set(key, (stat.st_size, header))
+  return header
+
+
+def whisper_fetch_window(header, fromTime, untilTime=None, now=None, maxDataPoints=None):
+  """Returns the archive whisper.fetch() reads a time range from, and the
+  (fromInterval, untilInterval, step) it returns, or None if it returns no data.
+
+  With maxDataPoints, the coarsest archive that still has that many points in
+  the time range is read instead, provided the file averages its points into
+  coarser archives, the way renders consolidate them."""
+  # Archive selection and interval alignment follow whisper.file_fetch()
+  if now is None:
+    now = int( time.time() )
+  if untilTime is None:
+    untilTime = now
+  fromTime = int(fromTime)
+  untilTime = int(untilTime)
+
+  if fromTime > untilTime:
+    raise whisper.InvalidTimeInterval("Invalid time interval: from time '%s' is after until time '%s'" % (fromTime, untilTime))
+
+  oldestTime = now - header['maxRetention']
+  if fromTime > now:
+    return None
+  if untilTime < oldestTime:
+    return None
+  if fromTime < oldestTime:
+    fromTime = oldestTime
+  if untilTime > now:
+    untilTime = now
+
+  diff = now - fromTime
+  for archive in header['archives']:
+    if archive['retention'] >= diff:
+      break
+
+  if maxDataPoints and header.get('aggregationMethod', 'average') == 'average':
+    archives = header['archives']
+    for coarser in archives[archives.index(archive) + 1:]:
+      if coarser['secondsPerPoint'] * maxDataPoints > untilTime - fromTime:
+        break
+      archive = coarser
+
+  step = archive['secondsPerPoint']
+  fromInterval = int( fromTime - (fromTime % step) ) + step
+  untilInterval = int( untilTime - (untilTime % step) ) + step
+  if fromInterval == untilInterval:
+    # Check for zero-length time rages and always include the next point
+    untilInterval = untilInterval + step
+  return (archive, (fromInterval,untilInterval,step))
+
+
+def _whisper_mmap_fetch(data, header, fromTime, untilTime, now, maxDataPoints=None):
+  window = whisper_fetch_window(header, fromTime, untilTime, now, maxDataPoints)
+  if window is None:
+    return None
+  (archive, timeInfo) = window
+  (fromInterval,untilInterval,step) = timeInfo
+
+  baseInterval = struct.unpack_from(whisper.longFormat, data, archive['offset'])[0]
+  if baseInterval == 0:
+    points = (untilInterval - fromInterval) // step
+    return (timeInfo, numpy.zeros(points), numpy.ones(points, dtype=bool))
+
+  fromOffset = archive['offset'] + ((fromInterval - baseInterval) // step * whisper.pointSize) % archive['size']
+  untilOffset = archive['offset'] + ((untilInterval - baseInterval) // step * whisper.pointSize) % archive['size']
+
+  if fromOffset < untilOffset: #If we don't wrap around the archive
+    series = _mmap_points(data, fromOffset, untilOffset)
+  else: #We do wrap around the archive, so we need two slices
+    archiveEnd = archive['offset'] + archive['size']
+    series = numpy.concatenate((_mmap_points(data, fromOffset, archiveEnd),
+                                _mmap_points(data, archive['offset'], untilOffset)))
+
+  # Slots still holding a point from a previous lap of the ring buffer are nulls
+  expected = fromInterval + step * numpy.arange(len(series), dtype=numpy.int64)
+  nulls = series['interval'] != expected
+  values = series['value'].astype(numpy.float64) #copies out of the mapping
+  return (timeInfo, values, nulls)
+
+
+def _mmap_points(data, startOffset, endOffset):
+  return numpy.frombuffer(data, dtype=WHISPER_POINT,
+                          count=(endOffset - startOffset) // whisper.pointSize, offset=startOffset)
+
+
+def whisper_downsampled_fetch(path, fromTime, untilTime, now, maxDataPoints):
+  "Same as whisper.fetch() but reads the archive whisper_fetch_window() picks for maxDataPoints"
+  window = whisper_fetch_window(whisper.info(path), fromTime, untilTime, now, maxDataPoints)
+  if window is None:
+    return None
+  (archive, timeInfo) = window
+  (fromInterval,untilInterval,step) = timeInfo
+  return (timeInfo, whisper_archive_fetch(path, archive, fromInterval, untilInterval))
+
+
+def whisper_archive_fetch(path, archive, fromInterval, untilInterval):
+  """Returns the values archive holds from fromInterval up to untilInterval,
+  both multiples of its step, None where it holds no point for the interval.
+  Reads them the way whisper.file_fetch() does, but from the given archive and
+  for ranges of any length."""
+  step = archive['secondsPerPoint']
+  valueList = []
+  with open(path, 'rb') as fh:
+    fh.seek(archive['offset'])
+    (baseInterval,baseValue) = struct.unpack(whisper.pointFormat, fh.read(whisper.pointSize))
+    if baseInterval == 0:
+      return [None] * ((untilInterval - fromInterval) // step)
+
+    # A range longer than the archive is read an archive's worth at a time
+    while fromInterval < untilInterval:
+      partUntil = min(untilInterval, fromInterval + archive['points'] * step)
+      fromOffset = archive['offset'] + ((fromInterval - baseInterval) // step * whisper.pointSize) % archive['size']
+      untilOffset = archive['offset'] + ((partUntil - baseInterval) // step * whisper.pointSize) % archive['size']
+
+      fh.seek(fromOffset)
+      if fromOffset < untilOffset: #If we don't wrap around the archive
+        seriesString = fh.read(untilOffset - fromOffset)
+      else: #We do wrap around the archive, so we need two reads
+        archiveEnd = archive['offset'] + archive['size']
+        seriesString = fh.read(archiveEnd - fromOffset)
+        fh.seek(archive['offset'])
+        seriesString += fh.read(untilOffset - archive['offset'])
+
+      points = len(seriesString) // whisper.pointSize
+      unpackedSeries = struct.unpack(whisper.pointFormat[0] + whisper.pointFormat[1:] * points, seriesString)
+      currentInterval = fromInterval
+      for i in xrange(0, len(unpackedSeries), 2):
+        if unpackedSeries[i] == currentInterval:
+          valueList.append(unpackedSeries[i + 1])
+        else:
+          valueList.append(None)
+        currentInterval += step
+      fromInterval = partUntil
+
+  return valueList
+
+
 class GzippedWhisperFile(WhisperFile):
   extension = '.wsp.gz'
 
-  def fetch(self, startTime, endTime, now=None):
+  def fetch(self, startTime, endTime, now=None, maxDataPoints=None):
     if not gzip:
       raise Exception("gzip module not available, GzippedWhisperFile not supported")
 
@@ -438,8 +903,8 @@ class RRDDataSource(Leaf):
     end = max( os.stat(self.rrd_file.fs_path).st_mtime, start )
     return [ (start, end) ]
 
-  def fetch(self, startTime, endTime, now=None):
-    # 'now' parameter is meaningful for whisper but not RRD
+  def fetch(self, startTime, endTime, now=None, maxDataPoints=None):
+    # 'now' and 'maxDataPoints' parameters are meaningful for whisper but not RRD
     startString = time.strftime("%H:%M_%Y%m%d+%Ss", time.localtime(startTime))
     endString = time.strftime("%H:%M_%Y%m%d+%Ss", time.localtime(endTime))
 
@@ -455,5 +920,6 @@ class RRDDataSource(Leaf):
 
 
 # Exposed Storage API
+DIRECTORY_CACHE = DirectoryCache(settings.DIRECTORY_CACHE_SIZE)
 LOCAL_STORE = Store(settings.DATA_DIRS)
 STORE = Store(settings.DATA_DIRS, remote_hosts=settings.CLUSTER_SERVERS)
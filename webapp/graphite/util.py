@@ -14,7 +14,9 @@ limitations under the License."""
 
 import sys
 import calendar
+import threading
 import pytz
+from multiprocessing.util import register_after_fork
 
 try:
   import cPickle as pickle
@@ -29,6 +31,7 @@ except ImportError:
   from StringIO import StringIO
 
 from os import environ
+from collections import OrderedDict
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
 from django.utils.timezone import get_current_timezone
@@ -57,6 +60,58 @@ def epoch(dt):
       dt = dt.replace(tzinfo=get_current_timezone())
     return calendar.timegm(dt.astimezone(pytz.utc).timetuple())
 
+class LRUCache(object):
+  """A thread-safe mapping bounded to max_size entries.
+
+  Once full, the least recently used entry is evicted to make room. Worker
+  processes started by multiprocessing get a new lock, another thread may have
+  held this one when they were forked."""
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+    register_after_fork(self, LRUCache._reset_lock)
+
+  def _reset_lock(self):
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._data.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self._data[key] = value
+      self.hits += 1
+      return value
+
+  def set(self, key, value):
+    if self.max_size <= 0:
+      return
+    with self._lock:
+      self._data.pop(key, None)
+      self._data[key] = value
+      while len(self._data) > self.max_size:
+        self._data.popitem(last=False)
+
+  def pop(self, key, default=None):
+    with self._lock:
+      return self._data.pop(key, default)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def __contains__(self, key):
+    return key in self._data
+
+  def __len__(self):
+    return len(self._data)
+
+
 def getProfile(request,allowDefault=True):
   if request.user.is_authenticated():
     try:
@@ -1,7 +1,8 @@
 import traceback
 from django.conf import settings
-from django.http import HttpResponseServerError
+from django.http import HttpResponse, HttpResponseServerError
 from django.template import Context, loader
+from graphite import instrumentation
 
 
 def server_error(request, template_name='500.html'):
@@ -10,3 +11,9 @@ def server_error(request, template_name='500.html'):
     'stacktrace' : traceback.format_exc()
   })
   return HttpResponseServerError( template.render(context) )
+
+
+def internal_metrics(request):
+  "Serves the internal metrics of all webapp processes in the Prometheus text exposition format"
+  snapshot = instrumentation.aggregate()
+  return HttpResponse(instrumentation.exposition(snapshot), content_type='text/plain; version=0.0.4')
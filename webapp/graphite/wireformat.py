@@ -0,0 +1,215 @@
+"""Compact binary encoding of the series and nodes cluster members exchange.
+
+A message is a header followed by records. All numbers are big-endian.
+
+  header    'GWF', uint8 version, uint8 kind ('S' series, 'N' nodes),
+            uint32 number of records
+  string    uint32 length and bytes, a length of 0xffffffff is None. Unicode
+            strings are sent as UTF-8 with the highest bit of the length set
+
+  series    string name, string pathExpression, int64 start, end and step,
+            uint32 number of values, a bitmap with one bit per value (least
+            significant bit first) set for the values that are None, and the
+            values as float64, 0.0 in place of None. Numbers other than
+            floats are sent as floats
+  node      string metric_path, uint8 isLeaf, uint32 number of intervals and
+            the intervals as float64 (start, end) pairs
+
+Decoding yields the same dicts as the pickle format, TimeSeries.getInfo() for
+series and the find view's node dicts. dumpSeries() and dumpNodes() raise
+WireFormatError for anything they cannot encode exactly, callers then fall
+back to pickle."""
+
+import sys
+import struct
+from array import array
+
+
+VERSION = 1
+CONTENT_TYPE = 'application/x-graphite-wire'
+
+MAGIC = 'GWF'
+HEADER = struct.Struct('>3sBcI')
+LENGTH = struct.Struct('>I')
+TIME_INFO = struct.Struct('>qqqI')
+NODE_INFO = struct.Struct('>BI')
+NONE_LENGTH = 0xffffffff
+UNICODE_FLAG = 0x80000000
+SWAP_FLOATS = sys.byteorder == 'little'
+NULL_BITS = [ tuple(bit for bit in range(8) if byte & (1 << bit)) for byte in range(256) ]
+
+
+class WireFormatError(ValueError):
+  pass
+
+
+def dumpSeries(seriesList):
+  "Encodes TimeSeries objects, or their getInfo() dicts"
+  chunks = [ HEADER.pack(MAGIC, VERSION, 'S', len(seriesList)) ]
+  for series in seriesList:
+    if isinstance(series, dict):
+      (name, pathExpression, start, end, step, values) = (series['name'], series.get('pathExpression'),
+        series['start'], series['end'], series['step'], series['values'])
+    else:
+      (name, pathExpression, start, end, step, values) = (series.name, series.pathExpression,
+        series.start, series.end, series.step, list(series))
+
+    for t in (start, end, step):
+      if t != int(t):
+        raise WireFormatError("%s has a fractional time range %s, %s, %s" % (name, start, end, step))
+
+    chunks.append( _packString(name) )
+    chunks.append( _packString(pathExpression) )
+    chunks.append( TIME_INFO.pack(int(start), int(end), int(step), len(values)) )
+    chunks.extend( _packValues(name, values) )
+
+  return ''.join(chunks)
+
+
+def dumpNodes(nodes):
+  "Encodes nodes as the find view returns them, without their contexts"
+  chunks = [ HEADER.pack(MAGIC, VERSION, 'N', len(nodes)) ]
+  for node in nodes:
+    intervals = node.getIntervals()
+    chunks.append( _packString(node.metric_path) )
+    chunks.append( NODE_INFO.pack(int(bool(node.isLeaf())), len(intervals)) )
+    for (start, end) in intervals:
+      chunks.append( struct.pack('>dd', start, end) )
+
+  return ''.join(chunks)
+
+
+def loads(data):
+  "Decodes a message into a list of series or node dicts"
+  try:
+    (magic, version, kind, count) = HEADER.unpack_from(data, 0)
+  except struct.error:
+    raise WireFormatError("truncated header")
+  if magic != MAGIC:
+    raise WireFormatError("not a wire format message")
+  if version > VERSION:
+    raise WireFormatError("unsupported wire format version %d" % version)
+
+  offset = HEADER.size
+  try:
+    if kind == 'S':
+      (records, offset) = _loadSeries(data, offset, count)
+    elif kind == 'N':
+      (records, offset) = _loadNodes(data, offset, count)
+    else:
+      raise WireFormatError("unknown record kind %r" % kind)
+  except struct.error:
+    raise WireFormatError("truncated message")
+
+  if offset != len(data):
+    raise WireFormatError("%d trailing bytes" % (len(data) - offset))
+  return records
+
+
+def _loadSeries(data, offset, count):
+  seriesList = []
+  for i in xrange(count):
+    (name, offset) = _unpackString(data, offset)
+    (pathExpression, offset) = _unpackString(data, offset)
+    (start, end, step, length) = TIME_INFO.unpack_from(data, offset)
+    offset += TIME_INFO.size
+
+    bitmapLength = (length + 7) // 8
+    nulls = data[offset:offset + bitmapLength]
+    offset += bitmapLength
+    packed = data[offset:offset + 8 * length]
+    offset += 8 * length
+    if len(packed) != 8 * length:
+      raise WireFormatError("truncated message")
+    floats = array('d', packed)
+    if SWAP_FLOATS:
+      floats.byteswap()
+    values = floats.tolist()
+
+    if nulls.strip('\0'):
+      for (byteIndex, byte) in enumerate(bytearray(nulls)):
+        for bit in NULL_BITS[byte]:
+          values[byteIndex * 8 + bit] = None
+
+    seriesList.append({
+      'name' : name,
+      'start' : start,
+      'end' : end,
+      'step' : step,
+      'values' : values,
+      'pathExpression' : pathExpression,
+    })
+  return (seriesList, offset)
+
+
+def _loadNodes(data, offset, count):
+  nodes = []
+  for i in xrange(count):
+    (metric_path, offset) = _unpackString(data, offset)
+    (isLeaf, intervalCount) = NODE_INFO.unpack_from(data, offset)
+    offset += NODE_INFO.size
+    flat = struct.unpack_from('>%dd' % (2 * intervalCount), data, offset)
+    offset += 16 * intervalCount
+    nodes.append({
+      'metric_path' : metric_path,
+      'isLeaf' : bool(isLeaf),
+      'intervals' : zip(flat[0::2], flat[1::2]),
+    })
+  return (nodes, offset)
+
+
+def _packString(value):
+  if value is None:
+    return LENGTH.pack(NONE_LENGTH)
+  flag = 0
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+    flag = UNICODE_FLAG
+  elif not isinstance(value, str):
+    raise WireFormatError("%r is not a string" % (value,))
+  if len(value) >= UNICODE_FLAG:
+    raise WireFormatError("string of %d bytes is too long" % len(value))
+  return LENGTH.pack(len(value) | flag) + value
+
+
+def _unpackString(data, offset):
+  (length,) = LENGTH.unpack_from(data, offset)
+  offset += LENGTH.size
+  if length == NONE_LENGTH:
+    return (None, offset)
+  isUnicode = length & UNICODE_FLAG
+  length &= ~UNICODE_FLAG
+  if offset + length > len(data):
+    raise WireFormatError("truncated message")
+  value = data[offset:offset + length]
+  if isUnicode:
+    try:
+      value = value.decode('utf-8')
+    except UnicodeDecodeError:
+      raise WireFormatError("malformed unicode string")
+  return (value, offset + length)
+
+
+def _packValues(name, values):
+  "Returns the null bitmap and the packed floats of values"
+  bitmap = bytearray( (len(values) + 7) // 8 )
+  packer = '>%dd' % len(values)
+  try: # series without gaps need no null bitmap
+    return (str(bitmap), struct.pack(packer, *values))
+  except struct.error:
+    pass
+
+  values = list(values)
+  i = -1
+  try:
+    while True:
+      i = values.index(None, i + 1)
+      values[i] = 0.0
+      bitmap[i >> 3] |= 1 << (i & 7)
+  except ValueError:
+    pass
+
+  try:
+    return (str(bitmap), struct.pack(packer, *values))
+  except struct.error:
+    raise WireFormatError("%s has values that are neither numbers nor None" % name)
@@ -1,6 +1,24 @@
+import os
+import pickle
+import Queue
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime
+from SocketServer import StreamRequestHandler, ThreadingTCPServer
+
+import pytz
+import whisper
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import TestCase
+from mock import patch
 
-from graphite.render import datalib
+from graphite.remote_storage import RemoteNode, RemoteStore
+from graphite.render import datalib, tieredcache
+from graphite.storage import Store, whisper_archive_fetch
 
 
 class DataLibTest(TestCase):
@@ -39,3 +57,500 @@ class DataLibTest(TestCase):
     @staticmethod
     def _create_none_window(points_per_window):
         return [None for _ in range(0, points_per_window)]
+
+
+class CompactTimeSeriesTest(TestCase):
+
+    values = [1.0, None, 3.0, 4.5, None, None, 7.25, 8.0]
+
+    def assertSameSeries(self, compact, series):
+        self.assertEqual(compact[:], series[:])
+        self.assertEqual(list(compact), list(series))
+        self.assertEqual(len(compact), len(series))
+        self.assertEqual(compact.count(None), series.count(None))
+        self.assertEqual(None in compact, None in series)
+
+    def test_behaves_like_timeseries(self):
+        series = datalib.TimeSeries('a.b', 0, 480, 60, self.values)
+        compact = datalib.CompactTimeSeries('a.b', 0, 480, 60, self.values)
+        self.assertSameSeries(compact, series)
+        self.assertEqual(compact, self.values)
+        self.assertEqual(repr(compact), repr(series))
+        self.assertEqual(compact.values.itemsize * len(compact.values), 8 * len(self.values))
+
+        operations = [
+            lambda s: s.__setitem__(0, None),
+            lambda s: s.__setitem__(1, 2),
+            lambda s: s.__setitem__(-1, None),
+            lambda s: s.__setitem__(slice(2, 4), [None, 5.5, 6.0]),
+            lambda s: s.__setitem__(slice(None, None, 2), [0.5] * len(s[::2])),
+            lambda s: s.__delitem__(2),
+            lambda s: s.__delitem__(slice(-2, None)),
+            lambda s: s.append(None),
+            lambda s: s.extend([9.0, None]),
+            lambda s: s.insert(1, None),
+            lambda s: s.pop(),
+            lambda s: s.remove(None),
+            lambda s: s.reverse(),
+            lambda s: s.sort(),
+        ]
+        for operation in operations:
+            operation(series)
+            operation(compact)
+            self.assertSameSeries(compact, series)
+        self.assertEqual(compact.index(9.0), series.index(9.0))
+        self.assertEqual(compact[-3:-1], series[-3:-1])
+
+    def test_consolidation(self):
+        for func in ('sum', 'average', 'max', 'min'):
+            series = datalib.TimeSeries('a.b', 0, 480, 60, self.values, consolidate=func)
+            compact = datalib.CompactTimeSeries('a.b', 0, 480, 60, self.values, consolidate=func)
+            series.consolidate(3)
+            compact.consolidate(3)
+            self.assertEqual(list(compact), list(series))
+
+        series.pathExpression = compact.pathExpression = 'a.*'
+        self.assertEqual(compact.getInfo(), series.getInfo())
+
+    def test_backend_setting(self):
+        self.assertEqual(type(datalib.newTimeSeries('a.b', 0, 60, 60, [None])), datalib.TimeSeries)
+        with self.settings(TIMESERIES_BACKEND='array'):
+            self.assertEqual(type(datalib.newTimeSeries('a.b', 0, 60, 60, [None])), datalib.CompactTimeSeries)
+
+
+def generator_consolidation(values, valuesPerPoint, consolidationFunc):
+    # The per-value generator TimeSeries consolidated with before
+    buf = []
+    for x in values:
+        buf.append(x)
+        if len(buf) == valuesPerPoint:
+            while None in buf: buf.remove(None)
+            if buf:
+                yield datalib.CONSOLIDATION_FUNCTIONS[consolidationFunc](buf)
+                buf = []
+            else:
+                yield None
+    while None in buf: buf.remove(None)
+    if buf: yield datalib.CONSOLIDATION_FUNCTIONS[consolidationFunc](buf)
+    else: yield None
+
+
+class ConsolidationTest(TestCase):
+
+    def test_matches_generator(self):
+        rng = random.Random(42)
+        for length in (0, 1, 5, 6, 29, 30, 31):
+            values = [None if rng.random() < 0.3 else rng.uniform(-100, 100) for i in range(length)]
+            for valuesPerPoint in (2, 3, 6):
+                for func in sorted(datalib.CONSOLIDATION_FUNCTIONS):
+                    expected = list(generator_consolidation(values, valuesPerPoint, func))
+                    for cls in (datalib.TimeSeries, datalib.CompactTimeSeries):
+                        series = cls('a.b', 0, 60 * length, 60, values, consolidate=func)
+                        series.consolidate(valuesPerPoint)
+                        self.assertEqual(map(repr, series), map(repr, expected), (cls, valuesPerPoint, func))
+
+    def test_pure_python_arrays(self):
+        values = [1.0, None, 3.0, None, None, None, 7.0]
+        series = datalib.CompactTimeSeries('a.b', 0, 420, 60, values, consolidate='last')
+        series.consolidate(3)
+        with patch.object(datalib, 'numpy', False):
+            self.assertEqual(list(series), [3.0, None, 7.0])
+
+    def test_invalid_function(self):
+        for cls in (datalib.TimeSeries, datalib.CompactTimeSeries):
+            series = cls('a.b', 0, 120, 60, [1, 2], consolidate='median')
+            series.consolidate(2)
+            self.assertRaises(Exception, list, series)
+
+    def test_results_follow_changes(self):
+        for cls in (datalib.TimeSeries, datalib.CompactTimeSeries):
+            series = cls('a.b', 0, 240, 60, [1.0, 2.0, None, 4.0])
+            series.consolidate(2)
+            self.assertEqual(list(series), [1.5, 4.0, None])
+            self.assertTrue(series.consolidatedValues() is series.consolidatedValues())
+
+            series[2] = 6.0
+            series.consolidate(2)
+            self.assertEqual(list(series), [1.5, 5.0, None])
+            series.consolidationFunc = 'max'
+            self.assertEqual(list(series), [2.0, 6.0, None])
+            series.append(10.0)
+            self.assertEqual(list(series), [2.0, 6.0, 10.0])
+            series.consolidate(1)
+            self.assertEqual(list(series), [1.0, 2.0, 6.0, 4.0, 10.0])
+
+            series.consolidate(2)
+            for change in (lambda s: s.__setslice__(0, 2, [3.0]),
+                           lambda s: s.__delslice__(0, 1),
+                           lambda s: s.__delitem__(0),
+                           lambda s: s.__iadd__([None, 8.0]),
+                           lambda s: s.insert(0, 7.0),
+                           lambda s: s.pop(0),
+                           lambda s: s.reverse(),
+                           lambda s: s.sort()):
+                list(series)
+                change(series)
+                fresh = cls('a.b', 0, 60 * len(series), 60, series[:], consolidate='max')
+                fresh.consolidate(2)
+                self.assertEqual(list(series), list(fresh))
+
+
+class CarbonCacheHandler(StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            len_prefix = self.rfile.read(4)
+            if len(len_prefix) < 4:
+                return
+            request = pickle.loads(self.rfile.read(struct.unpack('!L', len_prefix)[0]))
+            self.server.requests.append((id(self), request))
+            time.sleep(self.server.delay)
+            if request['type'] == 'cache-query-bulk':
+                result = {'datapointsByMetric': dict((metric, [(60, 1.0)]) for metric in request['metrics'])}
+            else:
+                result = {'datapoints': [(60, float(len(request['metric'])))]}
+            body = pickle.dumps(result, protocol=-1)
+            self.wfile.write(struct.pack('!L', len(body)) + body)
+
+
+class CarbonLinkTest(TestCase):
+
+    def setUp(self):
+        self.servers = []
+        for i in range(2):
+            server = ThreadingTCPServer(('127.0.0.1', 0), CarbonCacheHandler)
+            server.daemon_threads = True
+            server.requests = []
+            server.delay = 0
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            self.servers.append(server)
+        self.pool = datalib.CarbonLinkPool(
+            [('127.0.0.1', server.server_address[1], instance) for (server, instance) in zip(self.servers, 'ab')], 5)
+        self.metrics = ['hosts.host%02d.cpu' % i for i in range(20)]
+
+    def test_bulk_queries_run_concurrently_in_chunks(self):
+        for server in self.servers:
+            server.delay = 0.1
+        start = time.time()
+        with self.settings(CARBONLINK_QUERY_BULK_CHUNK_SIZE=3):
+            results = self.pool.query_bulk(self.metrics)
+        elapsed = time.time() - start
+
+        self.assertEqual(results, dict((metric, [(60, 1.0)]) for metric in self.metrics))
+        requestCounts = []
+        for server in self.servers:
+            self.assertTrue(server.requests)
+            self.assertEqual(len(set(connection for (connection, request) in server.requests)), 1)
+            self.assertTrue(all(len(request['metrics']) <= 3 for (connection, request) in server.requests))
+            requestCounts.append(len(server.requests))
+        # the hosts answer at the same time, so only the slowest one counts
+        self.assertTrue(elapsed < 0.1 * sum(requestCounts) - 0.05, elapsed)
+
+    def test_cache_queries_are_pipelined(self):
+        results = self.pool.query_many(self.metrics)
+        self.assertEqual(results, dict((metric, [(60, float(len(metric)))]) for metric in self.metrics))
+        for server in self.servers:
+            self.assertEqual(len(set(connection for (connection, request) in server.requests)), 1)
+        self.assertEqual(sorted(request['metric'] for server in self.servers
+                                for (connection, request) in server.requests), self.metrics)
+
+        # the connections go back to the pool
+        self.pool.query_many(self.metrics)
+        for server in self.servers:
+            self.assertEqual(len(set(connection for (connection, request) in server.requests)), 1)
+
+    def test_hosts_share_one_deadline(self):
+        self.pool.timeout = 0.3
+        self.servers[0].delay = 2
+        start = time.time()
+        results = self.pool.query_many(self.metrics)
+        self.assertTrue(time.time() - start < 1, time.time() - start)
+
+        slowHost = ('127.0.0.1', 'a')
+        self.assertTrue(slowHost in self.pool.last_failure)
+        self.assertEqual(sorted(results), [metric for metric in self.metrics
+                                           if self.pool.select_host(metric) != slowHost])
+        self.assertTrue(len(results) < len(self.metrics))
+
+
+class FetchDataTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.now = int(time.time())
+        for host in range(6):
+            directory = os.path.join(self.root, 'hosts', 'host%d' % host)
+            os.makedirs(directory)
+            path = os.path.join(directory, 'cpu.wsp')
+            whisper.create(path, [(1, 60)])
+            whisper.update(path, host, self.now - 1)
+
+        for (name, value) in (('LOCAL_STORE', Store([self.root])),
+                              ('CarbonLink', datalib.CarbonLinkPool([], 1))):
+            self.addCleanup(setattr, datalib, name, getattr(datalib, name))
+            setattr(datalib, name, value)
+
+    def fetch(self, pathExpr):
+        requestContext = {
+            'startTime': datetime.fromtimestamp(self.now - 30, pytz.utc),
+            'endTime': datetime.fromtimestamp(self.now, pytz.utc),
+            'now': datetime.fromtimestamp(self.now, pytz.utc),
+            'localOnly': True,
+        }
+        return [(series.name, list(series)) for series in datalib.fetchData(requestContext, pathExpr)]
+
+    def test_fetch_pool_keeps_results_ordered(self):
+        serial = self.fetch('hosts.*.cpu')
+        self.assertEqual([name for (name, values) in serial],
+                         ['hosts.host%d.cpu' % i for i in range(6)])
+        self.assertEqual([values[-2] for (name, values) in serial], range(6))
+
+        with self.settings(LOCAL_FETCH_THREADS=4):
+            self.assertEqual(self.fetch('hosts.*.cpu'), serial)
+            self.assertEqual(datalib.getLocalFetchPool()._processes, 4)
+
+        with self.settings(TIMESERIES_BACKEND='array'):
+            self.assertEqual(self.fetch('hosts.*.cpu'), serial)
+
+
+class ChunkedFetchTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'cpu.wsp')
+        whisper.create(self.path, [(60, 1440), (600, 1000)])
+        self.now = int(time.time())
+        whisper.update_many(self.path, [(t, float(t // 60 % 100)) for t in range(self.now - 86400, self.now, 60)])
+        self.dbFile = Store([self.root]).find('cpu').next()
+
+        self.reads = []
+        def read(path, archive, fromInterval, untilInterval):
+            self.reads.append((archive['secondsPerPoint'], untilInterval - fromInterval))
+            return whisper_archive_fetch(path, archive, fromInterval, untilInterval)
+        self.addCleanup(setattr, datalib, 'whisper_archive_fetch', datalib.whisper_archive_fetch)
+        datalib.whisper_archive_fetch = read
+        self.addCleanup(setattr, tieredcache, 'cache', tieredcache.cache)
+        tieredcache.cache = LocMemCache('chunks', {})
+
+    def fetch(self, fromTime, now):
+        with self.settings(DATA_CHUNK_SIZE=3600):
+            (result,) = datalib.fetchLocalData([self.dbFile], fromTime, now, now)
+        self.assertEqual(result, whisper.fetch(self.path, fromTime, now, now))
+
+    def test_only_missing_chunks_are_read(self):
+        self.fetch(self.now - 86400, self.now)
+        self.assertEqual(self.reads, [(60, 25 * 3600)])
+
+        # A minute later, the settled chunks come from the cache
+        del self.reads[:]
+        self.fetch(self.now - 86340, self.now + 60)
+        self.assertEqual(len(self.reads), 1)
+        self.assertTrue(self.reads[0][1] <= 2 * 3600)
+
+    def test_recreated_file_is_read_again(self):
+        self.fetch(self.now - 86400, self.now)
+        os.rename(self.path, self.path + '.old')
+        whisper.create(self.path, [(60, 1440), (600, 1000)])
+        whisper.update_many(self.path, [(t, 1.0) for t in range(self.now - 86400, self.now, 60)])
+        del self.reads[:]
+        self.fetch(self.now - 86400, self.now)
+        self.assertEqual(self.reads, [(60, 25 * 3600)])
+
+    def test_chunks_are_per_archive(self):
+        self.fetch(self.now - 3600, self.now)
+        self.fetch(self.now - 3 * 86400, self.now)
+        self.assertEqual([step for (step, length) in self.reads], [60, 600])
+
+
+class FetchMemoTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.now = int(time.time())
+        for host in range(2):
+            directory = os.path.join(self.root, 'hosts', 'host%d' % host)
+            os.makedirs(directory)
+            path = os.path.join(directory, 'cpu.wsp')
+            whisper.create(path, [(60, 60), (300, 288)])
+            whisper.update_many(path, [(self.now - 60 * i, i + host) for i in range(0, 120, 2)])
+
+        self.reads = []
+        fetch = datalib.WhisperFile.fetch
+        def countingFetch(dbFile, startTime, endTime, now=None):
+            self.reads.append(dbFile.metric_path)
+            return fetch(dbFile, startTime, endTime, now)
+        for (name, value) in (('LOCAL_STORE', Store([self.root])),
+                              ('CarbonLink', datalib.CarbonLinkPool([], 1))):
+            self.addCleanup(setattr, datalib, name, getattr(datalib, name))
+            setattr(datalib, name, value)
+        patcher = patch.object(datalib.WhisperFile, 'fetch', countingFetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.memo = datalib.FetchMemo()
+
+    def time(self, secondsAgo):
+        return datetime.fromtimestamp(self.now - secondsAgo, pytz.utc)
+
+    def context(self, start, end, memo=None):
+        return {
+            'startTime': self.time(start),
+            'endTime': self.time(end),
+            'now': self.time(0),
+            'localOnly': True,
+            'fetchMemo': memo,
+        }
+
+    def fetch(self, start, end, memo=None):
+        return datalib.fetchData(self.context(start, end, memo), 'hosts.*.cpu')
+
+    def assertSameSeries(self, seriesList, expected):
+        self.assertEqual([(s.name, s.start, s.end, s.step, s.pathExpression, s[:]) for s in seriesList],
+                         [(s.name, s.start, s.end, s.step, s.pathExpression, s[:]) for s in expected])
+
+    def test_repeated_fetch_reads_once(self):
+        first = self.fetch(3000, 0, self.memo)
+        first[0][1] = 12345
+        second = self.fetch(3000, 0, self.memo)
+        self.assertEqual(len(self.reads), 2)
+        self.assertTrue(second[0] is not first[0])
+        self.assertSameSeries(second, self.fetch(3000, 0))
+
+    def test_narrower_range_is_sliced(self):
+        for backend in ('list', 'array'):
+            with self.settings(TIMESERIES_BACKEND=backend):
+                self.fetch(3000, 0, self.memo)
+                del self.reads[:]
+                sliced = self.fetch(1800, 600, self.memo)
+                self.assertEqual(self.reads, [])
+                self.assertSameSeries(sliced, self.fetch(1800, 600))
+                self.assertEqual(type(sliced[0]), type(self.fetch(1800, 600)[0]))
+            self.memo = datalib.FetchMemo()
+
+    def test_narrower_range_in_finer_archive_is_fetched(self):
+        self.fetch(7200, 0, self.memo)
+        del self.reads[:]
+        seriesList = self.fetch(1800, 0, self.memo)
+        self.assertEqual(len(self.reads), 2)
+        self.assertEqual(seriesList[0].step, 60)
+        self.assertSameSeries(seriesList, self.fetch(1800, 0))
+
+    def test_plan_reads_overlapping_windows_once(self):
+        windows = [(3000, 0), (1800, 0), (1200, 300), (600000, 590000)]
+        fetchWindows = dict(((self.time(start), self.time(end)), set(['hosts.*.cpu']))
+                            for (start, end) in windows)
+        requestContext = self.context(3000, 0, self.memo)
+        datalib.planFetches(requestContext, fetchWindows)
+        self.assertEqual(sorted(self.reads), ['hosts.host0.cpu', 'hosts.host1.cpu'])
+
+        for (start, end) in windows[:3]:
+            self.assertSameSeries(self.fetch(start, end, self.memo), self.fetch(start, end))
+        # the disjoint window is not read ahead, and only its own fetch reads it
+        del self.reads[:]
+        self.fetch(600000, 590000, self.memo)
+        self.assertEqual(len(self.reads), 2)
+
+    def test_plan_keeps_only_repeated_fetches(self):
+        window = (self.time(3000), self.time(0))
+        requestContext = self.context(3000, 0, self.memo)
+        datalib.planFetches(requestContext, {window: set(['hosts.*.cpu', 'hosts.host0.*'])},
+                            {window + ('hosts.*.cpu',): 2, window + ('hosts.host0.*',): 1})
+        self.assertEqual(len(self.reads), 2)
+
+        first = datalib.fetchData(requestContext, 'hosts.*.cpu')
+        first[0][1] = 12345
+        self.assertSameSeries(datalib.fetchData(requestContext, 'hosts.*.cpu'), self.fetch(3000, 0))
+        datalib.fetchData(requestContext, 'hosts.host0.*')
+        self.assertEqual(self.memo.fetches, {})
+        # the read ahead, the fetch without the memo, and hosts.host0.*
+        self.assertEqual(len(self.reads), 2 + 2 + 1)
+
+    def test_plan_reads_local_series_ahead_for_clusters(self):
+        self.addCleanup(setattr, datalib, 'STORE', datalib.STORE)
+        datalib.STORE = type('FakeStore', (object,), {'remote_stores': [RemoteStore('10.0.0.1:80')]})()
+        patcher = patch.object(datalib, 'fetchRemoteData', lambda *args: Queue.Queue())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        fetchWindows = {(self.time(3000), self.time(0)): set(['hosts.*.cpu']),
+                        (self.time(1800), self.time(0)): set(['hosts.*.cpu'])}
+        requestContext = self.context(3000, 0, self.memo)
+        requestContext['localOnly'] = False
+        datalib.planFetches(requestContext, fetchWindows)
+        self.assertEqual(self.memo.fetches, {})
+        self.assertEqual(len(self.reads), 2)
+
+        requestContext = self.context(1800, 0, self.memo)
+        requestContext['localOnly'] = False
+        seriesList = datalib.fetchData(requestContext, 'hosts.*.cpu')
+        self.assertEqual(len(self.reads), 2)
+        self.assertSameSeries(seriesList, self.fetch(1800, 0))
+
+    def test_remote_series_are_not_sliced(self):
+        series = datalib.TimeSeries('a.b', self.now - 3000, self.now, 60, [1.0] * 50)
+        series.pathExpression = 'a.b'
+        self.memo.add('a.b', self.now - 3000, self.now, self.now, [(series, None)])
+        self.assertEqual(self.memo.get('a.b', self.now - 3000, self.now, self.now)[0][:], series[:])
+        self.assertEqual(self.memo.get('a.b', self.now - 1800, self.now, self.now), None)
+
+
+class BatchRemoteDataTest(TestCase):
+
+    def setUp(self):
+        self.now = 1465844460
+        self.requests = []
+        stores = [RemoteStore('10.0.0.1:80'), RemoteStore('10.0.0.2:80')]
+        self.addCleanup(setattr, datalib, 'STORE', datalib.STORE)
+        datalib.STORE = type('FakeStore', (object,), {'remote_stores': stores})()
+
+        def fetch(node, startTime, endTime, now=None, result_queue=None, headers=None, maxDataPoints=None):
+            self.requests.append((node.store.host, tuple(node.metric_path), startTime, endTime))
+            result_queue.put((node.store.host, [
+                {'name': pathExpr.replace('*', 'x'), 'pathExpression': pathExpr,
+                 'start': startTime, 'end': endTime, 'step': 60, 'values': [1.0]}
+                for pathExpr in node.metric_path]))
+        patcher = patch.object(RemoteNode, 'fetch', fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def context(self, start, end):
+        return {
+            'startTime': datetime.fromtimestamp(start, pytz.utc),
+            'endTime': datetime.fromtimestamp(end, pytz.utc),
+            'now': datetime.fromtimestamp(self.now, pytz.utc),
+            'localOnly': False,
+        }
+
+    def test_one_request_per_host_and_window(self):
+        requestContext = self.context(self.now - 3600, self.now)
+        shifted = self.context(self.now - 7200, self.now - 3600)
+        fetchWindows = {
+            (requestContext['startTime'], requestContext['endTime']): set(['b.*', 'a.*']),
+            (shifted['startTime'], shifted['endTime']): set(['a.*']),
+        }
+        prefetched = datalib.batchRemoteData(requestContext, fetchWindows)
+
+        self.assertEqual(sorted(self.requests), [
+            ('10.0.0.1:80', ('a.*',), self.now - 7200, self.now - 3600),
+            ('10.0.0.1:80', ('a.*', 'b.*'), self.now - 3600, self.now),
+            ('10.0.0.2:80', ('a.*',), self.now - 7200, self.now - 3600),
+            ('10.0.0.2:80', ('a.*', 'b.*'), self.now - 3600, self.now),
+        ])
+
+        # fetchData finds every expression and window in the batch
+        del self.requests[:]
+        requestContext['prefetchedRemoteData'] = shifted['prefetchedRemoteData'] = prefetched
+        for (context, pathExpr) in ((requestContext, 'a.*'), (requestContext, 'b.*'), (shifted, 'a.*')):
+            result_queue = datalib.fetchRemoteData(context, pathExpr, True)
+            results = [result_queue.get_nowait() for i in range(2)]
+            self.assertTrue(result_queue.empty())
+            for (node, seriesList) in results:
+                self.assertEqual([(s['pathExpression'], s['start']) for s in seriesList],
+                                 [(pathExpr, datalib._timebounds(context)[0])])
+        self.assertEqual(self.requests, [])
@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+import whisper
+from django.test import TestCase
+from mock import patch
+
+from graphite.render import datalib, evaluator
+from graphite.render.evaluator import (downsamplingSafe, evaluateTargets, evaluateTokens, extractFetchWindows,
+                                       extractPathExpressions, parseTarget)
+from graphite.render.parser import Tokens
+from graphite.storage import Store
+from graphite.util import LRUCache
+
+
+class ExtractFetchWindowsTest(TestCase):
+
+    def setUp(self):
+        self.start = datetime(2016, 6, 13, 19, 0, tzinfo=pytz.utc)
+        self.end = self.start + timedelta(hours=1)
+        self.requestContext = {
+            'startTime': self.start,
+            'endTime': self.end,
+            'now': self.end,
+            'localOnly': False,
+        }
+
+    def windows(self, *targets):
+        return extractFetchWindows(self.requestContext, list(targets))
+
+    def test_request_window(self):
+        self.assertEqual(self.windows('a.*', 'sumSeries(b.*, c)', 'a.*', ''), {
+            (self.start, self.end): set(['a.*', 'b.*', 'c']),
+        })
+
+    def test_widened_windows(self):
+        day = timedelta(days=1)
+        self.assertEqual(self.windows("movingAverage(a.*, '5min')",
+                                      "timeShift(sumSeries(b.*), '1d')",
+                                      "holtWintersForecast(c)"), {
+            (self.start, self.end): set(['a.*', 'b.*', 'c']),
+            (self.start - timedelta(minutes=5), self.end): set(['a.*']),
+            (self.start - day, self.end - day): set(['b.*']),
+            (self.start - 7 * day, self.end): set(['c']),
+        })
+
+    def test_time_stack(self):
+        hour = timedelta(hours=1)
+        self.assertEqual(self.windows("timeStack(a, '1h', 1, 3)"), {
+            (self.start, self.end): set(['a']),
+            (self.start - hour, self.end - hour): set(['a']),
+            (self.start - 2 * hour, self.end - 2 * hour): set(['a']),
+        })
+
+    def test_aligned_windows(self):
+        self.requestContext['startTime'] = self.start + timedelta(minutes=30)
+        aligned = (datetime(2016, 6, 13, 19, 0), self.end)
+        self.assertEqual(self.windows("smartSummarize(a.*, '1h')", "hitcount(b, '1h', true)", "hitcount(c, '1h')"), {
+            (self.start + timedelta(minutes=30), self.end): set(['a.*', 'b', 'c']),
+            aligned: set(['a.*', 'b']),
+        })
+
+    def test_windows_depending_on_data_are_left_out(self):
+        self.assertEqual(self.windows('movingAverage(a, 10)'), {
+            (self.start, self.end): set(['a']),
+        })
+
+
+class FetchMemoEvaluationTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        # On the hour, as hitcount fails on some unaligned time ranges
+        self.now = int(time.time()) // 3600 * 3600
+        for host in range(5):
+            path = os.path.join(self.root, 'hosts', 'host%d.wsp' % host)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            whisper.create(path, [(60, 1440)])
+            whisper.update_many(path, [(self.now - 60 * i, i + host) for i in range(360)])
+
+        self.reads = []
+        fetch = datalib.WhisperFile.fetch
+        def countingFetch(dbFile, *args, **kwargs):
+            self.reads.append(dbFile.metric_path)
+            return fetch(dbFile, *args, **kwargs)
+        for (name, value) in (('LOCAL_STORE', Store([self.root])),
+                              ('CarbonLink', datalib.CarbonLinkPool([], 1))):
+            self.addCleanup(setattr, datalib, name, getattr(datalib, name))
+            setattr(datalib, name, value)
+        patcher = patch.object(datalib.WhisperFile, 'fetch', countingFetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def evaluate(self, target, memo):
+        requestContext = {
+            'startTime': datetime.fromtimestamp(self.now - 4 * 3600 - 1800, pytz.utc),
+            'endTime': datetime.fromtimestamp(self.now, pytz.utc),
+            'now': datetime.fromtimestamp(self.now, pytz.utc),
+            'localOnly': True,
+            'data': [],
+        }
+        if memo:
+            requestContext['fetchMemo'] = datalib.FetchMemo()
+        return [(s.name, s.start, s.end, s.step, list(s)) for s in evaluateTargets(requestContext, [target])]
+
+    def test_series_evaluated_again_are_read_once(self):
+        for target in ("smartSummarize(hosts.*, '1h')", "hitcount(hosts.*, '1h', true)"):
+            expected = self.evaluate(target, memo=False)
+            del self.reads[:]
+            self.assertEqual(self.evaluate(target, memo=True), expected)
+            self.assertEqual(sorted(self.reads), ['hosts.host%d' % host for host in range(5)])
+
+
+class ParseTargetTest(TestCase):
+
+    def setUp(self):
+        self.cache = evaluator.PARSED_TARGETS
+        evaluator.PARSED_TARGETS = LRUCache(2)
+
+    def tearDown(self):
+        evaluator.PARSED_TARGETS = self.cache
+
+    def test_targets_are_parsed_once(self):
+        tokens = parseTarget('sumSeries(a.*, b)')
+        self.assertTrue(parseTarget('sumSeries(a.*, b)') is tokens)
+        self.assertEqual(sorted(extractPathExpressions(['sumSeries(a.*, b)'])), ['a.*', 'b'])
+        self.assertEqual(extractFetchWindows(self.context(), ['sumSeries(a.*, b)']).values(), [set(['a.*', 'b'])])
+        self.assertEqual(evaluator.parseCacheStats(), {
+            'hits': 3, 'misses': 1, 'hitRate': 0.75, 'size': 1, 'maxSize': 2,
+        })
+
+    def test_least_recently_used_targets_are_evicted(self):
+        tokens = parseTarget('a')
+        parseTarget('b')
+        parseTarget('a')
+        parseTarget('c')
+        self.assertTrue(parseTarget('a') is tokens)
+        self.assertFalse('b' in evaluator.PARSED_TARGETS)
+
+    def test_tokens(self):
+        call = parseTarget('f(a.{b,c}, 1, -2.5, 1e3, "x", true)').expression.call
+        self.assertEqual(call.func, 'f')
+        self.assertEqual(call.args[0].expression.pathExpression, 'a.{b,c}')
+        self.assertEqual([evaluateTokens({}, arg) for arg in call.args[1:]], [1, -2.5, 1000.0, 'x', True])
+        self.assertEqual(call.args[1].string, '')
+        self.assertRaises(AttributeError, setattr, call, 'func', 'g')
+        self.assertRaises(TypeError, Tokens, name='a')
+
+    def context(self):
+        now = datetime(2016, 6, 13, 19, 0, tzinfo=pytz.utc)
+        return {'startTime': now - timedelta(hours=1), 'endTime': now, 'now': now, 'localOnly': False}
+
+
+class DownsamplingSafeTest(TestCase):
+
+    def test_linear_functions_are_safe(self):
+        self.assertTrue(downsamplingSafe(['a.*', 'alias(sumSeries(scale(a.*, 2)), "total")', ' ']))
+
+    def test_other_functions_are_not(self):
+        self.assertFalse(downsamplingSafe(['a.*', 'alias(maxSeries(a.*), "peak")']))
+        self.assertFalse(downsamplingSafe(['sumSeries(a.*, movingAverage(b, 5))']))
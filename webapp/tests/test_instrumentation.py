@@ -0,0 +1,87 @@
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+from django.test import TestCase
+
+from graphite import instrumentation
+from graphite.render import tieredcache
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, instrumentation, '_registry', instrumentation._registry)
+        instrumentation._registry = None
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_counters_and_histograms(self):
+        instrumentation.increment('render_errors_total', format='png')
+        instrumentation.increment('render_errors_total', 2, format='png')
+        instrumentation.observe('render_duration_seconds', 0.2, format='png')
+        instrumentation.observe('render_duration_seconds', 100, format='png')
+
+        text = instrumentation.exposition(instrumentation.aggregate())
+        lines = text.splitlines()
+        self.assertTrue('# TYPE graphite_webapp_render_errors_total counter' in lines)
+        self.assertTrue('graphite_webapp_render_errors_total{format="png"} 3' in lines)
+        self.assertTrue('# TYPE graphite_webapp_render_duration_seconds histogram' in lines)
+        self.assertTrue('graphite_webapp_render_duration_seconds_bucket{format="png",le="0.1"} 0' in lines)
+        self.assertTrue('graphite_webapp_render_duration_seconds_bucket{format="png",le="0.25"} 1' in lines)
+        self.assertTrue('graphite_webapp_render_duration_seconds_bucket{format="png",le="60.0"} 1' in lines)
+        self.assertTrue('graphite_webapp_render_duration_seconds_bucket{format="png",le="+Inf"} 2' in lines)
+        self.assertTrue('graphite_webapp_render_duration_seconds_sum{format="png"} 100.2' in lines)
+        self.assertTrue('graphite_webapp_render_duration_seconds_count{format="png"} 2' in lines)
+        # Collected from the modules keeping their own counts
+        self.assertTrue('graphite_webapp_cache_tier_hits_total{tier="shared"} %d' % tieredcache.shared.hits in lines)
+
+    def test_processes_share_their_counts(self):
+        def snapshot(name, errors, durations, entries):
+            with open(os.path.join(self.dir, name), 'wb') as f:
+                pickle.dump(dict(counters={('render_errors_total', ()): errors},
+                                 gauges={('index_entries', ()): entries},
+                                 histograms={('render_duration_seconds', ()): durations}), f)
+        durations = [0] * len(instrumentation.BUCKETS) + [1.5, 2]
+        snapshot('%d.pickle' % os.getppid(), 5, durations, 1000)
+        # A process that has exited, and a file no process wrote
+        snapshot('%d.pickle' % (2 ** 22 + 1), 7, durations, 2000)
+        snapshot('backup.pickle', 11, durations, 3000)
+
+        path = os.path.join(self.dir, '%d.pickle' % os.getpid())
+        with self.settings(INTERNAL_METRICS_DIR=self.dir):
+            instrumentation.setGauge('index_entries', 1000)
+            instrumentation.increment('render_errors_total')
+        with self.settings(INTERNAL_METRICS_DIR=self.dir, INTERNAL_METRICS_INTERVAL=0):
+            instrumentation.observe('render_duration_seconds', 0.5)
+            # Written in the background
+            deadline = time.time() + 5
+            while not os.path.exists(path) and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(path))
+            aggregated = instrumentation.aggregate()
+
+        self.assertEqual(aggregated['counters'][('render_errors_total', ())], 6)
+        self.assertEqual(aggregated['gauges'][('index_entries', ())], 1000)
+        self.assertEqual(aggregated['histograms'][('render_duration_seconds', ())][-2:], [2.0, 3])
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         sorted(['%d.pickle' % os.getppid(), '%d.pickle' % os.getpid(), 'backup.pickle']))
+
+    def test_carbon_lines(self):
+        instrumentation.increment('remote_store_failures_total', host='10.0.0.1:80')
+        instrumentation.observe('index_reload_duration_seconds', 1.5)
+        with self.settings(INTERNAL_METRICS_CARBON_PREFIX='webapps.{host}'):
+            lines = instrumentation.carbonLines(instrumentation.registry().snapshot(), 1400000000)
+        host = instrumentation.socket.gethostname().split('.')[0]
+        self.assertTrue('webapps.%s.remote_store_failures_total.10_0_0_1_80 1 1400000000' % host in lines)
+        self.assertTrue('webapps.%s.index_reload_duration_seconds_sum 1.5 1400000000' % host in lines)
+        self.assertTrue('webapps.%s.index_reload_duration_seconds_count 1 1400000000' % host in lines)
+
+    def test_internal_metrics_view(self):
+        instrumentation.observe('render_duration_seconds', 0.1, format='json')
+        response = self.client.get('/internal/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertTrue('graphite_webapp_render_duration_seconds_count{format="json"} 1' in response.content.splitlines())
@@ -0,0 +1,119 @@
+import random
+
+from django.test import TestCase
+
+from graphite.render.grammar import grammar, freeze
+from graphite.render.parser import parse, Tokens
+
+
+# Targets parse() must read into the same tree as the pyparsing grammar,
+# including the ones the grammar reads in surprising ways.
+CORPUS = [
+    '',
+    ' ',
+    'a',
+    'collectd.host1.cpu-0.cpu-user',
+    'collectd.*.cpu-[0-7].cpu-{user,system}.value',
+    'a.{b,c}d.{e}',
+    'a.{b,c',
+    'a.{}.b',
+    'a.b}',
+    "o'reilly.hits",
+    '"quoted".path',
+    '1.2.3',
+    '-',
+    '  leading.whitespace',
+    'trailing.whitespace  ',
+    'tabbed\t.path',
+    'a.b c.d',
+    'sumSeries(a.*)',
+    'sumSeries( a.* , b )',
+    'sumSeries (a.*)',
+    'sumSeries(a.*',
+    'sumSeries(a.*))',
+    'sumSeries(a.*) x',
+    'sumSeries()',
+    'sumSeries(,)',
+    'sumSeries(a,,b)',
+    '_private(a)',
+    '2fast(a)',
+    'a.b(c)',
+    'scale(a, 1)',
+    'scale(a, -1)',
+    'scale(a, - 1)',
+    'scale(a, 1.5)',
+    'scale(a, -0.25)',
+    'scale(a, 1.)',
+    'scale(a, .5)',
+    'scale(a, 1e3)',
+    'scale(a, 1E3)',
+    'scale(a, -1.5e-3)',
+    'scale(a, 1e)',
+    'scale(a, 1e3x)',
+    'scale(a, 0x10)',
+    'scale(a, 1 )',
+    'scale(a, 1\n)',
+    'scale(a, 1',
+    'scale(a, 1\n',
+    'scale(a, 1 2)',
+    'alias(a, "name")',
+    "alias(a, 'name')",
+    'alias(a, "a, b (c)")',
+    'alias(a, "a""b")',
+    r'alias(a, "a\"b")',
+    r"alias(a, '\x41')",
+    'alias(a, "unterminated)',
+    'alias(a, "")',
+    'alias(a, "line\nbreak")',
+    'alias(a, "tab\there")',
+    'legendValue(a, true)',
+    'legendValue(a, false)',
+    'legendValue(a, TRUE)',
+    'legendValue(a, False)',
+    'legendValue(a, truely)',
+    'legendValue(a, true_x)',
+    'legendValue(a, true$)',
+    'legendValue(a, true.x)',
+    'legendValue(a, true)x',
+    'true(a)',
+    'true',
+    'movingAverage(sumSeries(a.*), "5min")',
+    'aliasByNode(movingAverage(sumSeries(collectd.{web,api}*.cpu-*.cpu-user), \'5min\'), 1, -2)',
+    'asPercent(a.*, sumSeries(a.*))',
+    'timeShift(sumSeries(b.*), "1d")',
+    'f(g(h(i(j(k.l)))))',
+    'f(g(h(i(j(k.l))))',
+    'sumSeries(%s)' % ', '.join('servers.host%03d.cpu.{user,system}' % i for i in range(300)),
+    'group(%s)' % ','.join('scale(servers.host%03d.load, %d.5)' % (i, i) for i in range(100)),
+]
+
+
+class ParseTest(TestCase):
+
+    def assertParsesLikeGrammar(self, target):
+        self.assertEqual(parse(target), freeze(grammar.parseString(target)), repr(target))
+
+    def test_corpus(self):
+        for target in CORPUS:
+            self.assertParsesLikeGrammar(target)
+            self.assertParsesLikeGrammar(unicode(target))
+
+    def test_random_targets(self):
+        rng = random.Random(42)
+        pieces = ['a', 'b.c', '*', 'sum', 'f', '(', ')', ',', ' ', '\t', '\n', '{', '}', '1', '-', '.',
+                  'e', 'E', '"', "'", 'true', 'False', '$', '_', '\\', '[', ']', '9.5', '1e3', 'a.{b,c}']
+        for i in range(2000):
+            target = ''.join(rng.choice(pieces) for j in range(rng.randint(0, 12)))
+            self.assertParsesLikeGrammar(target)
+
+    def test_tree(self):
+        call = parse('f(a.{b,c}, 1, -2.5, 1E3, "x", TRUE)').expression.call
+        self.assertEqual(call.func, 'f')
+        self.assertEqual(call.args, (
+            Tokens(expression=Tokens(pathExpression='a.{b,c}')),
+            Tokens(number=Tokens(integer='1')),
+            Tokens(number=Tokens(float='-2.5')),
+            Tokens(number=Tokens(scientific='1e3')),
+            Tokens(string='"x"'),
+            Tokens(boolean='true'),
+        ))
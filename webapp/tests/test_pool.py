@@ -0,0 +1,134 @@
+import os
+import logging
+import shutil
+import tempfile
+import time
+import multiprocessing
+from datetime import datetime
+
+import pytz
+import whisper
+from django.test import TestCase
+from mock import patch
+
+from graphite import instrumentation, storage
+from graphite.render import datalib, evaluator, pool
+from graphite.render.datalib import TimeSeries, CompactTimeSeries
+from graphite.render.evaluator import evaluateTargets
+from graphite.storage import Store
+
+
+class SeriesTransferTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'series')
+        open(self.path, 'w').close()
+
+    def transfer(self, seriesList):
+        return pool.readSeriesList(self.path, pool.writeSeriesList(seriesList, self.path))
+
+    def test_series_are_built_again(self):
+        floats = TimeSeries('a', 0, 240, 60, [1.5, None, 2.5, float('inf')], consolidate='max')
+        floats.pathExpression = 'a*'
+        floats.options['stacked'] = True
+        floats.consolidate(2)
+        ints = TimeSeries('countSeries(a)', 0, 120, 60, [1, 2])
+        compact = CompactTimeSeries('b', 60, 180, 60, [None, 3.0])
+        compact.consolidate(2)
+
+        (floatsCopy, intsCopy, compactCopy) = self.transfer([floats, ints, compact])
+        self.assertEqual(floatsCopy.__class__, TimeSeries)
+        self.assertEqual(floatsCopy[:], floats[:])
+        self.assertEqual(list(floatsCopy), list(floats))
+        self.assertEqual(floatsCopy.__dict__, floats.__dict__)
+        self.assertEqual(type(intsCopy[0]), int)
+        self.assertEqual(compactCopy.__class__, CompactTimeSeries)
+        self.assertEqual(compactCopy.tolist(), [None, 3.0])
+        self.assertEqual(list(compactCopy), list(compact))
+        self.assertEqual((compactCopy.name, compactCopy.start, compactCopy.end, compactCopy.step),
+                         ('b', 60, 180, 60))
+
+
+class RenderPoolTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.now = int(time.time())
+        for host in range(3):
+            directory = os.path.join(self.root, 'hosts', 'host%d' % host)
+            os.makedirs(directory)
+            path = os.path.join(directory, 'cpu.wsp')
+            whisper.create(path, [(60, 60)])
+            whisper.update_many(path, [(self.now - 60 * i, i * (host + 1)) for i in range(50)])
+
+        for (module, name, value) in ((datalib, 'LOCAL_STORE', Store([self.root])),
+                                      (datalib, 'CarbonLink', datalib.CarbonLinkPool([], 1)),
+                                      (pool, 'SHARED_MEMORY_DIR', os.path.join(self.root, 'shm'))):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, value)
+        os.mkdir(pool.SHARED_MEMORY_DIR)
+
+        # Forked after patching, so the workers read the test data
+        self.pool = multiprocessing.Pool(2, pool.initWorker)
+        self.addCleanup(self.pool.terminate)
+
+    def context(self):
+        return {
+            'startTime': datetime.fromtimestamp(self.now - 3000, pytz.utc),
+            'endTime': datetime.fromtimestamp(self.now, pytz.utc),
+            'now': datetime.fromtimestamp(self.now, pytz.utc),
+            'localOnly': True,
+            'data': [],
+        }
+
+    def test_targets_are_evaluated_in_order(self):
+        targets = ['sumSeries(hosts.*.cpu)', 'hosts.*.cpu', 'movingAverage(hosts.host0.cpu, 3)',
+                   'countSeries(hosts.*.cpu)']
+        expected = evaluateTargets(self.context(), targets)
+        for budget in (1, 3):
+            with self.settings(RENDER_PROCESSES_PER_REQUEST=budget):
+                seriesList = pool.evaluateTargetsInPool(self.pool, self.context(), targets)
+            self.assertEqual([(s.name, s.start, s.end, s.step, s[:]) for s in seriesList],
+                             [(s.name, s.start, s.end, s.step, s[:]) for s in expected])
+        self.assertEqual(os.listdir(pool.SHARED_MEMORY_DIR), [])
+
+    def test_errors_are_raised_in_the_render(self):
+        self.assertRaises(KeyError, pool.evaluateTargetsInPool, self.pool, self.context(),
+                          ['hosts.*.cpu', 'noSuchFunction(hosts.*.cpu)'])
+        self.assertEqual(os.listdir(pool.SHARED_MEMORY_DIR), [])
+
+    def test_timeout_terminates_the_pool(self):
+        with patch('graphite.render.pool.evaluateTargets', side_effect=lambda *args: time.sleep(10)):
+            slowPool = multiprocessing.Pool(2, pool.initWorker)
+        self.addCleanup(slowPool.terminate)
+        self.addCleanup(setattr, pool, '_renderPool', pool._renderPool)
+        pool._renderPool = (os.getpid(), slowPool)
+
+        with self.settings(RENDER_PROCESS_TIMEOUT=0.5):
+            self.assertRaises(multiprocessing.TimeoutError, pool.evaluateTargetsInPool, slowPool,
+                              self.context(), ['hosts.host0.cpu', 'hosts.host1.cpu'])
+        self.assertEqual(pool._renderPool, None)
+        self.assertFalse(any(worker.is_alive() for worker in slowPool._pool))
+        self.assertEqual(os.listdir(pool.SHARED_MEMORY_DIR), [])
+
+    def test_workers_forked_while_locks_are_held(self):
+        # Locks other threads of the webapp could hold at fork time
+        locks = [logging._lock, instrumentation._registryLock, storage.COMPILED_PATTERNS._lock,
+                 storage.WHISPER_HEADERS._lock, evaluator.PARSED_TARGETS._lock]
+        for lock in locks:
+            lock.acquire()
+        try:
+            forkedPool = multiprocessing.Pool(2, pool.initWorker)
+        finally:
+            for lock in locks:
+                lock.release()
+        self.addCleanup(forkedPool.terminate)
+
+        targets = ['hosts.*.cpu', 'sumSeries(hosts.*.cpu)']
+        expected = evaluateTargets(self.context(), targets)
+        with self.settings(RENDER_PROCESS_TIMEOUT=10):
+            seriesList = pool.evaluateTargetsInPool(forkedPool, self.context(), targets)
+        self.assertEqual([s[:] for s in seriesList], [s[:] for s in expected])
@@ -0,0 +1,57 @@
+import time
+
+from django.test import TestCase
+
+from graphite.render import profiling
+
+
+class ProfilingTest(TestCase):
+
+    def setUp(self):
+        self.addCleanup(profiling.stop)
+
+    def test_stages_exclude_nested_stages(self):
+        profile = profiling.start()
+        with profiling.stage('function.movingAverage'):
+            time.sleep(0.05)
+            with profiling.stage('read.whisper'):
+                time.sleep(0.1)
+        with profiling.stage('read.whisper'):
+            pass
+        profiling.count('series', 2)
+        profiling.count('series', 3)
+        self.assertEqual(profiling.stop(), profile)
+
+        profiled = profile.asDict()
+        self.assertEqual(profiled['stages']['read.whisper']['calls'], 2)
+        self.assertAlmostEqual(profiled['stages']['read.whisper']['seconds'], 0.1, delta=0.03)
+        self.assertAlmostEqual(profiled['stages']['function.movingAverage']['seconds'], 0.05, delta=0.03)
+        self.assertEqual(profiled['counts'], {'series': 5})
+        self.assertTrue(profiled['total'] >= 0.15)
+
+    def test_unprofiled_threads_are_not_timed(self):
+        self.assertEqual(profiling.current(), None)
+        with profiling.stage('parse'):
+            profiling.count('series')
+        self.assertEqual(profiling.stop(), None)
+
+    def test_streamed_chunks_are_timed(self):
+        def slowChunks():
+            for chunk in ('[', '1', ']'):
+                time.sleep(0.02)
+                yield chunk
+        profile = profiling.Profile()
+        finished = []
+
+        chunks = profiling.timedChunks(slowChunks(), profile, 'serialization', lambda: finished.append(True))
+        self.assertEqual(list(chunks), ['[', '1', ']'])
+        self.assertEqual(finished, [True])
+        serialization = profile.asDict()['stages']['serialization']
+        self.assertEqual(serialization['calls'], 4)
+        self.assertTrue(serialization['seconds'] >= 0.05)
+
+        # Responses closed early are done too
+        chunks = profiling.timedChunks(slowChunks(), profile, 'serialization', lambda: finished.append(True))
+        chunks.next()
+        chunks.close()
+        self.assertEqual(finished, [True, True])
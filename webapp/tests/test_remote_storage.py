@@ -0,0 +1,254 @@
+import socket
+import threading
+import Queue
+import pickle
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from django.test import TestCase
+from mock import patch
+
+from graphite.remote_storage import (HTTPConnectionPool, RemoteNode, RemoteStore,
+                                     RequestLoop, FindRequest, parallelFind,
+                                     parallelFetch)
+from graphite import instrumentation, remote_storage, wireformat
+from graphite.storage import Leaf
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        content_type = 'text/plain'
+        wire = 'wireFormat=1' in self.path
+        if self.path.startswith('/metrics/find/'):
+            if wire:
+                content_type = wireformat.CONTENT_TYPE
+                body = wireformat.dumpNodes([Leaf('/tmp/a/b.wsp', 'a.b')])
+            else:
+                body = pickle.dumps([{'metric_path': 'a.b', 'isLeaf': True}])
+        elif self.path.startswith('/render/'):
+            seriesList = [{'name': 'a.b', 'start': 0, 'end': 60, 'step': 60,
+                           'values': [1.0, None], 'pathExpression': 'a.*'}]
+            if wire:
+                content_type = wireformat.CONTENT_TYPE
+                body = wireformat.dumpSeries(seriesList)
+            else:
+                body = pickle.dumps(seriesList)
+        elif self.path.startswith('/slow'):
+            time.sleep(1)
+            body = 'slow'
+        elif self.path.startswith('/chunked'):
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in ('ok', ' ', '/chunked', ''):
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            return
+        else:
+            body = 'ok %s' % self.path
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Emulates the webapp timing out the idle keep-alive connection
+        if self.path.startswith('/drop'):
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ServerTestCase(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.host = '127.0.0.1:%d' % self.server.server_port
+        self.pool = HTTPConnectionPool(self.host, 2)
+
+
+class HTTPConnectionPoolTest(ServerTestCase):
+
+    def get(self, url):
+        connection = self.pool.request('GET', url, None, None, 5)
+        (response, data) = self.pool.getresponse(connection)
+        self.assertEqual(response.status, 200)
+        return data
+
+    def test_connections_are_reused(self):
+        self.assertEqual(self.get('/a'), 'ok /a')
+        self.assertEqual(self.get('/b'), 'ok /b')
+        self.assertEqual(self.get('/c'), 'ok /c')
+        self.assertEqual((self.pool.hits, self.pool.misses), (2, 1))
+        self.assertEqual(len(self.pool.idle), 1)
+
+    def test_pool_size_is_bounded(self):
+        connections = [self.pool.request('GET', '/%d' % i, None, None, 5) for i in range(3)]
+        for connection in connections:
+            self.pool.getresponse(connection)
+        self.assertEqual(self.pool.misses, 3)
+        self.assertEqual(len(self.pool.idle), 2)
+
+    def test_stale_connection_is_replaced(self):
+        self.get('/drop')
+        time.sleep(0.1)
+        self.assertEqual(self.get('/b'), 'ok /b')
+        self.assertEqual((self.pool.hits, self.pool.misses, self.pool.stale), (0, 2, 1))
+        self.assertEqual(self.server.requests, ['/drop', '/b'])
+
+    def test_failed_reused_connection_is_retried_once(self):
+        self.get('/drop')
+        time.sleep(0.1)
+        # Closes that are not noticed before sending make the request fail
+        with patch('graphite.remote_storage.isStale', return_value=False):
+            self.assertEqual(self.get('/b'), 'ok /b')
+        self.assertEqual((self.pool.hits, self.pool.stale), (1, 1))
+        self.assertEqual(self.server.requests, ['/drop', '/b'])
+
+    def test_timeout_on_reused_connection_is_not_retried(self):
+        self.get('/a')
+        connection = self.pool.request('GET', '/slow', None, None, 0.2)
+        self.assertRaises(socket.timeout, self.pool.getresponse, connection)
+        self.assertEqual((self.pool.hits, self.pool.stale), (1, 0))
+        self.assertEqual(self.server.requests, ['/a', '/slow'])
+        self.assertEqual(self.pool.idle, [])
+
+    def test_counts_add_up_across_threads(self):
+        def requests():
+            for i in range(10):
+                self.get('/a')
+        threads = [threading.Thread(target=requests) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.pool.hits + self.pool.misses, 80)
+
+    def test_counters_are_exported(self):
+        remote_storage.connectionPools[self.host] = self.pool
+        self.addCleanup(remote_storage.connectionPools.pop, self.host)
+        self.get('/drop')
+        time.sleep(0.1)
+        self.get('/a')
+        self.get('/b')
+        lines = instrumentation.exposition(instrumentation.registry().snapshot()).splitlines()
+        for (result, count) in [('reused', 1), ('opened', 2), ('stale', 1)]:
+            self.assertIn('graphite_webapp_remote_connections_total{host="%s",result="%s"} %d'
+                          % (self.host, result, count), lines)
+        self.assertIn('graphite_webapp_remote_connections_idle{host="%s"} 1' % self.host, lines)
+
+    def test_disabled_pool_closes_connections(self):
+        self.pool.max_size = 0
+        self.get('/a')
+        self.get('/b')
+        self.assertEqual((self.pool.hits, self.pool.misses), (0, 2))
+        self.assertEqual(self.pool.idle, [])
+
+
+class RequestLoopTest(ServerTestCase):
+
+    def setUp(self):
+        super(RequestLoopTest, self).setUp()
+        remote_storage.connectionPools[self.host] = self.pool
+        self.addCleanup(remote_storage.connectionPools.pop, self.host)
+        self.results = []
+        self.errors = []
+
+    def add(self, loop, url):
+        loop.add(self.host, ('GET', url, None, None),
+                 lambda response, data: self.results.append((url, response.status, data)),
+                 self.errors.append)
+
+    def test_requests_are_multiplexed(self):
+        loop = RequestLoop()
+        for url in ('/a', '/chunked', '/b'):
+            self.add(loop, url)
+        loop.run(5)
+        self.assertEqual(sorted(self.results), [
+            ('/a', 200, 'ok /a'),
+            ('/b', 200, 'ok /b'),
+            ('/chunked', 200, 'ok /chunked'),
+        ])
+        self.assertEqual(self.errors, [])
+        self.assertEqual(len(self.pool.idle), 2)
+
+        # Connections left in the pool serve the next loop
+        loop = RequestLoop()
+        self.add(loop, '/c')
+        loop.run(5)
+        self.assertEqual(self.results[-1], ('/c', 200, 'ok /c'))
+        self.assertEqual(self.pool.hits, 1)
+
+    def test_single_deadline(self):
+        loop = RequestLoop()
+        self.add(loop, '/slow')
+        self.add(loop, '/slow')
+        self.add(loop, '/a')
+        start = time.time()
+        loop.run(0.5)
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertEqual(self.results, [('/a', 200, 'ok /a')])
+        self.assertEqual(len(self.errors), 2)
+
+    def test_failed_reused_connection_is_retried_once(self):
+        loop = RequestLoop()
+        self.add(loop, '/drop')
+        loop.run(5)
+        time.sleep(0.1)
+        with patch('graphite.remote_storage.isStale', return_value=False):
+            loop = RequestLoop()
+            self.add(loop, '/b')
+            loop.run(5)
+        self.assertEqual(self.results[-1], ('/b', 200, 'ok /b'))
+        self.assertEqual(self.errors, [])
+        self.assertEqual((self.pool.hits, self.pool.stale), (1, 1))
+
+    def test_parallel_find(self):
+        store = RemoteStore(self.host)
+        requests = parallelFind([store], 'a.*')
+        self.assertEqual([[node.metric_path for node in request.get_results()]
+                          for request in requests], [['a.b']])
+        # Results are cached like those of threaded finds
+        self.assertEqual(FindRequest(store, 'a.*').get_results()[0].metric_path, 'a.b')
+
+    def test_parallel_find_failure(self):
+        store = RemoteStore('127.0.0.1:1')
+        self.assertEqual(parallelFind([store], 'a.*'), [])
+        self.assertFalse(store.available)
+
+    def test_parallel_fetch_matches_fetch(self):
+        node = RemoteNode(RemoteStore(self.host), 'a.*', True)
+        result_queue = Queue.Queue()
+        parallelFetch([(node, 0, 60, 60, result_queue)])
+        self.assertEqual(result_queue.get_nowait(), (self.host, node.fetch(0, 60, 60)))
+        self.assertTrue(result_queue.empty())
+
+    def test_fetch_sends_max_data_points(self):
+        node = RemoteNode(RemoteStore(self.host), 'a.*', True)
+        self.assertEqual(node.fetch(0, 60, 60, maxDataPoints=300), node.fetch(0, 60, 60))
+        self.assertEqual([('maxDataPoints=300' in path) for path in self.server.requests],
+                         [True, False])
+
+    def test_wire_format_negotiation(self):
+        node = RemoteNode(RemoteStore(self.host), 'a.*', True)
+        store = RemoteStore(self.host)
+        pickled = node.fetch(0, 60, 60)
+        self.assertEqual(FindRequest(store, 'b.*').get_results()[0].metric_path, 'a.b')
+        with self.settings(REMOTE_STORE_USE_WIRE_FORMAT=True):
+            self.assertEqual(node.fetch(0, 60, 60), pickled)
+            self.assertEqual(FindRequest(store, 'c.*').get_results()[0].metric_path, 'a.b')
+        self.assertEqual([('wireFormat=1' in path) for path in self.server.requests],
+                         [False, False, True, True])
@@ -1,17 +1,29 @@
 from datetime import datetime
 import json
 import os
+import pickle
 import time
 
 from graphite.render.hashing import hashRequest, hashData
 from graphite.render.glyph import LineGraph
 from graphite.render.datalib import TimeSeries
+from graphite.render.views import resolutionHint, parseOptions, requestCacheKey
+from graphite.logger import log
+from graphite import instrumentation, wireformat
 import whisper
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.http import HttpRequest, QueryDict
 from django.test import TestCase
+from django.test.client import RequestFactory
+from mock import patch
+
+
+def content(response):
+    if getattr(response, 'streaming', False):
+        return ''.join(response.streaming_content)
+    return response.content
 
 
 class RenderTest(TestCase):
@@ -27,7 +39,7 @@ class RenderTest(TestCase):
         url = reverse('graphite.render.views.renderView')
 
         response = self.client.get(url, {'target': 'test', 'format': 'json'})
-        self.assertEqual(json.loads(response.content), [])
+        self.assertEqual(json.loads(content(response)), [])
         self.assertTrue(response.has_header('Expires'))
         self.assertTrue(response.has_header('Last-Modified'))
         self.assertTrue(response.has_header('Cache-Control'))
@@ -47,7 +59,7 @@ class RenderTest(TestCase):
         whisper.update(self.db, 0.6, ts)
 
         response = self.client.get(url, {'target': 'test', 'format': 'json'})
-        data = json.loads(response.content)
+        data = json.loads(content(response))
         end = data[0]['datapoints'][-4:]
         self.assertEqual(
             end, [[None, ts - 3], [0.5, ts - 2], [0.4, ts - 1], [0.6, ts]])
@@ -94,6 +106,22 @@ class RenderTest(TestCase):
         self.assertEqual(hashRequest(request_params),
                         hashRequest(reverse_request_params))
 
+    def test_request_cache_key(self):
+        factory = RequestFactory()
+        def key(query):
+            request = factory.get('/render', QueryDict(query))
+            (graphOptions, requestOptions) = parseOptions(request)
+            return requestCacheKey(request, requestOptions)[0]
+
+        # 07:00 on 2014-02-26 UTC
+        until = 1393398000
+        graph = key('target=a.b&from=01:00_20140226&until=07:00_20140226&now=%d&tz=UTC' % until)
+        self.assertEqual(key('target=a.b&from=%d&until=%d&now=%d&tz=UTC&_salt=1' % (until - 21595, until + 5, until + 50)),
+                         graph)
+        self.assertNotEqual(key('target=a.b&from=%d&until=%d&now=%d&tz=UTC' % (until - 21600, until + 60, until)),
+                            graph)
+        self.assertNotEqual(key('target=a.c&from=01:00_20140226&until=07:00_20140226&now=%d&tz=UTC' % until), graph)
+
     def test_hash_data(self):
         targets = ['foo=1', 'bar=2']
         start_time = datetime.fromtimestamp(0)
@@ -102,6 +130,91 @@ class RenderTest(TestCase):
         self.assertEqual(hashData(targets, start_time, end_time, local_node),
                         hashData(reversed(targets), start_time, end_time, local_node))
 
+        self.assertNotEqual(hashData(targets, start_time, end_time, local_node),
+                            hashData(targets, start_time, end_time, local_node, 300))
+
+    def test_downsampled_render(self):
+        url = reverse('graphite.render.views.renderView')
+        self.addCleanup(self.wipe_whisper)
+        whisper.create(self.db, [(1, 600), (10, 600)])
+        ts = int(time.time())
+        whisper.update_many(self.db, [(t, 1.0) for t in range(ts - 599, ts + 1)])
+
+        # Pickles are not consolidated to maxDataPoints, as remote webapps ask for them
+        params = {'format': 'pickle', 'from': '-5min', 'maxDataPoints': '30', 'noCache': '1'}
+        for (downsample, target, step, value) in ((False, 'scale(test, 2)', 1, 2.0),
+                                                  (True, 'scale(test, 2)', 10, 2.0),
+                                                  (True, 'movingAverage(test, 2)', 1, 1.0)):
+            with self.settings(DOWNSAMPLE_READS=downsample):
+                response = self.client.get(url, dict(params, target=target))
+            series = pickle.loads(response.content)[0]
+            self.assertEqual(series['step'], step)
+            self.assertEqual(set(series['values'][2:-1]), set([value]))
+
+    def test_wire_format(self):
+        self.addCleanup(self.wipe_whisper)
+        whisper.create(self.db, [(1, 60)])
+        ts = int(time.time())
+        whisper.update(self.db, 0.5, ts - 2)
+
+        url = reverse('graphite.render.views.renderView')
+        response = self.client.get(url, {'target': 'test', 'format': 'pickle', 'wireFormat': '1', 'from': '-1min'})
+        self.assertEqual(response['Content-Type'], wireformat.CONTENT_TYPE)
+        (series,) = wireformat.loads(response.content)
+        self.assertEqual(series, pickle.loads(self.client.get(url, {'target': 'test', 'format': 'pickle', 'from': '-1min'}).content)[0])
+        self.assertEqual(series['pathExpression'], u'test')
+
+        response = self.client.get('/metrics/find/', {'query': 'tes*', 'format': 'pickle', 'wireFormat': '1'})
+        self.assertEqual(response['Content-Type'], wireformat.CONTENT_TYPE)
+        self.assertEqual([node['metric_path'] for node in wireformat.loads(response.content)], ['test'])
+
+    def test_profiled_render(self):
+        url = reverse('graphite.render.views.renderView')
+        self.addCleanup(self.wipe_whisper)
+        whisper.create(self.db, [(1, 600)])
+        ts = int(time.time())
+        whisper.update_many(self.db, [(t, 1.0) for t in range(ts - 599, ts + 1)])
+
+        params = {'target': 'scale(test, 2)', 'format': 'json', 'from': '-5min', 'maxDataPoints': '30'}
+        response = self.client.get(url, dict(params, profile='1'))
+        profile = json.loads(response['X-Graphite-Profile'])
+        self.assertEqual(json.loads(response.content)[0]['target'], 'scale(test,2)')
+        for stage in ('parse', 'find.local', 'read.whisper', 'function.scale', 'consolidation', 'serialization'):
+            self.assertTrue(profile['stages'][stage]['calls'] >= 1, stage)
+        self.assertEqual(profile['counts']['series'], 1)
+        self.assertEqual(profile['counts']['files'], 1)
+        self.assertTrue(profile['counts']['points'] >= 300)
+        self.assertTrue(profile['total'] >= sum(stage['seconds'] for stage in profile['stages'].values()))
+
+        # Slow renders are logged once their streamed response is done
+        with patch.object(log, 'slow_query') as slow_query:
+            with self.settings(SLOW_QUERY_THRESHOLD=1e-9):
+                response = self.client.get(url, params)
+                self.assertFalse('X-Graphite-Profile' in response)
+                self.assertFalse(slow_query.called)
+                content(response)
+        logged = json.loads(slow_query.call_args[0][0])
+        self.assertEqual(logged['url'], response.request['PATH_INFO'] + '?' + response.request['QUERY_STRING'])
+        self.assertTrue(logged['stages']['serialization']['calls'] >= 1)
+        self.assertEqual(logged['counts']['series'], 1)
+
+    def test_render_metrics(self):
+        url = reverse('graphite.render.views.renderView')
+        key = ('render_duration_seconds', (('format', 'json'),))
+        before = instrumentation.registry().snapshot()['histograms'].get(key, [0])[-1]
+        self.client.get(url, {'target': 'test', 'format': 'json'})
+        self.client.get(url, {'target': 'test', 'format': 'json'})
+        self.assertEqual(instrumentation.registry().snapshot()['histograms'][key][-1], before + 2)
+
+    def test_resolution_hint(self):
+        graphOptions = {'width': 800}
+        requestOptions = {'graphType': 'line', 'targets': ['sumSeries(a.*)']}
+        self.assertEqual(resolutionHint(graphOptions, requestOptions), 800)
+        self.assertEqual(resolutionHint(graphOptions, dict(requestOptions, maxDataPoints=100)), 100)
+        self.assertEqual(resolutionHint(graphOptions, dict(requestOptions, format='csv')), None)
+        self.assertEqual(resolutionHint(graphOptions, dict(requestOptions, graphType='pie')), None)
+        self.assertEqual(resolutionHint(graphOptions, dict(requestOptions, targets=['maxSeries(a.*)'])), None)
+        self.assertEqual(resolutionHint({'width': 'wide'}, requestOptions), None)
 
     def test_consolidated_stacked_yMax(self):
         # Fixture: timeseries with a spike in the middle
@@ -136,7 +249,7 @@ class RenderTest(TestCase):
                  'until': '08:01_20140226',
                  'tz': 'UTC',
         })
-        data = json.loads(response.content)[0]['datapoints']
+        data = json.loads(content(response))[0]['datapoints']
         # all the from/until/tz combinations lead to the same window
         expected = [[12, 1393398060], [12, 1393401660]]
         self.assertEqual(data, expected)
@@ -148,7 +261,7 @@ class RenderTest(TestCase):
                  'until': '09:01_20140226',
                  'tz': 'Europe/Berlin',
         })
-        data = json.loads(response.content)[0]['datapoints']
+        data = json.loads(content(response))[0]['datapoints']
         # all the from/until/tz combinations lead to the same window
         expected = [[12, 1393398060], [12, 1393401660]]
         self.assertEqual(data, expected)
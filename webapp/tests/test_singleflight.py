@@ -0,0 +1,85 @@
+import threading
+import time
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+
+from graphite.render import singleflight, tieredcache
+
+
+class SingleFlightTest(TestCase):
+
+    def setUp(self):
+        self.cache = LocMemCache('singleflight', {})
+        self.cache.clear()
+        for module in (singleflight, tieredcache):
+            self.addCleanup(setattr, module, 'cache', module.cache)
+            module.cache = self.cache
+        self.computed = []
+
+    def compute(self, value, delay=0):
+        def compute():
+            self.computed.append(value)
+            time.sleep(delay)
+            return value
+        return compute
+
+    def test_concurrent_misses_compute_once(self):
+        results = []
+        def render():
+            results.append(singleflight.cached('key', self.compute(['data'], 0.2), 60))
+        threads = [threading.Thread(target=render) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.computed, [['data']])
+        self.assertEqual(results, [['data']] * 5)
+        # Every render gets a copy of its own
+        self.assertEqual(len(set(map(id, results))), 5)
+        self.assertEqual(self.cache.get('key'), ['data'])
+
+    def test_waits_for_other_processes(self):
+        self.cache.add('key:lock', True, 30)
+        def otherProcess():
+            time.sleep(0.2)
+            self.cache.set('key', 'theirs', 60)
+            self.cache.delete('key:lock')
+        threading.Thread(target=otherProcess).start()
+
+        self.assertEqual(singleflight.cached('key', self.compute('ours'), 60), 'theirs')
+        self.assertEqual(self.computed, [])
+
+    def test_computes_when_other_process_gives_up(self):
+        self.cache.add('key:lock', True, 30)
+        threading.Timer(0.2, self.cache.delete, ['key:lock']).start()
+        self.assertEqual(singleflight.cached('key', self.compute('ours'), 60), 'ours')
+        self.assertEqual(self.computed, ['ours'])
+
+    def test_false_values_are_not_cached(self):
+        self.assertEqual(singleflight.cached('key', self.compute([]), 60), [])
+        self.assertEqual(singleflight.cached('key', self.compute([]), 60), [])
+        self.assertEqual(self.computed, [[], []])
+
+    def test_stale_entries_are_served_while_refreshed(self):
+        with self.settings(STALE_CACHE_DURATION=60):
+            singleflight.store('key', 'old', 60)
+            self.assertEqual(singleflight.cached('key', self.compute('new'), 60), 'old')
+
+            self.cache.set('key', (singleflight.ENVELOPE, time.time() - 1, 'old'), 60)
+            self.cache.add('key:lock', True, 30)
+            self.assertEqual(singleflight.cached('key', self.compute('new'), 60), 'old')
+            self.assertEqual(self.computed, [])
+
+            self.cache.delete('key:lock')
+            self.assertEqual(singleflight.cached('key', self.compute('new'), 60), 'new')
+            self.assertEqual(singleflight.lookup('key'), ('new', True))
+            self.assertEqual(self.computed, ['new'])
+
+    def test_tuples_are_cached_as_they_are(self):
+        for stale in (0, 60):
+            with self.settings(STALE_CACHE_DURATION=stale):
+                for value in ((1, 2), (1, 2, 3), ('singleflight', 1)):
+                    singleflight.store('key', value, 60)
+                    self.assertEqual(singleflight.lookup('key'), (value, True))
@@ -0,0 +1,271 @@
+import fnmatch
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import whisper
+from django.test import TestCase
+
+from graphite.storage import find, Branch, DirectoryCache, WhisperFile
+from graphite import storage
+
+
+class StorageTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.cache = DirectoryCache(100)
+        self.cache.racy_interval = -1
+        self.orig_cache = storage.DIRECTORY_CACHE
+        storage.DIRECTORY_CACHE = self.cache
+        self.addCleanup(setattr, storage, 'DIRECTORY_CACHE', self.orig_cache)
+
+    def touch(self, *parts):
+        path = os.path.join(self.root, *parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        return path
+
+    def find_paths(self, pattern):
+        return sorted((node.metric_path, node.__class__)
+                      for node in find(self.root, pattern))
+
+    def test_find_classifies_nodes(self):
+        self.touch('servers', 'a', 'cpu.wsp')
+        self.touch('servers', 'b', 'cpu.wsp')
+        self.touch('servers', 'b', 'load', 'short.wsp')
+
+        self.assertEqual(self.find_paths('servers.*'), [
+            ('servers.a', Branch),
+            ('servers.b', Branch),
+        ])
+        self.assertEqual(self.find_paths('servers.{a,b}.*'), [
+            ('servers.a.cpu', WhisperFile),
+            ('servers.b.cpu', WhisperFile),
+            ('servers.b.load', Branch),
+        ])
+
+    def test_directory_cache_is_revalidated_by_mtime(self):
+        self.touch('servers', 'a', 'cpu.wsp')
+        self.assertEqual(self.find_paths('servers.a.*'),
+                         [('servers.a.cpu', WhisperFile)])
+        self.assertTrue(os.path.join(self.root, 'servers', 'a') in self.cache.listings)
+
+        memory = self.touch('servers', 'a', 'memory.wsp')
+        # Make sure the mtime moves even on coarse-grained filesystems
+        directory = os.path.dirname(memory)
+        mtime = os.stat(directory).st_mtime + 2
+        os.utime(directory, (mtime, mtime))
+
+        self.assertEqual(self.find_paths('servers.a.*'), [
+            ('servers.a.cpu', WhisperFile),
+            ('servers.a.memory', WhisperFile),
+        ])
+
+    def test_directory_cache_evicts_least_recently_used(self):
+        cache = DirectoryCache(1)
+        cache.racy_interval = -1
+        first = os.path.dirname(self.touch('a', 'x.wsp'))
+        second = os.path.dirname(self.touch('b', 'y.wsp'))
+
+        self.assertEqual(cache.listdir(first).files, ['x.wsp'])
+        self.assertEqual(cache.listdir(second).files, ['y.wsp'])
+        self.assertFalse(first in cache.listings)
+        self.assertTrue(second in cache.listings)
+
+    def test_recently_modified_directories_are_not_cached(self):
+        cache = DirectoryCache(10)
+        directory = os.path.dirname(self.touch('a', 'x.wsp'))
+        os.utime(directory, (time.time(), time.time()))
+
+        self.assertEqual(cache.listdir(directory).files, ['x.wsp'])
+        self.assertFalse(directory in cache.listings)
+
+    def test_listdir_without_scandir(self):
+        self.touch('servers', 'a', 'cpu.wsp')
+        self.touch('servers', 'load.wsp')
+        directory = os.path.join(self.root, 'servers')
+
+        listing = storage._listdir(directory)
+        orig_scandir = storage.scandir
+        storage.scandir = False
+        self.addCleanup(setattr, storage, 'scandir', orig_scandir)
+
+        fallback = storage._listdir(directory)
+        self.assertEqual((fallback.subdirs, fallback.files), (listing.subdirs, listing.files))
+        self.assertEqual((listing.subdirs, listing.files), (['a'], ['load.wsp']))
+
+    def test_match_entries(self):
+        entries = ['cpu', 'cpu0', 'memory', 'load']
+        self.assertEqual(storage.match_entries(entries, 'cpu*'), ['cpu', 'cpu0'])
+        self.assertEqual(storage.match_entries(entries, '{cpu,cpu*,load}'),
+                         ['cpu', 'cpu0', 'load'])
+        self.assertEqual(storage.match_entries(entries, 'disk'), [])
+
+    def test_match_entries_literal_of_another_string_type(self):
+        # str.__eq__(u'...') is NotImplemented, which must not count as a match
+        self.assertEqual(storage.match_entries([u'cpu', u'cpu0', u'load'], 'cpu'), [u'cpu'])
+        self.assertEqual(storage.match_entries(['cpu', 'cpu0', 'load'], u'cpu'), ['cpu'])
+        self.assertEqual(storage.match_entries([u'cpu0', u'load'], 'cpu'), [])
+
+    def test_compile_pattern_matches_expanded_braces(self):
+        names = ['a', 'b', 'ab', 'a1', 'b1', 'c', 'ac1', '{a', 'a}', 'a,b',
+                 '{a,b}', '', 'x.y', 'ba', 'abc', '[a']
+        patterns = ['{a,b}', '{a,b}1', '{a,{b,c}}', '{a,b}{,1}', '{a', 'a}',
+                    '{a{,b}', '{}', '{a}', 'a,b', '*{1,c}', '?{,b}', '[ab]*',
+                    '[!a]*', '[a', '{a,b}*{1,2}', '{{a}', '[{a,b}]', '{a,[b]}']
+        for pattern in patterns:
+            for name in names:
+                expected = any(fnmatch.fnmatchcase(name, variant)
+                               for variant in storage.expand_braces(pattern))
+                self.assertEqual(bool(storage.compile_pattern(pattern)(name)), expected,
+                                 "%r against %r" % (pattern, name))
+
+    def test_compile_pattern_random_braces(self):
+        rng = random.Random(42)
+        alphabet = 'ab{},*?'
+        names = ['', 'a', 'b', 'aa', 'ab', 'ba', 'bb', 'a,b', '{a}', 'aba']
+        for i in range(2000):
+            pattern = ''.join(rng.choice(alphabet) for j in range(rng.randint(1, 7)))
+            for name in names:
+                expected = any(fnmatch.fnmatchcase(name, variant)
+                               for variant in storage.expand_braces(pattern))
+                self.assertEqual(bool(storage.compile_pattern(pattern)(name)), expected,
+                                 "%r against %r" % (pattern, name))
+
+    def test_find_plain_names(self):
+        self.touch('servers', 'a', 'cpu.wsp')
+        self.touch('servers', 'a', 'cpu', 'user.wsp')
+        self.touch('servers', 'a', 'cpu0.wsp')
+
+        self.assertEqual(self.find_paths('servers.a.cpu'), [
+            ('servers.a.cpu', Branch),
+            ('servers.a.cpu', WhisperFile),
+        ])
+        self.assertEqual(self.find_paths('servers.b.cpu'), [])
+
+    def test_find_unicode_literal(self):
+        self.touch('servers', 'a', 'cpu.wsp')
+        self.touch('servers', 'a', 'cpu0.wsp')
+        self.touch('servers', 'b', 'cpu.wsp')
+        self.root = unicode(self.root)
+
+        self.assertEqual(self.find_paths(u'servers.a.cpu'), [('servers.a.cpu', WhisperFile)])
+        self.assertEqual(self.find_paths('servers.*.cpu'), [
+            ('servers.a.cpu', WhisperFile),
+            ('servers.b.cpu', WhisperFile),
+        ])
+        self.assertEqual(self.find_paths(u'servers.{a,c}.cpu'), [('servers.a.cpu', WhisperFile)])
+
+
+class WhisperMmapReaderTest(TestCase):
+
+    def setUp(self):
+        if not storage.numpy:
+            self.skipTest("numpy is not installed")
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'test.wsp')
+
+    def assertSameFetch(self, fromTime, untilTime, now):
+        expected = whisper.fetch(self.path, fromTime, untilTime, now)
+        result = storage.whisper_mmap_fetch(self.path, fromTime, untilTime, now)
+        if expected is None:
+            self.assertEqual(result, None)
+            return
+        (timeInfo, values, nulls) = result
+        self.assertEqual((timeInfo, storage.value_list(values, nulls)), expected,
+                         "fetch(%s, %s, %s)" % (fromTime, untilTime, now))
+
+    def test_empty_archive(self):
+        whisper.create(self.path, [(1, 20), (5, 12)])
+        now = int(time.time())
+        self.assertSameFetch(now - 10, now, now)
+        self.assertSameFetch(now - 50, now - 20, now)
+
+    def test_matches_whisper_fetch(self):
+        whisper.create(self.path, [(1, 20), (5, 12)])
+        now = int(time.time())
+        # Write more points than the archive holds so the ring buffer wraps,
+        # and leave some holes behind
+        points = [(t, float(t % 97)) for t in range(now - 45, now + 1) if t % 7]
+        whisper.update_many(self.path, points)
+
+        for until_offset in (0, 1, 3, 13, 19, 25):
+            for length in (0, 1, 2, 7, 19, 20, 21, 40, 59, 100):
+                until = now - until_offset
+                self.assertSameFetch(until - length, until, now)
+                self.assertSameFetch(until - length, until, now + 4)
+        self.assertSameFetch(now + 5, now + 10, now)
+
+    def test_header_cache(self):
+        whisper.create(self.path, [(1, 20), (5, 12)])
+        self.assertEqual(storage.whisper_mmap_info(self.path), whisper.info(self.path))
+
+        # Writes leave the header cached
+        hits = storage.WHISPER_HEADERS.hits
+        whisper.update(self.path, 1.0)
+        self.assertEqual(storage.whisper_mmap_info(self.path), whisper.info(self.path))
+        self.assertEqual(storage.WHISPER_HEADERS.hits, hits + 1)
+
+        # A recreated file with other archives is read again
+        os.unlink(self.path)
+        whisper.create(self.path, [(10, 30)])
+        self.assertEqual(storage.whisper_mmap_info(self.path), whisper.info(self.path))
+
+    def test_whisper_file_fetch(self):
+        whisper.create(self.path, [(1, 20)])
+        now = int(time.time())
+        whisper.update(self.path, 0.5, now - 2)
+        node = WhisperFile(self.path, 'test')
+
+        with self.settings(WHISPER_READER='mmap'):
+            self.assertEqual(node.fetch(now - 5, now, now),
+                             whisper.fetch(self.path, now - 5, now, now))
+
+
+class DownsampledReadTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'test.wsp')
+        whisper.create(self.path, [(1, 600), (10, 600), (60, 600)])
+        self.now = int(time.time())
+        whisper.update_many(self.path, [(t, float(t % 10)) for t in range(self.now - 599, self.now + 1)])
+
+    def window(self, fromTime, maxDataPoints):
+        (archive, timeInfo) = storage.whisper_fetch_window(whisper.info(self.path), fromTime,
+                                                           self.now, self.now, maxDataPoints)
+        return archive['secondsPerPoint']
+
+    def test_coarsest_archive_with_enough_points(self):
+        self.assertEqual(self.window(self.now - 500, None), 1)
+        self.assertEqual(self.window(self.now - 500, 500), 1)
+        self.assertEqual(self.window(self.now - 500, 50), 10)
+        self.assertEqual(self.window(self.now - 500, 8), 60)
+        self.assertEqual(self.window(self.now - 500, 1), 60)
+        self.assertEqual(self.window(self.now - 3000, 50), 60)
+
+    def test_only_averaging_files_are_downsampled(self):
+        whisper.setAggregationMethod(self.path, 'max')
+        self.assertEqual(self.window(self.now - 500, 8), 1)
+
+    def test_whisper_file_fetch(self):
+        node = WhisperFile(self.path, 'test')
+        readers = ['whisper']
+        if storage.numpy:
+            readers.append('mmap')
+        for reader in readers:
+            with self.settings(WHISPER_READER=reader):
+                self.assertEqual(node.fetch(self.now - 500, self.now, self.now),
+                                 whisper.fetch(self.path, self.now - 500, self.now, self.now))
+                ((start, end, step), values) = node.fetch(self.now - 500, self.now, self.now, 50)
+                self.assertEqual(step, 10)
+                self.assertEqual(len(values), (end - start) // step)
+                # Every complete 10 second interval averages 0 to 9
+                self.assertEqual(set(values[:-1]), set([4.5]))
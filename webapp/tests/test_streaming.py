@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import csv
+import random
+from cStringIO import StringIO
+from datetime import datetime
+
+import pytz
+from django.test import TestCase
+
+from graphite.render import streaming
+from graphite.render.datalib import TimeSeries, CompactTimeSeries
+from graphite.render.streaming import jsonChunks, csvChunks, rawChunks
+from graphite.util import json
+
+
+class StreamingTest(TestCase):
+
+    def setUp(self):
+        rng = random.Random(7)
+        values = [None if rng.random() < 0.1 else rng.random() * 1000 - 500 for i in range(25)]
+        self.data = [
+            TimeSeries('a.b', 1393398000, 1393399500, 60, values),
+            TimeSeries('sumSeries(a.*)', 1393398000, 1393398180, 60, [1, 2, None]),
+            TimeSeries(u'alias(a, "q\\"ü")', 1393398000, 1393398120, 60, [float('nan'), float('inf'), -0.0]),
+            TimeSeries('empty', 1393398000, 1393398000, 60, []),
+            CompactTimeSeries('compact', 1393398000, 1393398120, 60, [None, 2.5]),
+        ]
+        # Chunks of a few points, so series span several of them
+        self.addCleanup(setattr, streaming, 'POINTS_PER_CHUNK', streaming.POINTS_PER_CHUNK)
+        streaming.POINTS_PER_CHUNK = 4
+
+    def test_json(self):
+        pairs = [(series, xrange(series.start, series.end + 1, series.step)) for series in self.data]
+        expected = json.dumps([dict(target=series.name, datapoints=zip(series, timestamps))
+                               for (series, timestamps) in pairs])
+        self.assertEqual(''.join(jsonChunks(pairs)), expected)
+        self.assertEqual(''.join(jsonChunks(pairs, 'cb')), 'cb(%s)' % expected)
+        self.assertEqual(''.join(jsonChunks([])), json.dumps([]))
+
+    def test_csv(self):
+        # csv writes byte strings only
+        data = [series for series in self.data if not isinstance(series.name, unicode)]
+        for tzinfo in (pytz.utc, pytz.timezone('Europe/Berlin')):
+            expected = StringIO()
+            writer = csv.writer(expected, dialect='excel')
+            for series in data:
+                for i, value in enumerate(series):
+                    timestamp = datetime.fromtimestamp(series.start + (i * series.step), tzinfo)
+                    writer.writerow((series.name, timestamp.strftime("%Y-%m-%d %H:%M:%S"), value))
+            self.assertEqual(''.join(csvChunks(data, tzinfo)), expected.getvalue())
+
+    def test_raw(self):
+        expected = ''
+        for series in self.data:
+            expected += "%s,%d,%d,%d|" % (series.name, series.start, series.end, series.step)
+            expected += ','.join(map(str, series))
+            expected += '\n'
+        self.assertEqual(''.join(rawChunks(self.data)), expected)
+
+    def test_series_span_chunks(self):
+        # a.b has 25 points, which take 7 chunks of 4
+        series = self.data[0]
+        timestamps = xrange(series.start, series.end + 1, series.step)
+        self.assertEqual(len(list(jsonChunks([(series, timestamps)]))), 1 + 1 + 7 + 1 + 1)
+        self.assertEqual(len(list(csvChunks([series], pytz.utc))), 7)
+        self.assertEqual(len(list(rawChunks([series]))), 1 + 7 + 1)
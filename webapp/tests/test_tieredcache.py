@@ -0,0 +1,75 @@
+import time
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+
+from graphite.render import tieredcache
+
+
+class TieredCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = LocMemCache('tieredcache', {})
+        self.cache.clear()
+        self.addCleanup(setattr, tieredcache, 'cache', tieredcache.cache)
+        tieredcache.cache = self.cache
+        tieredcache.local.clear()
+        self.addCleanup(tieredcache.local.clear)
+
+    def test_disabled_tiers_pass_values_through(self):
+        tieredcache.set('key', ['data'], 60)
+        self.assertEqual(self.cache.get('key'), ['data'])
+        self.assertEqual(tieredcache.get('key'), ['data'])
+        self.assertEqual(tieredcache.local.entries, {})
+
+    def test_values_are_served_from_the_process(self):
+        with self.settings(LOCAL_CACHE_MAX_BYTES=1024):
+            tieredcache.set('key', ['data'], 60)
+            before = tieredcache.stats()
+            self.cache.clear()
+            value = tieredcache.get('key')
+            self.assertEqual(value, ['data'])
+            # Every lookup gets a copy of its own
+            value.append('changed')
+            self.assertEqual(tieredcache.get('key'), ['data'])
+
+            after = tieredcache.stats()
+            self.assertEqual(after['local']['hits'] - before['local']['hits'], 2)
+            self.assertEqual(after['shared']['hits'], before['shared']['hits'])
+
+    def test_values_read_from_the_cache_expire_with_it(self):
+        with self.settings(LOCAL_CACHE_MAX_BYTES=1024):
+            tieredcache.set('key', ['data'], 60, 1)
+            tieredcache.local.clear()
+            self.assertEqual(tieredcache.get('key'), ['data'])
+            (expires, data) = tieredcache.local.entries['key']
+            self.assertAlmostEqual(expires, time.time() + 1, delta=0.5)
+
+            self.cache.set('old', ['data'], 60)
+            self.assertEqual(tieredcache.get('old'), ['data'])
+            self.assertFalse('old' in tieredcache.local.entries)
+
+    def test_least_recently_used_values_are_dropped(self):
+        with self.settings(LOCAL_CACHE_MAX_BYTES=1024):
+            tieredcache.set('a', 'x' * 100, 60)
+            size = tieredcache.local.size
+        with self.settings(LOCAL_CACHE_MAX_BYTES=size * 3):
+            for key in 'bc':
+                tieredcache.set(key, 'x' * 100, 60)
+            tieredcache.get('a')
+            tieredcache.set('d', 'x' * 100, 60)
+            self.assertEqual(tieredcache.local.entries.keys(), ['c', 'a', 'd'])
+            self.assertEqual(tieredcache.local.size, size * 3)
+
+            tieredcache.set('big', 'x' * 1000, 60)
+            self.assertFalse('big' in tieredcache.local.entries)
+            self.assertEqual(tieredcache.get('big'), 'x' * 1000)
+
+    def test_large_values_are_compressed(self):
+        with self.settings(CACHE_COMPRESSION_MIN_BYTES=100):
+            tieredcache.set_many({'small': [1.0], 'large': [1.0] * 1000}, 60)
+            self.assertFalse(self.cache.get('small')[2])
+            self.assertTrue(self.cache.get('large')[2])
+            self.assertTrue(len(self.cache.get('large')[3]) < 1000)
+            self.assertEqual(tieredcache.get_many(['small', 'large', 'missing']),
+                             {'small': [1.0], 'large': [1.0] * 1000})
@@ -0,0 +1,79 @@
+
+import pickle
+
+from django.test import TestCase
+from mock import Mock, patch
+
+from graphite import wireformat
+from graphite.render.datalib import TimeSeries
+from graphite.storage import Branch
+
+
+class WireFormatTest(TestCase):
+
+    def series(self, name, values, start=0, step=60):
+        series = TimeSeries(name, start, start + step * len(values), step, values)
+        series.pathExpression = 'collectd.*.load'
+        return series
+
+    def test_series_round_trip(self):
+        nan = float('nan')
+        seriesList = [
+            self.series('collectd.a.load', [1.5, None, -2.25, None, 1e300] * 3),
+            self.series('collectd.b.load', [], start=1465844460),
+            self.series('collectd.\xc3\xa9.load', [None] * 9),
+            self.series('collectd.c.load', [0.1] * 17),
+        ]
+        seriesList[1].pathExpression = None
+
+        data = wireformat.dumpSeries(seriesList)
+        self.assertEqual(wireformat.loads(data), [s.getInfo() for s in seriesList])
+        self.assertEqual(wireformat.loads(wireformat.dumpSeries([s.getInfo() for s in seriesList])),
+                         wireformat.loads(data))
+
+        (decoded,) = wireformat.loads(wireformat.dumpSeries([self.series('nan', [nan])]))
+        self.assertNotEqual(decoded['values'][0], decoded['values'][0])
+
+    def test_inexact_series_are_refused(self):
+        for series in (self.series('a', [1.0], start=0.5),
+                       self.series('a', ['1.0'])):
+            self.assertRaises(wireformat.WireFormatError, wireformat.dumpSeries, [series])
+
+    def test_nodes_round_trip(self):
+        class Leaf(Branch):
+            def isLeaf(self):
+                return True
+
+            def getIntervals(self):
+                return [(1.5, 2.5), (3.0, 4.0)]
+
+        nodes = [Branch('/tmp/a', 'collectd.a'), Leaf('/tmp/a/b.wsp', 'collectd.a.b')]
+        self.assertEqual(wireformat.loads(wireformat.dumpNodes(nodes)), [
+            {'metric_path': 'collectd.a', 'isLeaf': False, 'intervals': []},
+            {'metric_path': 'collectd.a.b', 'isLeaf': True,
+             'intervals': [(1.5, 2.5), (3.0, 4.0)]},
+        ])
+
+    def test_malformed_messages(self):
+        data = wireformat.dumpSeries([self.series('a', [1.0, None])])
+        for bad in ('', 'GWF', 'XYZ' + data[3:], data[:-1], data + '\0',
+                    data[:3] + chr(wireformat.VERSION + 1) + data[4:]):
+            self.assertRaises(wireformat.WireFormatError, wireformat.loads, bad)
+
+    def test_unicode_strings(self):
+        series = self.series(u'alias(a, "\xfc")', [1.0])
+        series.pathExpression = u'a'
+        (decoded,) = wireformat.loads(wireformat.dumpSeries([series, self.series('\xff', [])]))[:1]
+        self.assertEqual(decoded, series.getInfo())
+        self.assertEqual(map(type, (decoded['name'], decoded['pathExpression'])), [unicode, unicode])
+
+    def test_find_view_falls_back_to_pickle(self):
+        node = Branch('/tmp/a', 'collectd.a')
+        node.metric_path = 42
+        store = Mock()
+        store.find.return_value = [node]
+        with patch('graphite.metrics.views.STORE', store):
+            response = self.client.get('/metrics/find/', {'query': 'collectd.*', 'format': 'pickle', 'wireFormat': 1})
+        self.assertEqual(response['Content-Type'], 'application/pickle')
+        self.assertEqual(pickle.loads(response.content),
+                         [{'metric_path': 42, 'isLeaf': False, 'intervals': []}])